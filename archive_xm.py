@@ -0,0 +1,249 @@
+"""
+Retención y compactación del archivo de Garantías.
+
+Con un libro suelto por día y esquema, las carpetas de ./Garantías acumulan miles de
+archivos que upload_drive recorre (y consulta en Drive) y que el manifiesto reconcilia con
+el disco. Este comando deja sueltos solo los meses activos (los últimos --keep-months,
+el actual incluido) y junta cada mes cerrado de cada esquema en un único zip:
+
+    <root>/.xm_archivo/<esquema>/<YYYY-MM>.zip
+
+La carpeta es oculta: ni upload_drive ni el descargador la recorren. Compactar reduce la
+cantidad de archivos, no los bytes (un .xlsx ya está comprimido). Lo que acota el tamaño
+de ./Garantías (y de la caché de actions que lo guarda) es la retención: con
+--expire-months N, los zips de meses anteriores a los últimos N se borran del disco si
+todos sus libros ya se subieron a Drive, que pasa a ser la única copia. Sus filas quedan
+en el manifiesto marcadas como expiradas, así el descargador no los vuelve a bajar. Los libros conservan
+su contenido exacto (mismo sha256 que en el almacén compartido) y su fila en el manifiesto
+(manifest_xm), que anota el zip que los contiene. Así la lectura sigue siendo transparente:
+- ProbePlan y _is_cached los siguen viendo como descargados (no se vuelven a bajar).
+- read_workbook (y con él calculate_debt_for_agent) los lee desde el zip sin extraerlos.
+- El calendario de publicación sigue aprendiendo de todo el historial.
+--extract devuelve un mes a su carpeta (ej: para abrirlo en Excel).
+
+Uso:
+    python archive_xm.py
+    python archive_xm.py --keep-months 2 --dry-run
+    python archive_xm.py --extract TIE 2026-03
+    python archive_xm.py --uploaded-only --expire-months 6
+"""
+import os
+import sys
+import time
+import zipfile
+import argparse
+from datetime import datetime
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+import download_xm_file
+
+ARCHIVE_DIRNAME = ".xm_archivo"   # Oculto: upload_drive no lo sube
+ARCHIVE_KEEP_MONTHS = 3           # Meses sueltos (el actual incluido); los anteriores se compactan
+EXPIRED_ARCHIVE = "expirado"      # Columna archivo de los libros cuyo zip se borró (solo en Drive)
+
+
+def archive_path(root_dir, scheme_name, month):
+    return os.path.join(root_dir, ARCHIVE_DIRNAME, scheme_name, f"{month}.zip")
+
+
+def _month_of(row):
+    """"YYYY-MM" del libro: el de la fecha del nombre o, sin fecha, el de modificación."""
+    if row["fecha"]:
+        return row["fecha"][:7]
+    if row["mtime"] is not None:
+        return datetime.fromtimestamp(row["mtime"]).strftime("%Y-%m")
+    return None
+
+
+def first_active_month(keep_months, today=None):
+    """"YYYY-MM" del mes activo más antiguo: los anteriores son meses cerrados a compactar."""
+    today = today or datetime.now()
+    index = today.year * 12 + today.month - 1 - (max(keep_months, 1) - 1)
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def _write_month_archive(path, files):
+    """
+    Agrega files ({nombre: ruta}) al zip del mes, reemplazando miembros con el mismo nombre.
+    Se escribe en un temporal oculto y se verifica antes del os.replace: un corte nunca
+    deja un zip a medias con el nombre final.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    folder, name = os.path.split(path)
+    tmp_path = os.path.join(folder, f".{name}.tmp")
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as out:
+        if os.path.exists(path):
+            with zipfile.ZipFile(path) as previous:
+                for info in previous.infolist():
+                    if info.filename not in files:
+                        out.writestr(info, previous.read(info))
+        for member, source in sorted(files.items()):
+            out.write(source, arcname=member)
+    with zipfile.ZipFile(tmp_path) as check:
+        broken = check.testzip()
+    if broken is not None:
+        os.remove(tmp_path)
+        raise zipfile.BadZipFile(f"{path}: {broken} quedó dañado al compactar")
+    os.replace(tmp_path, path)
+
+
+def compact(root_dir, keep_months=ARCHIVE_KEEP_MONTHS, scheme_names=None, uploaded_only=False,
+            dry_run=False, today=None, callback_log=None):
+    """
+    Compacta los meses cerrados de cada esquema de root_dir.
+    uploaded_only: solo libros ya subidos a Drive (manifiesto con marca de subida).
+    Retorna: {"libros": n, "meses": n, "bytes": tamaño de los libros compactados}
+    """
+    def log(msg):
+        if callback_log: callback_log(msg)
+
+    cutoff = first_active_month(keep_months, today)
+    summary = {"libros": 0, "meses": 0, "bytes": 0}
+    for scheme_name in scheme_names or download_xm_file.ESQUEMAS.keys():
+        folder = os.path.join(root_dir, scheme_name)
+        if not os.path.isdir(folder):
+            continue
+        index = download_xm_file._file_index(folder)
+        index.names(refresh=True)  # Reconcilia el manifiesto con la carpeta
+        months = {}
+        for row in index.manifest.rows(index.carpeta):
+            month = _month_of(row)
+            if row["archivo"] or month is None or month >= cutoff:
+                continue
+            if uploaded_only and not row["subido"]:
+                continue
+            path = os.path.join(folder, row["nombre"])
+            if os.path.isfile(path):
+                months.setdefault(month, {})[row["nombre"]] = path
+        for month, files in sorted(months.items()):
+            size = sum(os.path.getsize(path) for path in files.values())
+            target = archive_path(root_dir, scheme_name, month)
+            log(f"[ARCHIVO] {scheme_name} {month}: {len(files)} libros ({size / 1e6:.1f} MB) -> "
+                f"{os.path.relpath(target, root_dir)}{' (simulado)' if dry_run else ''}")
+            summary["libros"] += len(files)
+            summary["meses"] += 1
+            summary["bytes"] += size
+            if dry_run:
+                continue
+            _write_month_archive(target, files)
+            # Primero el manifiesto y después el borrado: si se corta en medio, los libros
+            # siguen sueltos y la próxima sincronización los vuelve a dar por sueltos
+            index.manifest.mark_archived(index.carpeta, list(files), os.path.relpath(target, root_dir))
+            for path in files.values():
+                os.remove(path)
+    return summary
+
+
+def expire(root_dir, retain_months, scheme_names=None, dry_run=False, today=None, callback_log=None):
+    """
+    Borra los zips de los meses anteriores a los últimos retain_months (el actual incluido)
+    cuyos libros ya están todos subidos a Drive. Sus filas quedan en el manifiesto con
+    archivo = EXPIRED_ARCHIVE: siguen contando como descargados.
+    Retorna: {"meses": n, "libros": n, "bytes": tamaño de los zips borrados}
+    """
+    def log(msg):
+        if callback_log: callback_log(msg)
+
+    cutoff = first_active_month(retain_months, today)
+    summary = {"meses": 0, "libros": 0, "bytes": 0}
+    for scheme_name in scheme_names or download_xm_file.ESQUEMAS.keys():
+        folder = os.path.join(root_dir, ARCHIVE_DIRNAME, scheme_name)
+        if not os.path.isdir(folder):
+            continue
+        index = download_xm_file._file_index(os.path.join(root_dir, scheme_name))
+        rows = index.manifest.rows(index.carpeta)
+        for name in sorted(os.listdir(folder)):
+            month, ext = os.path.splitext(name)
+            if ext != ".zip" or month >= cutoff:
+                continue
+            path = os.path.join(folder, name)
+            relative = os.path.relpath(path, root_dir)
+            members = [row for row in rows if row["archivo"] == relative]
+            pending = [row["nombre"] for row in members if not row["subido"]]
+            if pending:
+                log(f"[ARCHIVO] {scheme_name} {month}: {len(pending)} libros sin subir a Drive, se conserva.")
+                continue
+            size = os.path.getsize(path)
+            log(f"[ARCHIVO] {scheme_name} {month}: {len(members)} libros ({size / 1e6:.1f} MB) solo en Drive"
+                f"{' (simulado)' if dry_run else ''}")
+            summary["meses"] += 1
+            summary["libros"] += len(members)
+            summary["bytes"] += size
+            if dry_run:
+                continue
+            # Primero el manifiesto: si se corta en medio, el zip sigue ahí y nada se pierde
+            index.manifest.mark_archived(index.carpeta, [row["nombre"] for row in members], EXPIRED_ARCHIVE)
+            os.remove(path)
+    return summary
+
+
+def extract(root_dir, scheme_name, month, callback_log=None):
+    """Devuelve a su carpeta los libros de un mes compactado y borra el zip. Retorna cuántos."""
+    path = archive_path(root_dir, scheme_name, month)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No hay archivo compactado para {scheme_name} {month}: {path}")
+    folder = os.path.join(root_dir, scheme_name)
+    index = download_xm_file._file_index(folder)
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+        for name in names:
+            dest = os.path.join(folder, name)
+            tmp_path = download_xm_file._partial_path(dest)
+            with open(tmp_path, 'wb') as f:
+                f.write(archive.read(name))
+            os.replace(tmp_path, dest)
+            row = index.manifest.get(index.carpeta, name)
+            if row and row["mtime"]:
+                os.utime(dest, (time.time(), row["mtime"]))
+    # La sincronización ve los libros sueltos otra vez y les quita la marca de compactados
+    index.names(refresh=True)
+    os.remove(path)
+    if callback_log:
+        callback_log(f"[ARCHIVO] {scheme_name} {month}: {len(names)} libros restaurados en {folder}")
+    return len(names)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compacta los meses cerrados del archivo de garantías XM.")
+    parser.add_argument("--root", default=os.path.join(current_dir, "Garantías"))
+    parser.add_argument("--schemes", nargs="+", default=list(download_xm_file.ESQUEMAS.keys()),
+                        choices=list(download_xm_file.ESQUEMAS.keys()))
+    parser.add_argument("--keep-months", type=int, default=ARCHIVE_KEEP_MONTHS,
+                        help="Meses que quedan sueltos, el actual incluido.")
+    parser.add_argument("--uploaded-only", action="store_true",
+                        help="Compactar solo libros ya subidos a Drive por upload_drive.")
+    parser.add_argument("--expire-months", type=int, default=None,
+                        help="Borrar del disco los meses compactados anteriores a los últimos N (ya subidos a Drive).")
+    parser.add_argument("--dry-run", action="store_true", help="Solo informar qué se compactaría.")
+    parser.add_argument("--extract", nargs=2, metavar=("ESQUEMA", "YYYY-MM"), default=None,
+                        help="Restaurar un mes compactado a su carpeta.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    log_func = lambda msg: print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
+    if args.extract:
+        extract(args.root, args.extract[0], args.extract[1], callback_log=log_func)
+        return 0
+    print(f"=== COMPACTACIÓN: meses anteriores a {first_active_month(args.keep_months)} ===")
+    print(f"Carpeta: {args.root}")
+    summary = compact(args.root, keep_months=args.keep_months, scheme_names=args.schemes,
+                      uploaded_only=args.uploaded_only, dry_run=args.dry_run, callback_log=log_func)
+    print(f"Libros compactados: {summary['libros']} en {summary['meses']} meses "
+          f"({summary['bytes'] / 1e6:.1f} MB sueltos menos)")
+    if args.expire_months:
+        if args.expire_months <= args.keep_months:
+            print(f"[ERROR] --expire-months ({args.expire_months}) debe ser mayor que --keep-months ({args.keep_months}).")
+            return 2
+        summary = expire(args.root, args.expire_months, scheme_names=args.schemes, dry_run=args.dry_run,
+                         callback_log=log_func)
+        print(f"Meses retirados del disco: {summary['meses']} ({summary['libros']} libros, "
+              f"{summary['bytes'] / 1e6:.1f} MB liberados)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
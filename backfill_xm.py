@@ -0,0 +1,284 @@
+"""
+Backfill histórico: reconstruye el archivo de Garantías para un rango largo (meses o años).
+
+A diferencia de run_daily, no arma el plan completo en memoria: las escaleras se generan
+día por día a medida que la cola las pide (como máximo unas pocas por worker pendientes),
+así la memoria no crece con el largo del rango. Cada (esquema, fecha) terminado se anota
+en <root>/.xm_backfill.json; al relanzar, los días ya completos se saltan.
+
+Uso:
+    python backfill_xm.py 2025-01-01 2025-12-31
+    python backfill_xm.py 2025-01-01 2025-12-31 --schemes TIE Cuentas --engine asyncio
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+import download_xm_file
+from download_xm_file import (MissCache, ProbePlan, AdaptiveConcurrency, CircuitBreaker, PatternLog, RunCoordinator,
+                              PostProcessQueue)
+
+BACKFILL_CHECKPOINT_FILENAME = ".xm_backfill.json"  # Oculto: upload_drive no lo sube
+BACKFILL_LOOKAHEAD_PER_WORKER = 4   # Escaleras pendientes por worker en la cola
+BACKFILL_SAVE_EVERY = 30.0          # Segundos entre guardados del checkpoint
+
+
+def checkpoint_path(root_dir, shard=None):
+    """Cada shard lleva su propio checkpoint: sus días completos no son los de los demás."""
+    if shard:
+        stem, ext = os.path.splitext(BACKFILL_CHECKPOINT_FILENAME)
+        return os.path.join(root_dir, f"{stem}.shard-{shard[0]}-de-{shard[1]}{ext}")
+    return os.path.join(root_dir, BACKFILL_CHECKPOINT_FILENAME)
+
+
+class BackfillCheckpoint:
+    """
+    Días ya completos por esquema: {esquema: {"YYYY-MM-DD": archivos_encontrados}}.
+    Se guarda de forma atómica (archivo .tmp + os.replace), como MissCache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.done = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Advertencia: checkpoint de backfill ilegible ({e}). Se empieza de cero.")
+                self.done = {}
+
+    @classmethod
+    def for_root(cls, root_dir, shard=None):
+        return cls(checkpoint_path(root_dir, shard))
+
+    def is_done(self, scheme_name, day):
+        return day.strftime("%Y-%m-%d") in self.done.get(scheme_name, {})
+
+    def mark(self, scheme_name, day, found):
+        self.done.setdefault(scheme_name, {})[day.strftime("%Y-%m-%d")] = found
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.done, f, indent=0, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Advertencia: no se pudo guardar el checkpoint de backfill: {e}")
+
+
+class _BackfillTracker:
+    """
+    Genera las escaleras día por día y detecta cuándo un (esquema, fecha) terminó:
+    todas sus escaleras generadas y cerradas (acierto, agotada) -> se anota en el checkpoint.
+    Un día con algún sondeo sin respuesta definitiva (error de red, timeout, circuito
+    abierto) no se anota: solo un 404 (o equivalente) prueba que el archivo no existe.
+    """
+
+    def __init__(self, plan, scheme_names, checkpoint, miss_cache, breaker=None, callback_log=None, on_file=None):
+        self.plan = plan
+        self.on_file = on_file
+        self.breaker = breaker
+        self.scheme_names = scheme_names
+        self.checkpoint = checkpoint
+        self.miss_cache = miss_cache
+        self.patterns = PatternLog.for_root(plan.root_dir)
+        self.callback_log = callback_log
+        self._open = {}       # (esquema, "YYYY-MM-DD") -> escaleras sin cerrar
+        self._found = {}      # (esquema, "YYYY-MM-DD") -> aciertos
+        self._unanswered = {} # (esquema, "YYYY-MM-DD") -> sondeos fallidos sin respuesta definitiva
+        self._generated = set()
+        self._last_save = time.time()
+        self.skipped_days = 0
+        self.completed_days = 0
+        self.incomplete_days = 0
+        self.found = 0
+
+    def log(self, msg):
+        if self.callback_log: self.callback_log(msg)
+
+    def iter_ladders(self):
+        day = self.plan.start_date
+        while day <= self.plan.end_date:
+            for scheme_name in self.scheme_names:
+                if self.checkpoint.is_done(scheme_name, day):
+                    self.skipped_days += 1
+                    continue
+                key = (scheme_name, day.strftime("%Y-%m-%d"))
+                ladders = self.plan.day_ladders(scheme_name, day)
+                self._open[key] = len(ladders)
+                self._found[key] = 0
+                self._unanswered[key] = 0
+                for ladder in ladders:
+                    yield ladder
+                self._generated.add(key)
+                self._maybe_complete(key, day)
+            day += timedelta(days=1)
+
+    def on_result(self, task, success, msg):
+        if success:
+            self._found[(task[3], task[4].strftime("%Y-%m-%d"))] += 1
+            self.found += 1
+            if msg and "Ya en disco" not in msg:
+                self.log(msg)
+                new_pattern = self.patterns.record(task[3], task[1])
+                if new_pattern:
+                    self.log(f"[PATRÓN] {task[3]}: primer acierto con {new_pattern} ({task[1]})")
+            if self.on_file: self.on_file(task, msg)
+        elif msg:
+            # (False, None) es un 404 o equivalente; cualquier otro fallo deja el día abierto
+            self._unanswered[(task[3], task[4].strftime("%Y-%m-%d"))] += 1
+            if "[ERROR]" in msg or "[EXCEPTION]" in msg:
+                self.log(msg)
+
+    def on_ladder_done(self, task):
+        key = (task[3], task[4].strftime("%Y-%m-%d"))
+        self._open[key] -= 1
+        self._maybe_complete(key, task[4])
+
+    def _maybe_complete(self, key, day):
+        if self._open.get(key) != 0 or key not in self._generated:
+            return
+        found, unanswered = self._found.pop(key), self._unanswered.pop(key)
+        del self._open[key]
+        self._generated.discard(key)
+        if unanswered or (self.breaker is not None and self.breaker.gave_up):
+            self.incomplete_days += 1  # Sus tareas pudieron fallar sin red: queda para la próxima ejecución
+            return
+        self.checkpoint.mark(key[0], day, found)
+        self.completed_days += 1
+        if time.time() - self._last_save >= BACKFILL_SAVE_EVERY:
+            self.save()
+            self.log(f"[BACKFILL] Checkpoint: {self.completed_days} días-esquema completos, "
+                     f"{self.found} archivos (último: {key[0]} {key[1]}).")
+
+    def save(self):
+        self.checkpoint.save()
+        self.miss_cache.save()
+        self.patterns.save()
+        self._last_save = time.time()
+
+
+def backfill(start_date, end_date, scheme_names, root_dir, max_workers=40, engine="threads",
+             callback_log=None, controller=None, breaker=None, deadline=None, shard=None, on_file=None):
+    """
+    Descarga el rango [start_date, end_date] día por día con checkpoint por (esquema, fecha).
+    Sin calendario de publicación (min_score=0): el objetivo es completar el archivo.
+    shard / on_file: ver download_xm_file.download_schemes_range.
+    Retorna: (archivos_encontrados, días-esquema completados, días-esquema saltados)
+    """
+    miss_cache = MissCache.for_root(root_dir)
+    checkpoint = BackfillCheckpoint.for_root(root_dir, shard)
+    if breaker is None:
+        breaker = CircuitBreaker(callback_log=callback_log)
+    scheme_names = [name for name in scheme_names if download_xm_file._prepare_scheme_folder(root_dir, name, callback_log)]
+
+    plan = ProbePlan(start_date, end_date, scheme_names, root_dir, miss_cache=miss_cache, shard=shard)
+    tracker = _BackfillTracker(plan, scheme_names, checkpoint, miss_cache, breaker, callback_log, on_file)
+    limit = controller.maximum if controller else max_workers
+    lookahead = max(limit * BACKFILL_LOOKAHEAD_PER_WORKER, 1)
+
+    # Arriendo sobre la raíz: un run_daily o la GUI en paralelo no repiten estos sondeos
+    coordinator = RunCoordinator(root_dir, callback_log, defer=True)
+    coordinator.acquire()
+    # Limpieza TIE en la etapa de CPU, fuera de los hilos / corrutinas de descarga
+    post_processor = PostProcessQueue(callback_log)
+    try:
+        for scheme_name in scheme_names:
+            post_processor.resume(plan.scheme_folder(scheme_name), scheme_name)
+        if engine == "asyncio":
+            import asyncio
+            import download_xm_async
+            ssl_context = download_xm_file.make_xm_ssl_context()
+            worker = lambda *task: download_xm_async._download_worker_async(
+                *task, ssl_context=ssl_context, miss_cache=miss_cache, controller=controller, breaker=breaker,
+                coordinator=coordinator, post_processor=post_processor)
+            asyncio.run(download_xm_async._run_probe_ladders_async(
+                tracker.iter_ladders(), worker, max_workers, tracker.on_result, controller=controller,
+                on_ladder_done=tracker.on_ladder_done, breaker=breaker, deadline=deadline, lookahead=lookahead))
+        else:
+            worker = lambda *task: download_xm_file._download_worker_wrapper(
+                *task, miss_cache=miss_cache, controller=controller, breaker=breaker, coordinator=coordinator,
+                post_processor=post_processor)
+            download_xm_file._run_probe_ladders(
+                tracker.iter_ladders(), worker, max_workers, tracker.on_result, controller=controller,
+                on_ladder_done=tracker.on_ladder_done, breaker=breaker, deadline=deadline, lookahead=lookahead)
+    finally:
+        # También ante Ctrl+C o excepción: lo completado hasta aquí no se repite
+        post_processor.__exit__(None, None, None)
+        tracker.save()
+        coordinator.release()
+    if tracker.incomplete_days and callback_log:
+        callback_log(f"[BACKFILL] {tracker.incomplete_days} días-esquema con sondeos sin respuesta "
+                     f"(red, timeout o circuito abierto): quedan para la próxima ejecución.")
+    return tracker.found, tracker.completed_days, tracker.skipped_days
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill histórico de garantías XM con checkpoint.")
+    parser.add_argument("start", help="Fecha inicial YYYY-MM-DD")
+    parser.add_argument("end", help="Fecha final YYYY-MM-DD (incluida)")
+    parser.add_argument("--schemes", nargs="+", default=list(download_xm_file.ESQUEMAS.keys()),
+                        choices=list(download_xm_file.ESQUEMAS.keys()))
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default=os.environ.get("XM_ENGINE", "threads"))
+    parser.add_argument("--workers", type=int, default=40, help="Sondeos simultáneos iniciales.")
+    parser.add_argument("--root", default=os.path.join(current_dir, "Garantías"))
+    parser.add_argument("--deadline", type=float, default=None,
+                        help="Minutos máximos; lo pendiente queda para la próxima ejecución.")
+    parser.add_argument("--reset", action="store_true", help="Ignorar el checkpoint existente.")
+    parser.add_argument("--shard", type=download_xm_file.parse_shard, default=None,
+                        help="i/N: recorrer solo la parte i de N (ver shards_xm.py merge).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    start_date = datetime.strptime(args.start, "%Y-%m-%d")
+    end_date = datetime.strptime(args.end, "%Y-%m-%d")
+    log_func = lambda msg: print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
+
+    if args.reset:
+        path = checkpoint_path(args.root, args.shard)
+        if os.path.exists(path):
+            os.remove(path)
+
+    cap = 600 if args.engine == "asyncio" else 120
+    controller = AdaptiveConcurrency(initial=args.workers, maximum=max(cap, args.workers), callback_log=log_func)
+    deadline = time.time() + args.deadline * 60 if args.deadline else None
+
+    print(f"=== BACKFILL: {args.start} a {args.end} ({', '.join(args.schemes)}) ===")
+    print(f"Carpeta: {args.root}")
+    manifest = None
+    if args.shard:
+        import shards_xm
+        manifest = shards_xm.ShardManifest(args.root, args.shard, start_date, end_date)
+        print(f"Shard: {args.shard[0]}/{args.shard[1]}")
+    started = time.time()
+    try:
+        found, completed, skipped = backfill(start_date, end_date, args.schemes, args.root,
+                                             max_workers=args.workers, engine=args.engine, callback_log=log_func,
+                                             controller=controller, deadline=deadline, shard=args.shard,
+                                             on_file=manifest.add if manifest else None)
+    finally:
+        if manifest:
+            manifest.save()
+    total = ((end_date - start_date).days + 1) * len(args.schemes)
+    print(f"\n=== BACKFILL TERMINADO ===")
+    print(f"Archivos encontrados: {found}")
+    print(f"Días-esquema: {completed} completados ahora, {skipped} ya hechos antes, "
+          f"{max(total - completed - skipped, 0)} pendientes")
+    print(f"Tiempo total: {time.time() - started:.2f} segundos")
+    print(controller.summary())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,631 @@
+"""
+Motor de descarga asyncio, alternativo al ThreadPoolExecutor de download_xm_file.
+
+El API nuevo de XM tarda ~6s en contestar cada 404/500. Con hilos, cada sondeo bloquea
+un hilo del sistema; aquí cada sondeo es una corrutina, así que se pueden mantener
+cientos en vuelo con un solo hilo (útil en el runner pequeño de GitHub Actions).
+
+Mismas entradas, salidas y mensajes de callback_log que
+download_xm_file.download_scheme_range. Usa el mismo planificador de escaleras,
+la misma caché de fallos y el mismo requisito de TLS 1.3.
+
+El event loop solo espera a la red: lo que toca disco (manifiesto SQLite, almacén
+compartido con su sha256, reclamos de coordinación, el .part de cada descarga) corre en
+hilos con asyncio.to_thread. El cuerpo se junta en memoria y se escribe en bloques de
+WRITE_BUFFER_BYTES, así una escritura lenta (ej: la unidad de Drive) no frena a las
+demás conexiones.
+Las conexiones se reutilizan (keep-alive) como en el pool de urllib3 del motor de hilos:
+un handshake TLS 1.3 por conexión, no por sondeo.
+"""
+import asyncio
+import os
+import ssl
+import time
+import weakref
+from urllib.parse import urlsplit
+
+import download_xm_file
+from download_xm_file import MissCache, ProbePlan, PublicationCalendar
+
+REQUEST_TIMEOUT = 15  # Igual que download_file
+CHUNK_SIZE = 8192
+POOL_MAX_IDLE = 50         # Conexiones libres por host (como maxsize del pool de urllib3)
+SKIP_BODY_LIMIT = 64 * 1024  # Cuerpos de 404/500 más grandes: se cierra en vez de leerlos
+WRITE_BUFFER_BYTES = 256 * 1024  # Bytes del cuerpo acumulados antes de cada escritura (en un hilo)
+
+
+class _ConnectionPool:
+    """Conexiones keep-alive libres por host, de un event loop."""
+
+    def __init__(self, max_idle=POOL_MAX_IDLE):
+        self.max_idle = max_idle
+        self._idle = {}   # (host, port) -> [(reader, writer)]
+        self._hosts = {}  # writer en uso -> (host, port)
+
+    def get(self, key):
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                self._hosts[writer] = key
+                return reader, writer
+            writer.close()
+        return None
+
+    def track(self, key, writer):
+        self._hosts[writer] = key
+
+    def put(self, reader, writer):
+        """Devuelve una conexión con la respuesta leída completa. False si no se pudo guardar."""
+        key = self._hosts.pop(writer, None)
+        if key is None or writer.is_closing():
+            return False
+        idle = self._idle.setdefault(key, [])
+        if len(idle) >= self.max_idle:
+            return False
+        idle.append((reader, writer))
+        return True
+
+    def forget(self, writer):
+        self._hosts.pop(writer, None)
+
+    async def close(self):
+        idle = [writer for connections in self._idle.values() for _, writer in connections]
+        self._idle = {}
+        for writer in idle:
+            await _close(writer)
+
+
+_pools = weakref.WeakKeyDictionary()  # event loop -> _ConnectionPool
+
+def _connections():
+    """Pool del event loop en curso (las conexiones no sirven en otro loop)."""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = _ConnectionPool()
+    return pool
+
+
+async def _open_request(url, ssl_context, timeout=REQUEST_TIMEOUT, extra_headers=None):
+    """
+    Envía un GET HTTP/1.1 mínimo sobre TLS y lee la cabecera de la respuesta. Usa una
+    conexión libre del pool si hay; si el servidor ya la había cerrado, abre otra.
+    extra_headers: cabeceras adicionales (ej: Range para reanudar).
+    Retorna: (status, headers, reader, writer). Los nombres de cabecera van en minúsculas.
+    Al terminar con la respuesta, _release(...) devuelve la conexión al pool.
+    """
+    parts = urlsplit(url)
+    host = parts.hostname
+    port = parts.port or 443
+    target = parts.path + (f"?{parts.query}" if parts.query else "")
+    pool = _connections()
+
+    pooled = pool.get((host, port))
+    if pooled is not None:
+        try:
+            return await _send_request(*pooled, host, target, timeout, extra_headers)
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass  # Cerrada por el servidor mientras estaba libre: se reintenta en una nueva
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port, ssl=ssl_context, server_hostname=host), timeout)
+    pool.track((host, port), writer)
+    return await _send_request(reader, writer, host, target, timeout, extra_headers)
+
+
+async def _send_request(reader, writer, host, target, timeout, extra_headers):
+    try:
+        request = (
+            f"GET {target} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            f"User-Agent: {download_xm_file.XM_USER_AGENT}\r\n"
+            "Accept: */*\r\n"
+            "Accept-Encoding: identity\r\n"
+            + "".join(f"{name}: {value}\r\n" for name, value in (extra_headers or {}).items())
+            + "Connection: keep-alive\r\n\r\n"
+        )
+        writer.write(request.encode('ascii'))
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        parts_status = status_line.decode('latin-1').split(None, 2)
+        if len(parts_status) < 2 or not parts_status[1].isdigit():
+            raise ConnectionError(f"Respuesta HTTP inválida: {status_line[:80]!r}")
+        status = int(parts_status[1])
+
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return status, headers, reader, writer
+    except BaseException:
+        await _close(writer)
+        raise
+
+
+async def _iter_body(reader, headers, timeout=REQUEST_TIMEOUT):
+    """Itera el cuerpo de la respuesta en bloques (chunked, Content-Length o hasta EOF)."""
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        while True:
+            size_line = await asyncio.wait_for(reader.readline(), timeout)
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                # Consumir trailers hasta la línea vacía
+                while (await asyncio.wait_for(reader.readline(), timeout)) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            yield await asyncio.wait_for(reader.readexactly(size), timeout)
+            await asyncio.wait_for(reader.readexactly(2), timeout)  # CRLF del chunk
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            chunk = await asyncio.wait_for(reader.read(min(CHUNK_SIZE, remaining)), timeout)
+            if not chunk:
+                raise ConnectionError(f"Conexión cerrada con {remaining} bytes pendientes")
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = await asyncio.wait_for(reader.read(CHUNK_SIZE), timeout)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def _skip_body(reader, headers):
+    """Lee y descarta un cuerpo corto (ej: el de un 404). False si no se pudo dejar la conexión limpia."""
+    if "chunked" not in headers.get("transfer-encoding", "").lower():
+        length = headers.get("content-length")
+        if length is None or not length.isdigit() or int(length) > SKIP_BODY_LIMIT:
+            return False  # Cuerpo hasta el cierre, o demasiado largo para leerlo de gusto
+    skipped = 0
+    async for chunk in _iter_body(reader, headers):
+        skipped += len(chunk)
+        if skipped > SKIP_BODY_LIMIT:
+            return False
+    return True
+
+
+async def _release(reader, writer, headers, reusable, body_read=False):
+    """
+    Termina con una respuesta: la conexión vuelve al pool si quedó lista para otro request
+    (sin errores, cuerpo leído completo y sin "Connection: close"); si no, se cierra.
+    """
+    if reusable and headers.get("connection", "").lower() != "close":
+        try:
+            if body_read or await _skip_body(reader, headers):
+                if _connections().put(reader, writer):
+                    return
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+    await _close(writer)
+
+
+async def _close(writer):
+    _connections().forget(writer)
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (OSError, asyncio.CancelledError, ConnectionError):
+        pass  # El servidor XM suele cortar TLS sin close_notify
+
+
+async def _write_body(reader, headers, path, mode, sniffer):
+    """
+    Escribe el cuerpo de la respuesta en path (pasando por sniffer). Los bloques se juntan
+    en memoria y cada escritura, como abrir y cerrar el archivo, corre en un hilo.
+    """
+    f = await asyncio.to_thread(open, path, mode)
+    try:
+        buffer, size = [], 0
+        async for chunk in _iter_body(reader, headers):
+            data = sniffer.feed(chunk)
+            buffer.append(data)
+            size += len(data)
+            if size >= WRITE_BUFFER_BYTES:
+                await asyncio.to_thread(f.write, b"".join(buffer))
+                buffer, size = [], 0
+        if buffer:
+            await asyncio.to_thread(f.write, b"".join(buffer))
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+def _partial_size(part_path):
+    return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+
+async def download_file_async(url, filename, save_dir, ssl_context, miss_cache=None, file_date=None, controller=None, revalidate=False, breaker=None, coordinator=None):
+    """
+    Equivalente asyncio de download_file. Retorna True si el archivo quedó en disco.
+    Usa el mismo .part reanudable y el mismo índice de tamaños que download_file.
+    """
+    status = await _download_status_async(url, filename, save_dir, ssl_context, miss_cache=miss_cache,
+                                          file_date=file_date, controller=controller, revalidate=revalidate,
+                                          breaker=breaker, coordinator=coordinator)
+    return status is not None
+
+
+async def _download_status_async(url, filename, save_dir, ssl_context, miss_cache=None, file_date=None, controller=None, revalidate=False, breaker=None, coordinator=None):
+    """Equivalente asyncio de download_xm_file._download_status."""
+    status = await _probe_status_async(url, filename, save_dir, ssl_context, miss_cache=miss_cache,
+                                       file_date=file_date, controller=controller, revalidate=revalidate,
+                                       breaker=breaker, coordinator=coordinator)
+    return None if status == download_xm_file._MISSED else status
+
+
+async def _probe_status_async(url, filename, save_dir, ssl_context, miss_cache=None, file_date=None, controller=None, revalidate=False, breaker=None, coordinator=None):
+    """Equivalente asyncio de download_xm_file._probe_status (_MISSED: no existe; None: sin respuesta)."""
+    await asyncio.to_thread(os.makedirs, save_dir, exist_ok=True)
+
+    save_path = os.path.join(save_dir, filename)
+    part_path = download_xm_file._partial_path(save_path)
+
+    # Si el archivo ya existe completo (de una ejecución anterior o caché), no re-descargar.
+    # Manifiesto (SQLite) y almacén (enlaces o copias) tocan disco: fuera del event loop
+    if await asyncio.to_thread(download_xm_file._is_cached, save_path):
+        if not revalidate:
+            return download_xm_file.STATUS_CACHED
+        return await _revalidate_async(url, save_path, part_path, ssl_context, controller, breaker)
+
+    if await asyncio.to_thread(download_xm_file._link_from_store, url, save_path):
+        return download_xm_file.STATUS_LINKED
+
+    if miss_cache is not None and miss_cache.is_miss(url):
+        return download_xm_file._MISSED
+    if coordinator is None:
+        return await _fetch_status_async(url, filename, save_path, part_path, ssl_context, miss_cache,
+                                         file_date, controller, breaker)
+    shared = await _claim_async(coordinator, url)
+    if shared != download_xm_file.CLAIM_OWN:
+        return download_xm_file.STATUS_CACHED if shared == download_xm_file.CLAIM_FOUND else download_xm_file._MISSED
+    status = None
+    try:
+        status = await _fetch_status_async(url, filename, save_path, part_path, ssl_context, miss_cache,
+                                           file_date, controller, breaker)
+    finally:
+        await asyncio.to_thread(coordinator.finish, url, download_xm_file._claim_state(status))
+    return status
+
+
+async def _claim_async(coordinator, url):
+    """Equivalente asyncio de RunCoordinator.claim: espera sin bloquear el event loop."""
+    while True:
+        state = await asyncio.to_thread(coordinator.try_claim, url)
+        if state is not None:
+            if state != download_xm_file.CLAIM_OWN:
+                coordinator._count("shared")
+            return state
+        await asyncio.sleep(download_xm_file.CLAIM_POLL_SECONDS)
+        if coordinator.defer:
+            raise download_xm_file.ClaimPending(url)
+
+
+async def _fetch_status_async(url, filename, save_path, part_path, ssl_context, miss_cache, file_date, controller, breaker):
+    """Equivalente asyncio de download_xm_file._fetch_status."""
+    # Dos intentos: si el servidor rechaza el Range (416) se repite desde cero
+    for _ in range(2):
+        if breaker is not None and not breaker.allow():
+            return None  # Circuito abierto: falla al instante, sin registrar en la caché de fallos
+        offset = await asyncio.to_thread(_partial_size, part_path)
+        writer = None
+        reusable, body_read = True, False
+        started = time.time()
+        try:
+            status, headers, reader, writer = await _open_request(
+                url, ssl_context, extra_headers={"Range": f"bytes={offset}-"} if offset else None)
+            if breaker is not None:
+                breaker.record_success()
+            if controller is not None:
+                healthy = status in (200, 206, 404, 416, 500)
+                controller.record(time.time() - started, None if healthy else f"HTTP {status}")
+            if status == 416:
+                total = download_xm_file._parse_content_range(headers.get("content-range", ""))[1]
+                if total == offset and await asyncio.to_thread(
+                        download_xm_file._finish_partial, part_path, save_path, total, url):
+                    print(f"¡Éxito! Guardado en: {save_path}")
+                    return download_xm_file.STATUS_DOWNLOADED
+                await asyncio.to_thread(download_xm_file._discard_partial, part_path)
+                continue
+            if status in (200, 206):
+                # 206 continúa el .part; 200 (Range ignorado o sin .part) lo reescribe
+                resumed = status == 206 and download_xm_file._parse_content_range(headers.get("content-range", ""))[0] == offset
+                if status == 206 and not resumed:
+                    await asyncio.to_thread(download_xm_file._discard_partial, part_path)
+                    continue
+                expected = download_xm_file._expected_length(status, headers)
+                head = await asyncio.to_thread(download_xm_file._read_head, part_path) if resumed else b""
+                sniffer = download_xm_file._WorkbookSniffer(filename, head)
+                await _write_body(reader, headers, part_path, 'ab' if resumed else 'wb', sniffer)
+                body_read = True
+                sniffer.finish()
+                # sha256 y copia al almacén compartido: en un hilo
+                if not await asyncio.to_thread(download_xm_file._finish_partial, part_path, save_path,
+                                               expected, url, headers):
+                    return None
+                print(f"¡Éxito! Guardado en: {save_path}" + (f" (reanudado desde {offset} bytes)" if resumed else ""))
+                return download_xm_file.STATUS_DOWNLOADED
+            # 404 = archivo no existe (normal en brute-force)
+            # 500 = el nuevo API devuelve 500 cuando el blob no existe (en vez de 404)
+            if status not in (404, 500):
+                print(f"[HTTP {status}] {filename}")
+            else:
+                if miss_cache is not None:
+                    miss_cache.record(url, file_date)
+                await asyncio.to_thread(download_xm_file._discard_partial, part_path)
+                return download_xm_file._MISSED
+            return None
+        except download_xm_file.NotAWorkbookError as e:
+            reusable = False  # Cuerpo leído a medias
+            await asyncio.to_thread(download_xm_file._reject_content, e, url, part_path, miss_cache, file_date)
+            return download_xm_file._MISSED
+        except Exception as e:
+            reusable = False
+            # El .part se conserva: la próxima ejecución lo continúa con Range
+            reason = _classify_async_error(e)
+            if breaker is None or not breaker.is_open:
+                print(f"Error general en {filename}: {e!r}")  # Con el circuito abierto ya se informó el corte
+            if controller is not None:
+                controller.record(time.time() - started, reason)
+            if breaker is not None:
+                breaker.record_failure(reason)
+            return None
+        finally:
+            if writer is not None:
+                await _release(reader, writer, headers, reusable, body_read)
+    return None
+
+
+async def _revalidate_async(url, save_path, part_path, ssl_context, controller=None, breaker=None):
+    """Equivalente asyncio de download_xm_file._revalidate."""
+    url, conditional = await asyncio.to_thread(download_xm_file._conditional_request, save_path, url)
+    if url is None:
+        return download_xm_file.STATUS_CACHED  # Descargado antes de guardar validadores
+    if breaker is not None and not breaker.allow():
+        return download_xm_file.STATUS_CACHED
+    writer = None
+    reusable, body_read = True, False
+    started = time.time()
+    try:
+        status, headers, reader, writer = await _open_request(url, ssl_context, extra_headers=conditional)
+        if breaker is not None:
+            breaker.record_success()
+        if controller is not None:
+            healthy = status in (200, 304, 404, 500)
+            controller.record(time.time() - started, None if healthy else f"HTTP {status}")
+        if status != 200:
+            return download_xm_file.STATUS_CACHED
+        sniffer = download_xm_file._WorkbookSniffer(os.path.basename(save_path))
+        await _write_body(reader, headers, part_path, 'wb', sniffer)
+        body_read = True
+        sniffer.finish()
+        if not await asyncio.to_thread(download_xm_file._finish_partial, part_path, save_path,
+                                       download_xm_file._expected_length(200, headers), url, headers):
+            await asyncio.to_thread(download_xm_file._discard_partial, part_path)  # Sin Range en revalidación
+            return download_xm_file.STATUS_CACHED
+        print(f"¡Actualizado! Nueva versión en: {save_path}")
+        return download_xm_file.STATUS_UPDATED
+    except download_xm_file.NotAWorkbookError as e:
+        reusable = False
+        # Se conserva la versión en disco, que sí es un libro
+        print(f"[RECHAZADO] {e}")
+        await asyncio.to_thread(download_xm_file._discard_partial, part_path)
+        return download_xm_file.STATUS_CACHED
+    except Exception as e:
+        reusable = False
+        reason = _classify_async_error(e)
+        if breaker is None or not breaker.is_open:
+            print(f"Error revalidando {os.path.basename(save_path)}: {e!r}")
+        if controller is not None:
+            controller.record(time.time() - started, reason)
+        if breaker is not None:
+            breaker.record_failure(reason)
+        await asyncio.to_thread(download_xm_file._discard_partial, part_path)
+        return download_xm_file.STATUS_CACHED
+    finally:
+        if writer is not None:
+            await _release(reader, writer, headers, reusable, body_read)
+
+
+def _classify_async_error(exc):
+    """Como download_xm_file._classify_request_error, para excepciones de asyncio/ssl."""
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError)):
+        return "timeout"
+    if isinstance(exc, (ssl.SSLError, asyncio.IncompleteReadError)) or "EOF" in str(exc):
+        return "tls"
+    return "conexion"
+
+
+async def _download_worker_async(url, filename, scheme_folder, scheme, file_date, ssl_context, miss_cache, controller=None, revalidate_days=download_xm_file.DEFAULT_REVALIDATE_DAYS, breaker=None, coordinator=None, post_processor=None):
+    """Equivalente asyncio de _download_worker_wrapper."""
+    try:
+        status = await _probe_status_async(
+            url, filename, scheme_folder, ssl_context, miss_cache=miss_cache, file_date=file_date,
+            controller=controller, revalidate=download_xm_file._should_revalidate(file_date, revalidate_days),
+            breaker=breaker, coordinator=coordinator)
+        if status == download_xm_file._MISSED:
+            return False, None
+        if status is None:
+            return False, f"{download_xm_file.PROBE_UNANSWERED} {filename}"
+        # Un archivo ya en disco no se vuelve a procesar (la limpieza TIE no es idempotente)
+        if status == download_xm_file.STATUS_CACHED:
+            return True, f"[OK] Ya en disco: {filename}"
+        loop = asyncio.get_running_loop()
+        if post_processor is not None and download_xm_file._needs_post_process(scheme):
+            # submit() espera si la etapa de CPU está llena: fuera del event loop
+            await loop.run_in_executor(None, post_processor.submit, filename, scheme_folder, scheme)
+            return True, download_xm_file._download_message(filename, status) + " -> limpieza en cola"
+        # La limpieza TIE es bloqueante: se ejecuta fuera del event loop
+        msg = await loop.run_in_executor(
+            None, download_xm_file._post_process_download, filename, scheme_folder, scheme, status)
+        return True, msg
+    except download_xm_file.ClaimPending:
+        raise  # _run_probe_ladders_async la devuelve a la cola
+    except Exception as e:
+        return False, f"[ERROR] {filename}: {str(e)}"
+
+
+async def _run_probe_ladders_async(ladders, worker, max_concurrency, on_result, controller=None, weights=None, on_ladder_done=None, breaker=None, deadline=None, on_dropped=None, lookahead=None):
+    """
+    Equivalente asyncio de download_xm_file._run_probe_ladders: una tarea en vuelo por
+    escalera, como máximo max_concurrency en total (o controller.limit si se da), reparto
+    ponderado entre esquemas, al primer acierto la escalera termina, con el cortacircuitos
+    abierto se retienen las escaleras hasta el request de prueba, al llegar deadline lo
+    pendiente se entrega a on_dropped y una tarea con ClaimPending vuelve a la cola.
+    """
+    pending = download_xm_file._FairLadderQueue(ladders, weights, lookahead)
+    in_flight = {}  # asyncio.Task -> (tarea, pasos restantes de la escalera)
+    current_limit = (lambda: controller.limit) if controller else (lambda: max_concurrency)
+    try:
+        return await _drive_ladders(pending, in_flight, worker, on_result, current_limit, breaker, deadline,
+                                    on_dropped, on_ladder_done, controller)
+    finally:
+        await _connections().close()  # Las conexiones libres no sobreviven al event loop
+
+
+async def _drive_ladders(pending, in_flight, worker, on_result, current_limit, breaker, deadline, on_dropped, on_ladder_done, controller=None):
+    """Bucle de _run_probe_ladders_async. Retorna los sondeos ejecutados."""
+    executed = 0
+
+    def submit_next(ladder):
+        task = ladder.popleft()
+        in_flight[asyncio.ensure_future(worker(*task))] = (task, ladder)
+
+    def can_submit():
+        if breaker is not None and breaker.waiting:
+            return not in_flight and breaker.retry_in() == 0  # Solo el request de prueba
+        return len(in_flight) < current_limit()
+
+    while True:
+        if deadline is not None and pending and time.time() >= deadline:
+            for ladder in pending.drain():
+                if on_dropped: on_dropped(ladder)
+        while pending and can_submit():
+            submit_next(pending.pop())
+        if controller is not None:
+            controller.observe(len(in_flight))
+        if not in_flight:
+            if pending and breaker is not None and breaker.waiting:
+                wait = breaker.retry_in()
+                if deadline is not None:
+                    wait = min(wait, max(deadline - time.time(), 0))
+                await asyncio.sleep(max(wait, 0.05))
+                continue
+            break
+        timeout = max(deadline - time.time(), 0.05) if deadline is not None and pending else None
+        done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            task, ladder = in_flight.pop(future)
+            pending.release(task[3])
+            try:
+                success, msg = future.result()
+            except download_xm_file.ClaimPending:
+                ladder.appendleft(task)
+                pending.push(ladder)
+                continue
+            except Exception as e:
+                success, msg = False, f"[EXCEPTION] {e}"
+            executed += 1
+            on_result(task, success, msg)
+
+            if not success and ladder:
+                if deadline is not None and time.time() >= deadline:
+                    if on_dropped: on_dropped(ladder)
+                else:
+                    pending.push(ladder, front=True)
+            elif on_ladder_done:
+                on_ladder_done(task)
+
+    return executed
+
+
+async def download_schemes_range_async(start_date, end_date, scheme_names, root_dir, max_workers=200, callback_log=None, miss_cache=None, controller=None, weights=None, calendar=None, min_score=download_xm_file.DEFAULT_MIN_SCORE, discovered=None, revalidate_days=download_xm_file.DEFAULT_REVALIDATE_DAYS, breaker=None, deadline=None, shard=None, on_file=None, windows=None, coordinator=None):
+    """
+    Corrutina equivalente a download_xm_file.download_schemes_range: una sola cola de
+    sondeos para todos los esquemas.
+    max_workers: sondeos simultáneos en vuelo (corrutinas, no hilos).
+    controller: AdaptiveConcurrency opcional; reemplaza a max_workers.
+    calendar / min_score / discovered / revalidate_days / breaker / deadline: ver download_xm_file.download_scheme_range.
+    shard / on_file / windows / coordinator: ver download_xm_file.download_schemes_range.
+    Retorna: {esquema: (archivos_descargados, total_dias)}
+    """
+    if coordinator is None:
+        with download_xm_file.RunCoordinator(root_dir, callback_log, defer=True) as coordinator:
+            return await download_schemes_range_async(
+                start_date, end_date, scheme_names, root_dir, max_workers=max_workers, callback_log=callback_log,
+                miss_cache=miss_cache, controller=controller, weights=weights, calendar=calendar,
+                min_score=min_score, discovered=discovered, revalidate_days=revalidate_days, breaker=breaker,
+                deadline=deadline, shard=shard, on_file=on_file, windows=windows, coordinator=coordinator)
+
+    owns_cache = miss_cache is None
+    if owns_cache:
+        miss_cache = MissCache.for_root(root_dir)
+    if calendar is None:
+        calendar = PublicationCalendar.from_archive(root_dir, scheme_names)
+    if breaker is None:
+        breaker = download_xm_file.CircuitBreaker(callback_log=callback_log)
+
+    plan = ProbePlan(start_date, end_date, scheme_names, root_dir, miss_cache=miss_cache,
+                     calendar=calendar, min_score=min_score, discovered=discovered, shard=shard,
+                     windows=windows)
+    patterns = download_xm_file.PatternLog.for_root(root_dir)
+    run = download_xm_file._MultiSchemeRun(callback_log, on_file=on_file, patterns=patterns)
+    ladders = run.plan(plan)
+
+    ssl_context = download_xm_file.make_xm_ssl_context()
+    # Limpieza TIE en la etapa de CPU (procesos): ni el event loop ni los sondeos la esperan
+    post_processor = download_xm_file.PostProcessQueue(callback_log)
+    try:
+        for scheme_name in plan.scheme_names:
+            post_processor.resume(plan.scheme_folder(scheme_name), scheme_name)
+        worker = lambda *task: _download_worker_async(*task, ssl_context=ssl_context, miss_cache=miss_cache,
+                                                      controller=controller, revalidate_days=revalidate_days,
+                                                      breaker=breaker, coordinator=coordinator,
+                                                      post_processor=post_processor)
+        await _run_probe_ladders_async(ladders, worker, max_workers, run.on_result, controller=controller,
+                                       weights=weights, on_ladder_done=run.on_ladder_done, breaker=breaker,
+                                       deadline=deadline, on_dropped=run.on_dropped)
+    finally:
+        await asyncio.get_running_loop().run_in_executor(None, post_processor.__exit__, None, None, None)
+    run.report_dropped()
+    patterns.save()
+
+    if owns_cache:
+        miss_cache.save()
+    return run.results()
+
+
+async def download_scheme_range_async(start_date, end_date, scheme_name, root_dir, max_workers=200, callback_log=None, miss_cache=None, controller=None, calendar=None, min_score=download_xm_file.DEFAULT_MIN_SCORE, discovered=None, revalidate_days=download_xm_file.DEFAULT_REVALIDATE_DAYS, breaker=None, deadline=None):
+    """
+    Corrutina equivalente a download_xm_file.download_scheme_range.
+    Retorna: (archivos_descargados, total_dias)
+    """
+    results = await download_schemes_range_async(
+        start_date, end_date, [scheme_name], root_dir, max_workers=max_workers,
+        callback_log=callback_log, miss_cache=miss_cache, controller=controller,
+        calendar=calendar, min_score=min_score, discovered=discovered, revalidate_days=revalidate_days,
+        breaker=breaker, deadline=deadline)
+    return results.get(scheme_name, (0, 0))
+
+
+def download_scheme_range(start_date, end_date, scheme_name, root_dir, max_workers=200, callback_log=None, miss_cache=None, controller=None, calendar=None, min_score=download_xm_file.DEFAULT_MIN_SCORE, discovered=None, revalidate_days=download_xm_file.DEFAULT_REVALIDATE_DAYS, breaker=None, deadline=None):
+    """Versión síncrona (misma firma que download_xm_file.download_scheme_range)."""
+    return asyncio.run(download_scheme_range_async(
+        start_date, end_date, scheme_name, root_dir, max_workers=max_workers,
+        callback_log=callback_log, miss_cache=miss_cache, controller=controller,
+        calendar=calendar, min_score=min_score, discovered=discovered, revalidate_days=revalidate_days,
+        breaker=breaker, deadline=deadline))
+
+
+def download_schemes_range(start_date, end_date, scheme_names, root_dir, max_workers=200, callback_log=None, miss_cache=None, controller=None, weights=None, calendar=None, min_score=download_xm_file.DEFAULT_MIN_SCORE, discovered=None, revalidate_days=download_xm_file.DEFAULT_REVALIDATE_DAYS, breaker=None, deadline=None, shard=None, on_file=None, windows=None, coordinator=None):
+    """Versión síncrona (misma firma que download_xm_file.download_schemes_range)."""
+    return asyncio.run(download_schemes_range_async(
+        start_date, end_date, scheme_names, root_dir, max_workers=max_workers,
+        callback_log=callback_log, miss_cache=miss_cache, controller=controller, weights=weights,
+        calendar=calendar, min_score=min_score, discovered=discovered, revalidate_days=revalidate_days,
+        breaker=breaker, deadline=deadline, shard=shard, on_file=on_file, windows=windows,
+        coordinator=coordinator))
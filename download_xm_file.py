@@ -4,21 +4,60 @@ import os
 import subprocess
 import shutil
 from datetime import datetime, timedelta
-from urllib.parse import quote
+from urllib.parse import quote, unquote, urlsplit, parse_qs
 import calendar
 import locale
+import json
+import threading
+import time
+import random
+import re
+import bisect
+import functools
+import zlib
+import zipfile
+import io
+import hashlib
+import socket
+import multiprocessing
+import manifest_xm
+import workbook_xm
+
+try:
+    import fcntl  # Reflinks (FICLONE) en Linux; no existe en Windows
+except ImportError:
+    fcntl = None
 
 try:
     import pandas as pd
 except ImportError:
     pd = None
-    print("Advertencia: pandas no está instalado. No se podrá procesar archivos TIE.")
+    print("Advertencia: pandas no está instalado. No se podrán leer los reportes.")
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+    print("Advertencia: openpyxl no está instalado. No se podrá procesar archivos TIE.")
 
 # El servidor XM rechaza TLS 1.2 con EOF desde ~10 abril.
 # Solución: forzar TLS 1.3 mínimo en urllib3 usando ssl_minimum_version
 # (parámetro nativo de urllib3 v2.x, más confiable que pasar ssl_context).
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+XM_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36'
+
+def make_xm_ssl_context():
+    """
+    Contexto TLS para clientes que no usan _https_pool (ej: motor asyncio).
+    Sin verificación de certificado y TLS 1.3 como mínimo (XM corta TLS 1.2 con EOF).
+    """
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_3
+    return ctx
+
 # Pool compartido para todas las plataformas (Linux y Windows).
 # num_pools alto + maxsize alto → reutiliza conexiones TCP/TLS entre requests del threadpool,
 # evitando el overhead de spawn de proceso por cada curl subprocess.
@@ -27,12 +66,612 @@ _https_pool = urllib3.PoolManager(
     maxsize=50,
     cert_reqs='CERT_NONE',
     headers={
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+        'User-Agent': XM_USER_AGENT,
     }
 )
 
 
 import concurrent.futures
+from collections import deque, namedtuple
+
+# --- CACHÉ PERSISTENTE DE FALLOS (404/500) ---
+# El brute-force re-sondea cada día las mismas URLs inexistentes (~6s por 404 en el API nuevo).
+# Guardamos los fallos confirmados con una vigencia que depende de la fecha del archivo
+# respecto al momento del fallo: fechas antiguas casi nunca reciben publicaciones
+# tardías, fechas futuras sí. El vencimiento se fija al registrar el fallo (un 404 de
+# ayer para la fecha de hoy era un 404 de fecha futura y vence como tal).
+MISS_CACHE_FILENAME = ".xm_miss_cache.json"
+
+# (dias_en_el_pasado_minimo, horas_de_vigencia): se aplica la primera regla que se cumpla.
+MISS_CACHE_TTL_RULES = [
+    (15, 24 * 30),  # Más de 2 semanas atrás: revisar una vez al mes
+    (3, 24 * 7),    # Entre 3 y 14 días atrás: publicaciones tardías poco frecuentes
+    (0, 20),        # Hoy y 2 días atrás: aún pueden llegar correcciones. Menos de un día:
+                    # la ejecución diaria siguiente siempre vuelve a sondear
+]
+MISS_CACHE_TTL_FUTURE_HOURS = 6  # Fechas futuras: XM puede publicar en cualquier momento
+
+
+class MissCache:
+    """
+    Caché persistente de URLs que el servidor XM confirmó como inexistentes (404/500).
+    Clave: la URL generada por get_xm_url. Es seguro compartirla entre hilos.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}  # url -> (epoch_marcado, "YYYY-MM-DD" o None, epoch_vencimiento)
+        self._lock = threading.Lock()
+        self.skipped = 0
+        if path:
+            self.load()
+
+    @classmethod
+    def for_root(cls, root_dir):
+        return cls(os.path.join(root_dir, MISS_CACHE_FILENAME))
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._entries = {url: self._entry(*entry[:3]) for url, entry in data.items()}
+        except (OSError, ValueError, TypeError, IndexError) as e:
+            # Caché corrupta: se descarta, solo cuesta volver a sondear
+            print(f"Advertencia: caché de fallos ilegible ({e}). Se reinicia.")
+            self._entries = {}
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            vigentes = {url: list(entry) for url, entry in self._entries.items()
+                        if self._is_valid(entry, now)}
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(vigentes, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Advertencia: no se pudo guardar la caché de fallos: {e}")
+
+    @staticmethod
+    def ttl_hours(file_date, now=None):
+        """Horas de vigencia de un fallo para un archivo con fecha file_date."""
+        if file_date is None:
+            return MISS_CACHE_TTL_FUTURE_HOURS
+        today = (now or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+        days_ago = (today - file_date.replace(hour=0, minute=0, second=0, microsecond=0)).days
+        if days_ago < 0:
+            return MISS_CACHE_TTL_FUTURE_HOURS
+        for min_days, hours in MISS_CACHE_TTL_RULES:
+            if days_ago >= min_days:
+                return hours
+        return MISS_CACHE_TTL_FUTURE_HOURS
+
+    @classmethod
+    def _entry(cls, marked_at, date_str, expires_at=None):
+        """(marcado, fecha, vencimiento); las cachés anteriores no guardaban el vencimiento."""
+        if expires_at is None:
+            file_date = datetime.strptime(date_str, "%Y-%m-%d") if date_str else None
+            expires_at = marked_at + cls.ttl_hours(file_date, datetime.fromtimestamp(marked_at)) * 3600
+        return (marked_at, date_str, expires_at)
+
+    @staticmethod
+    def _is_valid(entry, now):
+        return now < entry[2]
+
+    def is_miss(self, url):
+        """True si la URL tiene un fallo vigente (no vale la pena sondearla)."""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return False
+            if self._is_valid(entry, time.time()):
+                self.skipped += 1
+                return True
+            del self._entries[url]
+            return False
+
+    def record(self, url, file_date=None):
+        date_str = file_date.strftime("%Y-%m-%d") if file_date else None
+        entry = self._entry(time.time(), date_str)
+        with self._lock:
+            self._entries[url] = entry
+
+    def forget(self, url):
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def merge(self, other):
+        """Incorpora los fallos de otra caché (ej: la de otro shard); gana la marca más reciente."""
+        with self._lock:
+            for url, entry in other._entries.items():
+                current = self._entries.get(url)
+                if current is None or entry[0] > current[0]:
+                    self._entries[url] = entry
+
+
+# --- CONCURRENCIA ADAPTATIVA (AIMD) ---
+# En vez de un max_workers fijo, el número de sondeos en vuelo sube de a poco mientras
+# el servidor responde sano (p95 de latencia y tasa de errores bajo umbral) y se reduce
+# a la mitad ante timeouts, EOF de TLS o estados distintos de 200/404/500.
+# Solo sube si el límite actual se usó de verdad: con pocas escaleras pendientes los
+# sondeos en vuelo quedan por debajo del límite y una respuesta sana no dice nada de
+# cómo se comporta el servidor con más carga.
+
+class AdaptiveConcurrency:
+    """
+    Controlador AIMD (aumento aditivo, disminución multiplicativa) de sondeos en vuelo.
+    Los motores consultan `limit` antes de enviar, informan los sondeos en vuelo con
+    observe() y reportan cada respuesta con record().
+    Es seguro compartirlo entre hilos y entre esquemas de una misma ejecución.
+    """
+
+    def __init__(self, initial=20, minimum=4, maximum=120, increase=2, decrease_factor=0.5,
+                 window=20, p95_target=10.0, max_error_rate=0.05, cooldown=5.0, callback_log=None):
+        self.minimum = minimum
+        self.maximum = max(maximum, initial)
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.window = window
+        self.p95_target = p95_target          # segundos; el API nuevo tarda ~6s por 404
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown              # segundos entre reducciones (una ráfaga = un evento)
+        self.callback_log = callback_log
+        self._limit = max(minimum, min(initial, self.maximum))
+        self._samples = []                    # (latencia, es_error) desde el último ajuste
+        self._peak = 0                        # Máximo de sondeos en vuelo desde el último ajuste
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self.history = [(time.time(), self._limit, "inicial")]
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def _set_limit(self, new_limit, reason):
+        old = self._limit
+        self._limit = new_limit
+        self._samples = []
+        self._peak = 0
+        self.history.append((time.time(), new_limit, reason))
+        # Solo las reducciones van al log en vivo; los aumentos quedan en el historial
+        if self.callback_log and new_limit < old:
+            self.callback_log(f"[AIMD] Concurrencia {old} -> {new_limit} ({reason})")
+
+    def observe(self, in_flight):
+        """Sondeos en vuelo ahora (lo llaman los motores después de enviar)."""
+        with self._lock:
+            self._peak = max(self._peak, in_flight)
+
+    @property
+    def saturated(self):
+        """True si desde el último ajuste hubo en vuelo (casi) tantos sondeos como el límite."""
+        return self._peak >= self._limit - self.increase
+
+    def record(self, latency, error=None):
+        """
+        Registra una respuesta. error: None si fue sana (200/404/500) o un texto corto
+        ("timeout", "tls", "HTTP 429"...) si debe provocar una reducción.
+        """
+        with self._lock:
+            now = time.time()
+            if error is not None:
+                self._samples.append((latency, True))
+                if now - self._last_decrease >= self.cooldown and self._limit > self.minimum:
+                    self._last_decrease = now
+                    self._set_limit(max(self.minimum, int(self._limit * self.decrease_factor)), error)
+                return
+
+            self._samples.append((latency, False))
+            if len(self._samples) < self.window:
+                return
+            latencies = sorted(lat for lat, _ in self._samples)
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            error_rate = sum(1 for _, is_error in self._samples if is_error) / len(self._samples)
+            if (p95 <= self.p95_target and error_rate <= self.max_error_rate and self._limit < self.maximum
+                    and self.saturated):
+                self._set_limit(min(self.maximum, self._limit + self.increase), f"p95 {p95:.1f}s")
+            else:
+                self._samples = []
+                self._peak = 0
+
+    def history_lines(self):
+        """Historial compacto: los aumentos consecutivos se agrupan en una sola línea."""
+        lines = []
+        run_start = None
+        for i, (ts, limit, reason) in enumerate(self.history):
+            hhmmss = datetime.fromtimestamp(ts).strftime('%H:%M:%S')
+            prev_limit = self.history[i - 1][1] if i else None
+            if prev_limit is not None and limit > prev_limit:
+                if run_start is None:
+                    run_start = (hhmmss, prev_limit, 0)
+                run_start = (run_start[0], run_start[1], run_start[2] + 1)
+                next_is_increase = i + 1 < len(self.history) and self.history[i + 1][1] > limit
+                if not next_is_increase:
+                    lines.append(f"{run_start[0]}-{hhmmss} {run_start[1]} -> {limit} ({run_start[2]} aumentos)")
+                    run_start = None
+            else:
+                lines.append(f"{hhmmss} -> {limit} ({reason})")
+        return lines
+
+    def summary(self):
+        limits = [limit for _, limit, _ in self.history]
+        return (f"Concurrencia adaptativa: inicial {limits[0]}, final {self._limit}, "
+                f"rango [{min(limits)}, {max(limits)}], {len(self.history) - 1} ajustes")
+
+
+def _classify_request_error(exc):
+    """Clasifica una excepción de red para el controlador AIMD: 'timeout', 'tls' o 'conexion'."""
+    reason = getattr(exc, "reason", None) or exc  # MaxRetryError envuelve la causa real
+    if isinstance(reason, (urllib3.exceptions.TimeoutError, TimeoutError)):
+        return "timeout"
+    if isinstance(reason, (urllib3.exceptions.SSLError, ssl.SSLError)) or "EOF" in str(reason):
+        return "tls"
+    return "conexion"
+
+
+# --- CORTACIRCUITOS ---
+# Cuando el servidor XM se rompe (EOF de TLS 1.2 en abril, migración del endpoint), cada
+# request espera hasta el timeout. El cortacircuitos se abre tras una racha de fallos de
+# red: los planificadores retienen las escaleras pendientes y cada cierto tiempo (backoff
+# exponencial con jitter) dejan pasar un solo request de prueba. Si varias pruebas seguidas
+# fallan se abandona la ejecución y el resto de tareas falla al instante sin tocar la red.
+# El corte se informa una sola vez.
+BREAKER_FAILURE_THRESHOLD = 10   # Fallos de red seguidos para abrir
+BREAKER_BASE_DELAY = 5.0         # Segundos hasta la primera prueba
+BREAKER_MAX_DELAY = 60.0
+BREAKER_MAX_TRIALS = 4           # Pruebas fallidas antes de abandonar
+
+class CircuitBreaker:
+    """
+    Cortacircuitos compartido por todas las descargas de una ejecución (hilos o asyncio).
+    Los motores llaman allow() antes de cada request y record_success() / record_failure()
+    con el resultado. Cualquier respuesta HTTP (incluso 404/500) cuenta como éxito: el
+    cortacircuitos mide si el servidor contesta, no si el archivo existe.
+    """
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, base_delay=BREAKER_BASE_DELAY,
+                 max_delay=BREAKER_MAX_DELAY, max_trials=BREAKER_MAX_TRIALS, callback_log=None):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_trials = max_trials
+        self.callback_log = callback_log
+        self.is_open = False
+        self.gave_up = False
+        self.openings = 0
+        self.rejected = 0       # Tareas descartadas sin red mientras estuvo abierto
+        self.reason = None
+        self._streak = 0
+        self._trials = 0
+        self._retry_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _log(self, msg):
+        if self.callback_log:
+            self.callback_log(msg)
+        else:
+            print(msg)
+
+    def _schedule_trial(self):
+        delay = min(self.max_delay, self.base_delay * (2 ** self._trials))
+        self._retry_at = time.time() + delay * random.uniform(0.5, 1.5)
+
+    def allow(self):
+        """True si se puede enviar un request (circuito cerrado o turno de prueba)."""
+        with self._lock:
+            if not self.is_open:
+                return True
+            if not self.gave_up and not self._trial_in_flight and time.time() >= self._retry_at:
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    @property
+    def waiting(self):
+        """True mientras está abierto esperando una prueba (aún no se abandonó)."""
+        return self.is_open and not self.gave_up
+
+    def retry_in(self):
+        """Segundos hasta el próximo request de prueba (0 si ya puede enviarse)."""
+        with self._lock:
+            if not self.waiting or self._trial_in_flight:
+                return 0.0
+            return max(0.0, self._retry_at - time.time())
+
+    def record_success(self):
+        with self._lock:
+            self._streak = 0
+            if self.is_open and not self.gave_up:
+                self.is_open = False
+                self._trials = 0
+                self._trial_in_flight = False
+                self._log(f"[CIRCUITO] Servidor XM responde de nuevo; se reanudan las descargas "
+                          f"({self.rejected} tareas descartadas durante el corte).")
+
+    def record_failure(self, reason):
+        """reason: tipo de fallo de red ('tls', 'timeout', 'conexion')."""
+        with self._lock:
+            if not self.is_open:
+                self._streak += 1
+                if self._streak >= self.threshold:
+                    self.is_open = True
+                    self.openings += 1
+                    self.reason = reason
+                    self._trials = 0
+                    self._schedule_trial()
+                    self._log(f"[CIRCUITO] Abierto tras {self._streak} fallos de red seguidos ({reason}). "
+                              f"Se retienen las tareas pendientes y se reintentará con backoff.")
+                return
+            if self._trial_in_flight:
+                self._trial_in_flight = False
+                self._trials += 1
+                if self._trials >= self.max_trials:
+                    self.gave_up = True
+                    self._log(f"[CIRCUITO] {self._trials} pruebas fallidas ({reason}): se abandonan "
+                              f"las descargas restantes de esta ejecución.")
+                else:
+                    self._schedule_trial()
+
+    def summary(self):
+        if not self.openings:
+            return "Circuito: sin cortes."
+        state = "abandonado" if self.gave_up else ("abierto" if self.is_open else "cerrado")
+        return (f"Circuito: {self.openings} corte(s) por '{self.reason}', {self.rejected} tareas "
+                f"descartadas sin red, estado final {state}.")
+
+
+# --- COORDINACIÓN ENTRE EJECUCIONES SOBRE LA MISMA RAÍZ ---
+# La GUI, la tarea programada y scripts sueltos pueden descargar a la vez en la misma
+# raíz. Cada ejecución toma un arriendo (<root>/.xm_coordinacion/ejecuciones/<id>.json,
+# renovado cada LEASE_HEARTBEAT segundos) y reclama cada URL antes de sondearla con un
+# archivo creado en exclusiva (reclamos/<sha1(url)>.json); al terminar anota el resultado
+# en el mismo archivo. Otra ejecución que llega a esa URL no la vuelve a pedir: si el
+# sondeo sigue en vuelo espera su resultado, y si ya terminó lo toma tal cual. Reclamos
+# de ejecuciones cuyo arriendo venció (cerradas o caídas) no cuentan.
+# Una ejecución sola en la raíz no escribe reclamos (no hay con quién repartir): empieza
+# a hacerlo cuando el latido ve el arriendo de otra. Al cerrar borra sus reclamos, así la
+# carpeta no queda con un archivo por URL sondeada (ni entra en la caché de actions).
+COORDINATION_DIRNAME = ".xm_coordinacion"  # Oculta: upload_drive no la sube
+LEASE_TTL = 60.0          # Segundos sin renovar para dar por muerta una ejecución
+LEASE_HEARTBEAT = 15.0
+CLAIM_POLL_SECONDS = 0.5  # Espera entre consultas al reclamo de otra ejecución
+
+CLAIM_OWN = "propio"      # La URL se sondea en esta ejecución
+CLAIM_FOUND = "ok"        # Otra ejecución la descargó
+CLAIM_MISSED = "fallo"    # Otra ejecución confirmó que no existe
+
+class ClaimPending(Exception):
+    """Otra ejecución sondea la URL ahora mismo: la tarea vuelve a la cola para más tarde."""
+
+class RunCoordinator:
+    """
+    Arriendo de una ejecución sobre root_dir y reclamos de URLs compartidos con las demás
+    ejecuciones activas en la misma raíz (otros procesos o máquinas con la carpeta en red).
+    Se usa como context manager: with RunCoordinator(root) as coordinator: ...
+    defer: si otra ejecución sondea la URL, claim() lanza ClaimPending en vez de esperar;
+           los ejecutores de escaleras devuelven la tarea a la cola y siguen con otras
+           escaleras, así dos ejecuciones se reparten el plan en vez de avanzar juntas.
+    """
+
+    def __init__(self, root_dir, callback_log=None, defer=False):
+        self.root_dir = root_dir
+        self.defer = defer
+        self.callback_log = callback_log
+        self.dir = os.path.join(root_dir, COORDINATION_DIRNAME)
+        self.run_id = f"{socket.gethostname()}-{os.getpid()}-{int(time.time() * 1000) % 10**8}"
+        self.lease_path = os.path.join(self.dir, "ejecuciones", f"{self.run_id}.json")
+        self.claimed = 0     # URLs sondeadas por esta ejecución
+        self.shared = 0      # URLs resueltas por otra ejecución
+        self.solo = False    # Sin otras ejecuciones activas: los reclamos no se escriben
+        self._claims = set() # Reclamos escritos por esta ejecución (se borran al cerrar)
+        self._alive_cache = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def log(self, msg):
+        if self.callback_log:
+            self.callback_log(msg)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.lease_path), exist_ok=True)
+        _write_json_atomic(self.lease_path, {"id": self.run_id, "pid": os.getpid(), "host": socket.gethostname(),
+                                             "inicio": datetime.now().isoformat(timespec="seconds")})
+        others = self.live_runs()
+        if others:
+            self.log(f"[COORDINACIÓN] {len(others)} ejecución(es) activa(s) en esta raíz "
+                     f"({', '.join(others)}): se reparten los sondeos.")
+            os.makedirs(os.path.join(self.dir, "reclamos"), exist_ok=True)
+        self.solo = not others
+        self._sweep()
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join(timeout=1)
+        with self._lock:
+            claims, self._claims = self._claims, set()
+        for path in [self.lease_path] + sorted(claims):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if self.shared:
+            self.log(f"[COORDINACIÓN] {self.shared} sondeos resueltos por otra ejecución, {self.claimed} propios.")
+
+    def _renew(self):
+        while not self._stop.wait(LEASE_HEARTBEAT):
+            try:
+                os.utime(self.lease_path)
+            except OSError:
+                pass
+            if self.solo:
+                try:
+                    others = self.live_runs()
+                except OSError:
+                    others = []
+                if others:
+                    self._share(others)
+
+    def _share(self, others):
+        """Otra ejecución llegó a la raíz: desde ahora los sondeos se reclaman en disco."""
+        os.makedirs(os.path.join(self.dir, "reclamos"), exist_ok=True)
+        self.solo = False
+        self.log(f"[COORDINACIÓN] Llegó otra ejecución ({', '.join(others)}): se reparten los sondeos.")
+
+    def _lease_of(self, run_id):
+        return os.path.join(self.dir, "ejecuciones", f"{run_id}.json")
+
+    def is_alive(self, run_id):
+        """True si run_id renovó su arriendo hace menos de LEASE_TTL (se consulta a lo más 1 vez/s)."""
+        if run_id == self.run_id:
+            return True
+        now = time.time()
+        with self._lock:
+            cached = self._alive_cache.get(run_id)
+            if cached and now - cached[0] < 1.0:
+                return cached[1]
+        try:
+            alive = now - os.path.getmtime(self._lease_of(run_id)) < LEASE_TTL
+        except OSError:
+            alive = False
+        with self._lock:
+            self._alive_cache[run_id] = (now, alive)
+        return alive
+
+    def live_runs(self):
+        folder = os.path.join(self.dir, "ejecuciones")
+        runs = [name[:-len(".json")] for name in os.listdir(folder) if name.endswith(".json")]
+        return [run_id for run_id in runs if run_id != self.run_id and self.is_alive(run_id)]
+
+    def _sweep(self):
+        """Borra arriendos vencidos y reclamos de ejecuciones que ya no están activas."""
+        now = time.time()
+        folder = os.path.join(self.dir, "ejecuciones")
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                if now - os.path.getmtime(path) >= LEASE_TTL:
+                    os.remove(path)
+            except OSError:
+                pass
+        folder = os.path.join(self.dir, "reclamos")
+        for name in (os.listdir(folder) if os.path.isdir(folder) else []):
+            path = os.path.join(folder, name)
+            entry = self._read_claim(path)
+            if entry is not None and not self.is_alive(entry.get("ejecucion")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _claim_path(self, url):
+        return os.path.join(self.dir, "reclamos", hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _read_claim(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def try_claim(self, url):
+        """
+        Intenta reclamar url sin esperar. Retorna CLAIM_OWN, CLAIM_FOUND / CLAIM_MISSED
+        (resultado de otra ejecución activa) o None si otra ejecución la sondea ahora.
+        """
+        if self.solo:
+            self._count("claimed")
+            return CLAIM_OWN
+        path = self._claim_path(url)
+        claim = {"ejecucion": self.run_id, "url": url}
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(claim, f)
+            self._own(path)
+            return CLAIM_OWN
+        except FileExistsError:
+            pass
+        entry = self._read_claim(path)
+        if entry is None:
+            return None  # Se está escribiendo: se consulta de nuevo en la próxima vuelta
+        owner = entry.get("ejecucion")
+        if owner == self.run_id:
+            return CLAIM_OWN
+        if self.is_alive(owner):
+            return entry.get("estado")
+        # Ejecución cerrada o caída: su reclamo (y su resultado, quizás viejo) no cuenta
+        _write_json_atomic(path, claim)
+        if (self._read_claim(path) or {}).get("ejecucion") != self.run_id:
+            return None  # Otra ejecución lo tomó al mismo tiempo
+        self._own(path)
+        return CLAIM_OWN
+
+    def claim(self, url):
+        """
+        Como try_claim, pero mientras otra ejecución la sondea espera (bloqueando) o, con
+        defer, lanza ClaimPending tras una pausa corta.
+        """
+        while True:
+            state = self.try_claim(url)
+            if state is not None:
+                if state != CLAIM_OWN:
+                    self._count("shared")
+                return state
+            time.sleep(CLAIM_POLL_SECONDS)
+            if self.defer:
+                raise ClaimPending(url)
+
+    def finish(self, url, state):
+        """Anota el resultado del sondeo propio: CLAIM_FOUND, CLAIM_MISSED o None (sin resultado)."""
+        path = self._claim_path(url)
+        with self._lock:
+            if path not in self._claims:
+                return  # Reclamado sin archivo (ejecución sola): no hay nada que anotar
+            if state is None:
+                self._claims.discard(path)
+        if state is None:
+            # Error de red: se libera para que otra ejecución lo intente
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+        _write_json_atomic(path, {"ejecucion": self.run_id, "url": url, "estado": state})
+
+    def _own(self, path):
+        with self._lock:
+            self._claims.add(path)
+            self.claimed += 1
+
+    def _count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
 
 try:
     locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
@@ -46,6 +685,11 @@ except locale.Error:
 ESQUEMAS = {
     "Mensual": {
         "carpeta_url": "Energia y Mercado/Garantias Mensuales",
+        "prioridad": 1, # Peso en la cola compartida de descargas (más alto = más workers)
+        # Páginas de xm.com.co con enlaces a los archivos (ver extract_xm_links.py)
+        "paginas_xm": [
+            "https://www.xm.com.co/administraci%C3%B3n-financiera/garant%C3%ADas-financieras/c%C3%A1lculos-garant%C3%ADas-financieras-mensuales-esquema"
+        ],
         "archivos": [
             "GARANTIA SEMANAL MENSUAL",
             "GARANTIA TXR",
@@ -55,32 +699,122 @@ ESQUEMAS = {
     },
     "Semanal": {
         "carpeta_url": "Energia y Mercado/Garantias Semanales",
+        "prioridad": 2,
+        "critico": True, # Lo usan las notificaciones de la mañana: primero en la cola (ver ladder_tier)
         "archivos": [
             "GARANTIA SEMANAL",
             "GARANTIA TXR"
-        ]
+        ],
+        "sondeo": {
+            "vigilancia": {"intervalo": 10, "dias": (0, 3)},
+        }
     },
     "TIE": {
         "carpeta_url": "Agentes/Garantias Financieras TIE",
+        "prioridad": 3,
+        "critico": True,
         "archivos": [
             "WEB_GARANTIES",
             "WEB_GARANTIAS"
         ],
         "formato_fecha": "NUMERICO", # DD-MM-YYYY
         "separador": "-", # WEB_GARANTIES-10...
-        "formato_carpeta_mes": "SIN_ESPACIO" # 02.Febrero (vs 02. Febrero)
+        "formato_carpeta_mes": "SIN_ESPACIO", # 02.Febrero (vs 02. Febrero)
+        "sondeo": {
+            # Sin espacios en el nombre: las variantes de espacios solo repetían URLs
+            "pasado": {"ampliado": {"nombres": ["minusculas"], "versiones": ["_V3"], "extensiones": [".XLSX", ".XLS"]}},
+            # El archivo del lunes sale el jueves anterior: se vigila hasta 5 días adelante
+            "vigilancia": {"intervalo": 10, "dias": (0, 5)},
+        }
     },
     "Cuentas": {
         "carpeta_url": "Agentes/SaldosDiariosCuentasCustodia",
+        "prioridad": 3,
+        "critico": True,
         "archivos": [
             "Saldo cuenta custodia"
         ],
         "formato_fecha": "ISO", # YYYY-MM-DD
         "separador": " ",
-        "incluir_path_fecha": False # No usa subcarpetas de año/mes
+        "incluir_path_fecha": False, # No usa subcarpetas de año/mes
+        "sondeo": {
+            # Saldos del día hábil anterior: nunca hay archivos con fecha futura.
+            # -4 cubre un fin de semana largo (lunes festivo).
+            "ventana": (-4, 0),
+            "fechas_futuras": False,
+            "vigilancia": {"intervalo": 15, "dias": (-1, 0)},
+            "pasado": {"nombres": ["canonico"], "versiones": [""], "extensiones": [".xlsx", ".xls"],
+                       "ampliado": {"nombres": ["minusculas"], "extensiones": [".XLSX"]}},
+        }
     }
 }
 
+# --- POLÍTICA DE SONDEO POR ESQUEMA ---
+# Cada esquema de ESQUEMAS puede declarar en "sondeo" solo lo que cambia respecto a esta
+# política; ProbePlan la respeta en run_daily, la GUI, el backfill y ambos motores.
+# - ventana: días respecto a hoy que sondea run_daily (inicio, fin), ambos incluidos.
+# - fechas_futuras: False = las fechas posteriores a hoy no se sondean nunca.
+# - pasado / futuro: variantes por nivel de fecha. "nombres" son transformaciones del
+#   archivo base (ver NAME_VARIANTS); versiones y extensiones van de más a menos
+#   probables, porque cada escalera se detiene en el primer acierto.
+# - vigilancia: modo watch_xm.py; cada "intervalo" minutos se vuelven a sondear las
+#   claves aún faltantes con fecha en "dias" (respecto a hoy), solo con lo canónico.
+# - ampliado: variantes raras (errores de nombrado de XM). Solo se prueban para claves
+#   que deberían existir (ver EXPANDED_MIN_SCORE) y después de que las canónicas fallen;
+#   versiones nuevas (ej: _V3) forman su propia escalera, también solo para esas claves.
+# Fechas futuras: solo nombre canónico y sin _V2 (el archivo aún no se publicó), pero
+# con .xls: TIE publica con fecha adelantada y a veces en formato Excel 97-2003.
+DEFAULT_PROBE_POLICY = {
+    "ventana": (-2, 15),
+    "fechas_futuras": True,
+    "vigilancia": {"intervalo": 60, "dias": (-1, 3)},
+    "pasado": {
+        "nombres": ["canonico"],
+        "versiones": ["", "_V2"],
+        "extensiones": [".xlsx", ".xls"],
+        "ampliado": {
+            "nombres": ["espacio_final", "doble_espacio", "minusculas"],
+            "versiones": ["_V3"],
+            "extensiones": [".XLSX", ".XLS"],
+        },
+    },
+    "futuro": {
+        "nombres": ["canonico"],
+        "versiones": [""],
+        "extensiones": [".xlsx", ".xls", ".XLSX", ".XLS"],
+        "ampliado": {},
+    },
+}
+
+NAME_VARIANTS = {
+    "canonico": lambda base: base,
+    "espacio_final": lambda base: base + " ",
+    "doble_espacio": lambda base: base.replace(" ", "  "),
+    "minusculas": lambda base: base.lower(),
+}
+
+# Puntaje del calendario desde el que una clave pasada "debería existir": si las variantes
+# canónicas fallan, se prueba el nivel ampliado. Sin historial suficiente el puntaje es
+# 1.0, así que todas las claves pasadas lo reciben (misma cobertura que antes).
+EXPANDED_MIN_SCORE = 0.3
+
+def probe_policy(scheme_name):
+    """Política de sondeo efectiva del esquema: DEFAULT_PROBE_POLICY + su "sondeo"."""
+    declared = ESQUEMAS.get(scheme_name, {}).get("sondeo", {})
+    policy = dict(DEFAULT_PROBE_POLICY, **{key: value for key, value in declared.items()
+                                            if key not in ("pasado", "futuro")})
+    for tier in ("pasado", "futuro"):
+        policy[tier] = dict(DEFAULT_PROBE_POLICY[tier], **declared.get(tier, {}))
+    return policy
+
+def probe_window(scheme_name, today=None):
+    """(inicio, fin) de la ventana de sondeo del esquema, relativa a today (por defecto ahora)."""
+    today = today or datetime.now()
+    first, last = probe_policy(scheme_name)["ventana"]
+    if not probe_policy(scheme_name)["fechas_futuras"]:
+        last = min(last, 0)
+    return today + timedelta(days=first), today + timedelta(days=last)
+
 def get_xm_url(filename_base, date_obj, esquema_nombre="Mensual", version_suffix="", extension=".xlsx"):
     """
     Genera la URL de descarga basándose en el esquema y fecha.
@@ -150,104 +884,842 @@ def get_xm_url(filename_base, date_obj, esquema_nombre="Mensual", version_suffix
     
     
     # 3. URL
-    # Nuevo endpoint desde ~12 abril 2026 (el antiguo app-portalxmcore01.azurewebsites.net fue dado de baja)
-    base_url = "https://api-portalxm.xm.com.co/administracion-archivos/ficheros/descarga-archivo"
     blob_path = f"{carp_garantias}{folder_path_part}/{full_filename}"
+    return xm_url_from_blob_path(blob_path), full_filename
 
+# Nuevo endpoint desde ~12 abril 2026 (el antiguo app-portalxmcore01.azurewebsites.net fue dado de baja)
+XM_API_URL = "https://api-portalxm.xm.com.co/administracion-archivos/ficheros/descarga-archivo"
+
+def xm_url_from_blob_path(blob_path):
+    """URL de descarga del API de XM para una ruta de blob (ej: 'Energia y Mercado/Garantias Mensuales/2026/...')."""
     # Codificar: espacios -> %20, slashes -> sin codificar (igual que el navegador)
     encoded_ruta = quote(blob_path, safe='/')
-    url = f"{base_url}?ruta={encoded_ruta}&nombreBlobContainer=storageportalxm"
+    return f"{XM_API_URL}?ruta={encoded_ruta}&nombreBlobContainer=storageportalxm"
+
+# --- DESCARGAS ATÓMICAS Y REANUDABLES ---
+# La descarga se escribe en un temporal oculto (.<nombre>.part) y se renombra al nombre
+# final solo cuando el tamaño coincide con Content-Length. Si la conexión se corta, el
+# .part queda en disco y la siguiente ejecución lo continúa con un request Range.
+# El manifiesto de la raíz (manifest_xm, <root>/.xm_manifiesto.sqlite) guarda, por archivo
+# completo, su tamaño (para detectar archivos alterados o truncados) y los validadores HTTP
+# con que se descargó (URL, ETag, Last-Modified) para poder revalidarlo con un request
+# condicional.
+PARTIAL_SUFFIX = ".part"
+
+# Revalidación: archivos con fecha desde hoy - N días se consultan con If-None-Match /
+# If-Modified-Since; un 304 cuesta poco y un 200 trae la republicación corregida.
+DEFAULT_REVALIDATE_DAYS = 0  # 0 = no revalidar (comportamiento clásico)
+
+# Resultado de _download_status
+STATUS_CACHED = "cache"          # Ya estaba en disco (o el servidor respondió 304)
+STATUS_DOWNLOADED = "nuevo"      # Descargado ahora
+STATUS_UPDATED = "actualizado"   # Estaba en disco y el servidor tenía una versión distinta
+STATUS_LINKED = "enlazado"       # No estaba en la raíz; se tomó del almacén compartido
+_MISSED = "no_existe"            # Interno: el servidor confirmó que no existe (404/500 o no es un libro)
+# Mensaje de los workers para un sondeo sin respuesta definitiva (red, timeout, circuito
+# abierto): a diferencia de un 404, no prueba que el archivo no exista
+PROBE_UNANSWERED = "[SIN RESPUESTA]"
+
+# Firma de los primeros bytes y lectura de libros: en workbook_xm, que es lo único que
+# necesitan los procesos de post-procesamiento
+from workbook_xm import SNIFF_BYTES, EXCEL_ENGINES, NotAWorkbookError, sniff_format
+_describe_content = workbook_xm.describe_content
 
-    return url, full_filename
+def _read_head(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(SNIFF_BYTES)
+    except OSError:
+        return b""
+
+class _WorkbookSniffer:
+    """
+    Retiene los primeros bytes de una descarga hasta poder decidir si es un libro de Excel.
+    prefix: bytes que ya estaban en disco (un .part reanudado).
+    """
+
+    def __init__(self, filename, prefix=b""):
+        self.filename = filename
+        self._prefix = prefix[:SNIFF_BYTES]
+        self._pending = b""
+        self.format = None
+        if len(self._prefix) >= SNIFF_BYTES:
+            self._decide(self._prefix)
+
+    def _decide(self, head):
+        self.format = sniff_format(head)
+        if self.format is None:
+            raise NotAWorkbookError(f"{self.filename}: contenido {_describe_content(head)}, no es un libro de Excel")
+
+    def feed(self, chunk):
+        """Retorna los bytes que ya se pueden escribir (b"" mientras no se decide)."""
+        if self.format is not None:
+            return chunk
+        self._pending += chunk
+        if len(self._prefix) + len(self._pending) < SNIFF_BYTES:
+            return b""
+        self._decide(self._prefix + self._pending)
+        data, self._pending = self._pending, b""
+        return data
+
+    def finish(self):
+        """Fin del cuerpo: lo que no alcanzó SNIFF_BYTES tampoco es un libro."""
+        if self.format is None:
+            self._decide(self._prefix + self._pending)
+
+def _partial_path(save_path):
+    folder, name = os.path.split(save_path)
+    return os.path.join(folder, f".{name}{PARTIAL_SUFFIX}")
+
+class _FileIndex:
+    """
+    Vista de una carpeta sobre el manifiesto de su raíz (manifest_xm): datos de los
+    archivos completos, {nombre: {"bytes": n, "formato": ..., "url": ..., "etag": ...,
+    "last_modified": ..., "sha256": ...}}. La carpeta se reconcilia con el disco al crear
+    la vista; después, las consultas no tocan el disco.
+    """
+
+    def __init__(self, folder):
+        root_dir, self.carpeta = os.path.split(os.path.abspath(folder))
+        self.manifest = manifest_xm.for_root(root_dir, describe=_describe_file)
+        self.manifest.sync(self.carpeta)
+
+    def get(self, name):
+        row = self.manifest.get(self.carpeta, name)
+        if row is None:
+            return None
+        return {key: row[key] for key in manifest_xm.ENTRY_FIELDS if row[key] is not None}
+
+    def update(self, name, **fields):
+        """Actualiza (o crea) la entrada de name; los campos None se eliminan."""
+        if fields.get("bytes") is not None:
+            try:
+                fields["mtime"] = os.path.getmtime(os.path.join(self.manifest.root_dir, self.carpeta, name))
+            except OSError:
+                pass
+        if fields.get("url"):
+            fields["ruta_blob"] = _store_key(fields["url"])
+        self.manifest.update(self.carpeta, name, **fields)
+
+    def discard(self, name):
+        self.manifest.discard(self.carpeta, name)
+
+    def items(self):
+        return [(row["nombre"], {key: row[key] for key in manifest_xm.ENTRY_FIELDS if row[key] is not None})
+                for row in self.manifest.rows(self.carpeta)]
+
+    def archived(self, name):
+        """Ruta del archivo mensual (archive_xm) que contiene name, o None si está suelto."""
+        row = self.manifest.get(self.carpeta, name)
+        if row is None or not row["archivo"]:
+            return None
+        return os.path.join(self.manifest.root_dir, row["archivo"])
+
+    def names(self, refresh=False):
+        """{nombre.casefold(): nombre} de los archivos completos de la carpeta (incluye compactados)."""
+        if refresh:
+            self.manifest.sync(self.carpeta)
+        return {name.casefold(): name for name in self.manifest.names(self.carpeta)}
+
+def _describe_file(carpeta, name):
+    """Columnas derivadas del nombre para el manifiesto: esquema, fecha, archivo base y versión."""
+    if carpeta not in ESQUEMAS:
+        return {}
+    parsed = parse_scheme_filename(name, carpeta)
+    return {"esquema": carpeta,
+            "fecha": parsed.date.strftime("%Y-%m-%d") if parsed.date else None,
+            "base": parsed.base,
+            "version": str(parsed.version) if parsed.version > 1 else None}
+
+_file_indexes = {}
+_file_indexes_lock = threading.Lock()
+
+def _file_index(folder):
+    key = os.path.abspath(folder)
+    with _file_indexes_lock:
+        if key not in _file_indexes:
+            _file_indexes[key] = _FileIndex(folder)
+        return _file_indexes[key]
+
+def _scheme_file_index(folder):
+    """
+    Vista del manifiesto para leer un archivo de folder, solo si folder es la carpeta de un
+    esquema en una raíz de descargas que ya tiene manifiesto. Para archivos sueltos (el
+    maestro, libros elegidos en la GUI) retorna None y no se crea ningún manifiesto.
+    """
+    root_dir, carpeta = os.path.split(os.path.abspath(folder))
+    if carpeta not in ESQUEMAS or not manifest_xm.exists(root_dir):
+        return None
+    return _file_index(folder)
+
+def _record_size(path, source=None):
+    """
+    Anota el tamaño actual de path como tamaño completo (tras descargarlo o procesarlo).
+    source: archivo del que proviene (ej: .xls convertido a .xlsx); hereda sus validadores.
+    """
+    folder, name = os.path.split(path)
+    index = _file_index(folder)
+    if source is not None and source != path:
+        inherited = index.get(os.path.basename(source)) or {}
+        inherited.pop("bytes", None)
+        index.update(name, **inherited)
+    # El contenido ya no es el descargado: su sha256 (el del almacén) deja de aplicar
+    index.update(name, bytes=os.path.getsize(path), formato=sniff_format(_read_head(path)), sha256=None,
+                 pendiente=None)
 
-def download_file(url, filename, save_dir="Descargas_XM"):
+# --- ALMACÉN COMPARTIDO ENTRE RAÍCES ---
+# La GUI (Descargas_XM), run_daily (Garantías) y las carpetas por cliente descargan los
+# mismos archivos públicos. El almacén guarda cada contenido una sola vez
+# (objetos/<sha256[:2]>/<sha256>) y, por ruta de blob de XM, qué contenido tiene
+# (rutas/<h[:2]>/<h>.json, un archivo por ruta: varios procesos escriben sin pisarse).
+# La carpeta <esquema>/ de cada raíz recibe un enlace duro al objeto (o un reflink, o
+# una copia si el sistema de archivos no permite ninguno) en vez de volver a descargarlo.
+# Como los archivos de las raíces pueden compartir inodo con el almacén, nunca se
+# escriben en el lugar: todo reemplazo pasa por un temporal + os.replace.
+# Es opcional: solo se usa si $XM_STORE apunta a una carpeta (ej: ~/.xm_almacen en el
+# equipo con la GUI y run_daily). Sin ella, cada descarga queda solo en su raíz: en
+# GitHub Actions el almacén no se reutiliza entre ejecuciones, y donde no hay enlaces
+# duros (ej: hacia la unidad de Drive) la copia duplicaría el espacio en disco.
+STORE_ENV = "XM_STORE"   # Carpeta del almacén; sin definir, "0" o "no": desactivado
+FICLONE = 0x40049409     # ioctl de Linux para reflinks (btrfs, XFS)
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _reflink(src, dest):
+    if fcntl is None:
+        raise OSError("reflink no disponible")
+    try:
+        with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+        raise
+
+def _place(src, dest):
+    """
+    Deja en dest el contenido de src sin escribir sobre un inodo compartido: enlace duro,
+    reflink o copia a un temporal y os.replace. Retorna el método usado.
+    """
+    folder, name = os.path.split(dest)
+    tmp_path = os.path.join(folder, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    for method, place in (("enlace", os.link), ("reflink", _reflink), ("copia", shutil.copyfile)):
+        try:
+            place(src, tmp_path)
+            break
+        except OSError:
+            if method == "copia":
+                raise
+    os.replace(tmp_path, dest)
+    return method
+
+def _store_key(url):
+    """Ruta de blob de una URL del API de XM (la misma ruta sirve a todas las raíces)."""
+    ruta = parse_qs(urlsplit(url).query).get("ruta")
+    return unquote(ruta[0]) if ruta else url
+
+class SharedStore:
+    """Almacén de contenidos direccionado por sha256, compartido por todas las raíces."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, "objetos", digest[:2], digest)
+
+    def _ref_path(self, url):
+        key = hashlib.sha1(_store_key(url).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "rutas", key[:2], f"{key}.json")
+
+    def lookup(self, url):
+        """Entrada de la ruta de blob de url ({sha256, bytes, formato, etag, ...}) o None."""
+        try:
+            with open(self._ref_path(url), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        obj = self._object_path(entry.get("sha256", ""))
+        if not entry.get("sha256") or not os.path.exists(obj) or os.path.getsize(obj) != entry.get("bytes"):
+            return None  # Objeto borrado o alterado: se descarga de nuevo
+        return entry
+
+    def link_into(self, url, save_path):
+        """Pone en save_path el contenido guardado para url. Retorna el método o None."""
+        entry = self.lookup(url)
+        if entry is None:
+            return None
+        method = _place(self._object_path(entry["sha256"]), save_path)
+        folder, name = os.path.split(save_path)
+        _file_index(folder).update(name, bytes=entry["bytes"], formato=entry.get("formato"), url=url,
+                                   etag=entry.get("etag"), last_modified=entry.get("last_modified"),
+                                   sha256=entry["sha256"])
+        return method
+
+    def ingest(self, path, url, fields=None):
+        """
+        Guarda el contenido de path (recién descargado de url) y anota la ruta de blob.
+        Si el contenido ya estaba, path pasa a ser un enlace al objeto existente.
+        Retorna el sha256.
+        """
+        digest = _sha256_file(path)
+        obj = self._object_path(digest)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        if not os.path.exists(obj):
+            _place(path, obj)
+        elif not os.path.samefile(path, obj):
+            _place(obj, path)
+        entry = {key: value for key, value in (fields or {}).items() if value is not None}
+        entry.update(ruta=_store_key(url), sha256=digest, bytes=os.path.getsize(obj))
+        ref_path = self._ref_path(url)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        tmp_path = f"{ref_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, sort_keys=True)
+        os.replace(tmp_path, ref_path)
+        return digest
+
+    def forget(self, url):
+        """Olvida qué contenido tiene la ruta de blob de url (ej: resultó ser un libro dañado)."""
+        try:
+            os.remove(self._ref_path(url))
+        except FileNotFoundError:
+            pass
+
+_shared_store = None
+_shared_store_configured = False
+
+def configure_store(path):
+    """Fija la carpeta del almacén compartido (None lo desactiva) en vez de $XM_STORE."""
+    global _shared_store, _shared_store_configured
+    _shared_store = SharedStore(path) if path else None
+    _shared_store_configured = True
+    return _shared_store
+
+def shared_store():
+    """Almacén en uso: el de configure_store o el de $XM_STORE; None si no hay ninguno."""
+    if not _shared_store_configured:
+        path = os.environ.get(STORE_ENV, "")
+        configure_store(None if path.strip().lower() in ("", "0", "no", "false") else path)
+    return _shared_store
+
+def _link_from_store(url, save_path):
+    """Toma save_path del almacén si otra raíz ya lo descargó. True si quedó en disco."""
+    store = shared_store()
+    if store is None:
+        return False
+    try:
+        method = store.link_into(url, save_path)
+    except OSError as e:
+        print(f"[WARN] Almacén compartido: no se pudo enlazar {os.path.basename(save_path)}: {e}")
+        return False
+    if method:
+        print(f"[ALMACÉN] {os.path.basename(save_path)}: {method} desde {store.path}")
+    return method is not None
+
+def _store_download(save_path, url):
+    """Registra en el almacén un archivo recién descargado (un fallo no afecta la descarga)."""
+    store = shared_store()
+    if store is None:
+        return
+    folder, name = os.path.split(save_path)
+    index = _file_index(folder)
+    entry = index.get(name) or {}
+    try:
+        digest = store.ingest(save_path, url, {key: entry.get(key) for key in ("formato", "etag", "last_modified")})
+        index.update(name, sha256=digest)
+    except OSError as e:
+        print(f"[WARN] Almacén compartido: no se pudo guardar {name}: {e}")
+
+def _forget_size(path):
+    folder, name = os.path.split(path)
+    _file_index(folder).discard(name)
+
+def _discard_invalid(path):
+    """
+    Borra un libro descargado que no se puede leer y su fila del manifiesto, para que se
+    vuelva a descargar; el almacén deja de ofrecer ese contenido para su URL.
+    """
+    folder, name = os.path.split(path)
+    index = _file_index(folder)
+    url = (index.get(name) or {}).get("url")
+    store = shared_store()
+    if store is not None and url:
+        try:
+            store.forget(url)
+        except OSError as e:
+            print(f"[WARN] Almacén compartido: no se pudo olvidar {name}: {e}")
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    index.discard(name)
+
+def _is_cached(save_path):
+    """
+    True si save_path ya está descargado completo.
+    Sin fila en el manifiesto no está en disco (no hace falta consultarlo). Archivos
+    anteriores al índice de tamaños se aceptan y se anotan tal cual, salvo que no sean
+    libros de Excel (ej: una página de error guardada por versiones anteriores).
+    """
+    folder, name = os.path.split(save_path)
+    index = _file_index(folder)
+    entry = index.get(name)
+    if entry is None:
+        return False
+    try:
+        size = os.path.getsize(save_path)
+    except OSError:
+        if index.archived(name):
+            return True  # Mes cerrado, compactado por archive_xm: se lee desde el archivo mensual
+        index.discard(name)  # Borrado a mano después de la última sincronización
+        return False
+    if size <= 0:
+        return False
+    expected = entry.get("bytes")
+    if expected is not None and expected != size:
+        problem = f"{size} bytes en disco, se esperaban {expected}"
+    elif entry.get("formato"):
+        return True
+    else:
+        file_format = sniff_format(_read_head(save_path))
+        if file_format is not None:
+            index.update(name, bytes=size, formato=file_format)
+            return True
+        problem = f"contenido {_describe_content(_read_head(save_path))}, no es un libro de Excel"
+    print(f"[WARN] {name}: {problem}. Se descarga de nuevo.")
+    try:
+        os.remove(save_path)
+    except OSError:
+        pass
+    index.discard(name)
+    return False
+
+def _should_revalidate(file_date, revalidate_days, today=None):
+    """True si file_date cae en la ventana de revalidación (hoy - revalidate_days en adelante)."""
+    if not revalidate_days or file_date is None:
+        return False
+    today = (today or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (today - file_date.replace(hour=0, minute=0, second=0, microsecond=0)).days <= revalidate_days
+
+def _conditional_request(save_path, url):
+    """
+    (url, cabeceras) para revalidar save_path, o (None, None) si no hay validadores.
+    Se usa la URL con que se descargó (ej: el .xls original de un TIE convertido a .xlsx).
+    """
+    folder, name = os.path.split(save_path)
+    entry = _file_index(folder).get(name) or {}
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    if not headers:
+        return None, None
+    return entry.get("url") or url, headers
+
+def _parse_content_range(value):
+    """'bytes 100-199/200' -> (100, 200); 'bytes */200' -> (None, 200). Total None si es '*'."""
+    try:
+        unit, _, spec = value.strip().partition(" ")
+        byte_range, _, total = spec.partition("/")
+        start = None if byte_range == "*" else int(byte_range.split("-")[0])
+        return start, (None if total in ("", "*") else int(total))
+    except (ValueError, AttributeError):
+        return None, None
+
+def _expected_length(status, headers):
+    """Tamaño final esperado del archivo según la respuesta, o None si no se conoce."""
+    if status == 206:
+        return _parse_content_range(headers.get("content-range", ""))[1]
+    if headers.get("content-encoding", "identity") not in ("", "identity"):
+        return None  # El cuerpo llega descomprimido: Content-Length no aplica
+    length = headers.get("content-length")
+    return int(length) if length and length.isdigit() else None
+
+def _finish_partial(part_path, save_path, expected, url=None, headers=None):
+    """
+    Renombra el .part al nombre final si está completo. Retorna True si quedó en su lugar;
+    si faltan bytes, el .part se conserva para reanudar en la próxima ejecución.
+    Lanza NotAWorkbookError si el contenido completo no es un libro de Excel.
+    url / headers: request y cabeceras de respuesta; se guardan como validadores.
+    """
+    size = os.path.getsize(part_path)
+    if size <= 0 or (expected is not None and size != expected):
+        print(f"[INCOMPLETO] {os.path.basename(save_path)}: {size} de {expected} bytes; se reanudará.")
+        return False
+    head = _read_head(part_path)
+    file_format = sniff_format(head)
+    if file_format is None:
+        raise NotAWorkbookError(f"{os.path.basename(save_path)}: contenido {_describe_content(head)}, no es un libro de Excel")
+    ext_format = os.path.splitext(save_path)[1].lower().lstrip(".")
+    if ext_format in EXCEL_ENGINES and ext_format != file_format:
+        # XM publica a veces .xls que en realidad son .xlsx: se acepta y se anota el real
+        print(f"[FORMATO] {os.path.basename(save_path)}: es {file_format}, no {ext_format}.")
+    os.replace(part_path, save_path)
+    folder, name = os.path.split(save_path)
+    headers = headers or {}
+    _file_index(folder).update(name, bytes=size, formato=file_format, url=url, etag=headers.get("etag"),
+                               last_modified=headers.get("last-modified"), sha256=None)
+    if url:
+        _store_download(save_path, url)
+    return True
+
+def _reject_content(error, url, part_path, miss_cache=None, file_date=None):
+    """Respuesta 200 que no es un libro: se descarta y cuenta como fallo en la caché (con TTL)."""
+    print(f"[RECHAZADO] {error}")
+    _discard_partial(part_path)
+    if miss_cache is not None:
+        miss_cache.record(url, file_date)
+
+def _discard_partial(part_path):
+    try:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    except OSError:
+        pass  # En Windows, otro hilo puede tener el archivo abierto (mismo path case-insensitive)
+
+def download_file(url, filename, save_dir="Descargas_XM", miss_cache=None, file_date=None, controller=None, revalidate=False, breaker=None, coordinator=None):
+    """
+    Descarga url en save_dir/filename. Retorna True si el archivo quedó en disco.
+    La descarga pasa por un .part oculto, reanudable con Range, que se renombra al final.
+    miss_cache: MissCache opcional; se consulta antes del request y registra los 404/500.
+    file_date: fecha del archivo, define la vigencia del fallo en la caché.
+    controller: AdaptiveConcurrency opcional; recibe la latencia y el tipo de fallo.
+    revalidate: si el archivo ya existe, consultar al servidor si cambió (request condicional).
+    breaker: CircuitBreaker opcional; con el circuito abierto no se envía el request.
+    coordinator: RunCoordinator opcional; la URL se reclama antes del request y, si otra
+                 ejecución sobre la misma raíz ya la sondea, se espera su resultado.
+    """
+    return _download_status(url, filename, save_dir, miss_cache=miss_cache, file_date=file_date,
+                            controller=controller, revalidate=revalidate, breaker=breaker,
+                            coordinator=coordinator) is not None
+
+def _download_status(url, filename, save_dir, miss_cache=None, file_date=None, controller=None, revalidate=False, breaker=None, coordinator=None):
+    """Como download_file, pero retorna STATUS_CACHED/DOWNLOADED/UPDATED/LINKED, o None si falló."""
+    status = _probe_status(url, filename, save_dir, miss_cache=miss_cache, file_date=file_date, controller=controller,
+                           revalidate=revalidate, breaker=breaker, coordinator=coordinator)
+    return None if status == _MISSED else status
+
+def _probe_status(url, filename, save_dir, miss_cache=None, file_date=None, controller=None, revalidate=False, breaker=None, coordinator=None):
+    """
+    Como _download_status, pero distingue los fallos: _MISSED si el archivo no existe
+    (respuesta del servidor, caché de fallos u otra ejecución) y None si no hubo respuesta
+    definitiva (error de red, timeout, circuito abierto).
+    """
     if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+        os.makedirs(save_dir, exist_ok=True)
 
     save_path = os.path.join(save_dir, filename)
+    part_path = _partial_path(save_path)
 
-    # Si el archivo ya existe (de una ejecución anterior o caché), no re-descargar
-    if os.path.exists(save_path) and os.path.getsize(save_path) > 0:
-        return True
+    # Si el archivo ya existe completo (de una ejecución anterior o caché), no re-descargar
+    if _is_cached(save_path):
+        if not revalidate:
+            return STATUS_CACHED
+        return _revalidate(url, save_path, part_path, controller, breaker)
 
+    # Otra raíz ya lo descargó: un enlace local en vez de un request
+    if _link_from_store(url, save_path):
+        return STATUS_LINKED
+
+    if miss_cache is not None and miss_cache.is_miss(url):
+        return _MISSED
+
+    if coordinator is None:
+        return _fetch_status(url, filename, save_path, part_path, miss_cache, file_date, controller, breaker)
+    # Otra ejecución en la misma raíz ya sondea (o sondeó) esta URL: se toma su resultado
+    shared = coordinator.claim(url)
+    if shared != CLAIM_OWN:
+        return STATUS_CACHED if shared == CLAIM_FOUND else _MISSED
+    status = None
     try:
-        resp = _https_pool.request('GET', url, preload_content=False, timeout=15)
-        if resp.status == 200:
-            with open(save_path, 'wb') as f:
-                for chunk in resp.stream(8192):
-                    f.write(chunk)
+        status = _fetch_status(url, filename, save_path, part_path, miss_cache, file_date, controller, breaker)
+    finally:
+        coordinator.finish(url, _claim_state(status))
+    return status
+
+def _claim_state(status):
+    """Resultado de un sondeo para el reclamo compartido (None = sin respuesta del servidor)."""
+    if status == _MISSED:
+        return CLAIM_MISSED
+    return CLAIM_FOUND if status is not None else None
+
+def _fetch_status(url, filename, save_path, part_path, miss_cache, file_date, controller, breaker):
+    """Request(s) de descarga de _download_status. Retorna un STATUS_*, _MISSED o None."""
+    # Dos intentos: si el servidor rechaza el Range (416) se repite desde cero
+    for _ in range(2):
+        if breaker is not None and not breaker.allow():
+            return None  # Circuito abierto: falla al instante, sin registrar en la caché de fallos
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        started = time.time()
+        try:
+            resp = _https_pool.request('GET', url, headers=headers, preload_content=False, timeout=15)
+            if breaker is not None:
+                breaker.record_success()
+            if controller is not None:
+                healthy = resp.status in (200, 206, 404, 416, 500)
+                controller.record(time.time() - started, None if healthy else f"HTTP {resp.status}")
+            resp_headers = {name.lower(): value for name, value in resp.headers.items()}
+            if resp.status == 416:
+                resp.release_conn()
+                total = _parse_content_range(resp_headers.get("content-range", ""))[1]
+                if total == offset and _finish_partial(part_path, save_path, total, url):
+                    print(f"¡Éxito! Guardado en: {save_path}")
+                    return STATUS_DOWNLOADED
+                _discard_partial(part_path)
+                continue
+            if resp.status in (200, 206):
+                # 206 continúa el .part; 200 (Range ignorado o sin .part) lo reescribe
+                resumed = resp.status == 206 and _parse_content_range(resp_headers.get("content-range", ""))[0] == offset
+                if resp.status == 206 and not resumed:
+                    resp.release_conn()
+                    _discard_partial(part_path)
+                    continue
+                expected = _expected_length(resp.status, resp_headers)
+                sniffer = _WorkbookSniffer(filename, _read_head(part_path) if resumed else b"")
+                try:
+                    with open(part_path, 'ab' if resumed else 'wb') as f:
+                        for chunk in resp.stream(8192):
+                            f.write(sniffer.feed(chunk))
+                    sniffer.finish()
+                except NotAWorkbookError:
+                    resp.drain_conn()  # La conexión vuelve al pool sin bytes pendientes
+                    raise
+                finally:
+                    resp.release_conn()
+                if not _finish_partial(part_path, save_path, expected, url, resp_headers):
+                    return None
+                print(f"¡Éxito! Guardado en: {save_path}" + (f" (reanudado desde {offset} bytes)" if resumed else ""))
+                return STATUS_DOWNLOADED
             resp.release_conn()
-            print(f"¡Éxito! Guardado en: {save_path}")
-            return True
-        resp.release_conn()
-        # 404 = archivo no existe (normal en brute-force)
-        # 500 = el nuevo API devuelve 500 cuando el blob no existe (en vez de 404)
-        if resp.status not in (404, 500):
-            print(f"[HTTP {resp.status}] {filename}")
+            # 404 = archivo no existe (normal en brute-force)
+            # 500 = el nuevo API devuelve 500 cuando el blob no existe (en vez de 404)
+            if resp.status not in (404, 500):
+                print(f"[HTTP {resp.status}] {filename}")
+            else:
+                if miss_cache is not None:
+                    miss_cache.record(url, file_date)
+                _discard_partial(part_path)
+                return _MISSED
+            return None
+        except NotAWorkbookError as e:
+            _reject_content(e, url, part_path, miss_cache, file_date)
+            return _MISSED
+        except Exception as e:
+            # El .part se conserva: la próxima ejecución lo continúa con Range
+            reason = _classify_request_error(e)
+            if breaker is None or not breaker.is_open:
+                print(f"Error general en {filename}: {e}")  # Con el circuito abierto ya se informó el corte
+            if controller is not None:
+                controller.record(time.time() - started, reason)
+            if breaker is not None:
+                breaker.record_failure(reason)
+            return None
+    return None
+
+def _revalidate(url, save_path, part_path, controller=None, breaker=None):
+    """
+    Request condicional para un archivo ya descargado. 304 (o cualquier fallo) lo deja
+    como está; 200 lo reemplaza de forma atómica. Retorna STATUS_CACHED o STATUS_UPDATED.
+    """
+    url, headers = _conditional_request(save_path, url)
+    if url is None:
+        return STATUS_CACHED  # Descargado antes de guardar validadores: nada que comparar
+    if breaker is not None and not breaker.allow():
+        return STATUS_CACHED
+    started = time.time()
+    try:
+        resp = _https_pool.request('GET', url, headers=headers, preload_content=False, timeout=15)
+        if breaker is not None:
+            breaker.record_success()
+        if controller is not None:
+            healthy = resp.status in (200, 304, 404, 500)
+            controller.record(time.time() - started, None if healthy else f"HTTP {resp.status}")
+        if resp.status != 200:
+            resp.release_conn()
+            return STATUS_CACHED
+        resp_headers = {name.lower(): value for name, value in resp.headers.items()}
+        sniffer = _WorkbookSniffer(os.path.basename(save_path))
         try:
-            if os.path.exists(save_path):
-                os.remove(save_path)
-        except OSError:
-            pass  # En Windows, otro hilo puede tener el archivo abierto (mismo path case-insensitive)
-        return False
+            with open(part_path, 'wb') as f:
+                for chunk in resp.stream(8192):
+                    f.write(sniffer.feed(chunk))
+            sniffer.finish()
+        except NotAWorkbookError:
+            resp.drain_conn()  # La conexión vuelve al pool sin bytes pendientes
+            raise
+        finally:
+            resp.release_conn()
+        if not _finish_partial(part_path, save_path, _expected_length(200, resp_headers), url, resp_headers):
+            _discard_partial(part_path)  # Sin Range en revalidación: el .part no se reanuda
+            return STATUS_CACHED
+        print(f"¡Actualizado! Nueva versión en: {save_path}")
+        return STATUS_UPDATED
+    except NotAWorkbookError as e:
+        # Se conserva la versión en disco, que sí es un libro
+        print(f"[RECHAZADO] {e}")
+        _discard_partial(part_path)
+        return STATUS_CACHED
     except Exception as e:
-        print(f"Error general en {filename}: {e}")
+        reason = _classify_request_error(e)
+        if breaker is None or not breaker.is_open:
+            print(f"Error revalidando {os.path.basename(save_path)}: {e}")
+        if controller is not None:
+            controller.record(time.time() - started, reason)
+        if breaker is not None:
+            breaker.record_failure(reason)
+        _discard_partial(part_path)
+        return STATUS_CACHED
+
+# --- VERIFICACIÓN PREVIA DEL PORTAL ---
+PREFLIGHT_TIMEOUT = 10
+PREFLIGHT_ATTEMPTS = 3
+
+def _known_good_url(root_dir, scheme_names=None):
+    """URL del archivo descargado más reciente (según el manifiesto), o None."""
+    if not manifest_xm.exists(root_dir):
+        return None
+    scheme_names = [name for name in scheme_names or ESQUEMAS.keys()
+                    if os.path.isdir(os.path.join(root_dir, name))]
+    for scheme_name in scheme_names:
+        _file_index(os.path.join(root_dir, scheme_name))  # Reconcilia la carpeta con el disco
+    row = manifest_xm.for_root(root_dir).latest_with_url(scheme_names)
+    return row["url"] if row else None
+
+def preflight_check(root_dir, scheme_names=None, attempts=PREFLIGHT_ATTEMPTS, timeout=PREFLIGHT_TIMEOUT):
+    """
+    Comprueba que el portal XM responde antes de lanzar miles de sondeos.
+    Pide el primer byte de un archivo que sabemos que existe (el último descargado) o, si no
+    hay ninguno, del endpoint. Cualquier respuesta HTTP prueba que el portal está arriba:
+    un archivo conocido que responde 404/500 puede haber sido republicado o retirado por
+    XM, así que solo se advierte en el detalle. ok es False únicamente ante fallos de red
+    (DNS, TLS, conexión, timeout) en todos los intentos.
+    Retorna: (ok, detalle)
+    """
+    known_url = _known_good_url(root_dir, scheme_names)
+    target = known_url or XM_API_URL
+    detail = ""
+    for attempt in range(attempts):
+        started = time.time()
         try:
-            if os.path.exists(save_path):
-                os.remove(save_path)
-        except OSError:
-            pass
-        return False
+            resp = _https_pool.request('GET', target, headers={'Range': 'bytes=0-0'}, preload_content=False,
+                                       timeout=timeout, retries=False)
+            resp.drain_conn()
+            resp.release_conn()
+            elapsed = time.time() - started
+            if known_url and resp.status not in (200, 206):
+                return True, (f"HTTP {resp.status} en {elapsed:.1f}s; [WARN] un archivo ya descargado ya no "
+                              f"responde 200 (¿republicado o retirado?): {known_url}")
+            return True, f"HTTP {resp.status} en {elapsed:.1f}s ({'archivo conocido' if known_url else 'endpoint'})"
+        except Exception as e:
+            detail = f"{_classify_request_error(e)}: {e}"
+            if attempt + 1 < attempts:
+                time.sleep(random.uniform(1, 2) * (2 ** attempt))
+    return False, detail
+
+def workbook_format(path):
+    """
+    Formato real ("xlsx" / "xls") de un libro: el anotado al descargarlo o, si no hay
+    (archivos de otras fuentes), leyendo sus primeros bytes. None si no es un libro.
+    """
+    folder, name = os.path.split(path)
+    index = _scheme_file_index(folder)
+    entry = (index.get(name) if index is not None else None) or {}
+    if entry.get("formato") and entry.get("bytes") == os.path.getsize(path):
+        return entry["formato"]
+    return sniff_format(_read_head(path))
+
+def read_archived(path):
+    """
+    Contenido de un libro compactado en su archivo mensual (ver archive_xm), o None si
+    path no está compactado.
+    """
+    folder, name = os.path.split(path)
+    index = _scheme_file_index(folder)
+    archive_path = index.archived(name) if index is not None else None
+    if archive_path is None:
+        return None
+    if not os.path.isfile(archive_path):
+        raise FileNotFoundError(f"{name}: su mes se retiró del disco (archive_xm --expire-months); la copia está en Drive")
+    with zipfile.ZipFile(archive_path) as archive:
+        return archive.read(name)
+
+def read_workbook(path, **kwargs):
+    """
+    pd.read_excel con el motor del formato real (sin reintentar con el otro motor).
+    Los libros de meses compactados se leen desde su archivo mensual, sin extraerlos.
+    Fuera de las carpetas de esquema (ej: el maestro) es una lectura directa del archivo.
+    """
+    if not os.path.exists(path):
+        data = read_archived(path)
+        if data is not None:
+            file_format = sniff_format(data[:SNIFF_BYTES])
+            if file_format is None:
+                raise NotAWorkbookError(f"{os.path.basename(path)}: contenido {_describe_content(data[:SNIFF_BYTES])}, no es un libro de Excel")
+            return pd.read_excel(io.BytesIO(data), engine=EXCEL_ENGINES[file_format], **kwargs)
+    file_format = workbook_format(path)
+    if file_format is None:
+        raise NotAWorkbookError(f"{os.path.basename(path)}: contenido {_describe_content(_read_head(path))}, no es un libro de Excel")
+    return pd.read_excel(path, engine=EXCEL_ENGINES[file_format], **kwargs)
+
+def _clean_paths(filepath):
+    """(ruta final, temporal) de la limpieza TIE de filepath: un .xls queda convertido a .xlsx."""
+    output_path = filepath
+    # Siempre intentamos guardar como xlsx moderno para evitar lios
+    if filepath.lower().endswith('.xls'):
+        output_path = filepath + "x"
+    # Temporal + os.replace: el original puede ser un enlace al almacén compartido
+    folder, name = os.path.split(output_path)
+    return output_path, os.path.join(folder, f".{os.path.splitext(name)[0]}.tmp.xlsx")
+
+def _apply_clean(filepath, result):
+    """
+    Deja en su lugar el libro limpio que workbook_xm.process_download escribió en el
+    temporal y actualiza el manifiesto. Retorna: (nuevo_path, error_msg)
+    """
+    output_path, tmp_path = _clean_paths(filepath)
+    if result["error"]:
+        _discard_partial(tmp_path)
+        if result["invalido"]:
+            return None, f"Error leyendo Excel ({result['error']})"
+        return None, result["error"]
+    os.replace(tmp_path, output_path)
+    _record_size(output_path, source=filepath)
+
+    if output_path != filepath:
+        try:
+            os.remove(filepath)
+            _forget_size(filepath)
+        except:
+            pass # Si no se puede borrar el viejo, no es crítico
+        print(f"Archivo actualizado a formato moderno: {output_path}")
+        return output_path, None
+
+    print("¡Archivo TIE procesado correctamente!")
+    return output_path, None
 
 def clean_tie_file(filepath):
     """
     Elimina la primera columna del archivo Excel dado (TIE).
-    Sobreescribe el archivo original.
+    Sobreescribe el archivo original (un .xls queda convertido a .xlsx).
+    El libro se lee una vez a memoria y se copia fila por fila sin la columna A a un
+    libro de escritura en streaming: una sola escritura en disco, ya en su forma final.
+    Corre en el hilo que la llama; PostProcessQueue hace lo mismo en otro proceso.
     Retorna: (nuevo_path, error_msg)
     """
-    if pd is None:
-        return None, "Librería pandas no instalada."
+    if openpyxl is None:
+        return None, "Librería openpyxl no instalada."
         
     try:
         print(f"Procesando TIE: Eliminando primera columna de {filepath}...")
-        
-        # Detectar motor según extensión
-        engine = 'openpyxl' if filepath.lower().endswith('.xlsx') else 'xlrd'
-        
-        # Leer archivo
-        try:
-            df = pd.read_excel(filepath, engine=engine)
-        except Exception as e_read:
-            # Fallback: intentar el otro motor si falló (a veces extensión miente)
-            alt_engine = 'xlrd' if engine == 'openpyxl' else 'openpyxl'
-            try:
-                print(f"Reintentando con motor alternativo {alt_engine}...")
-                df = pd.read_excel(filepath, engine=alt_engine)
-            except Exception as e_retry:
-                return None, f"Error leyendo Excel ({e_read}) | Retry ({e_retry})"
-
-        # Eliminar primera columna (index 0)
-        if not df.empty:
-            df.drop(df.columns[0], axis=1, inplace=True)
-        
-        # Guardar (sin index)
-        output_path = filepath
-        # Siempre intentamos guardar como xlsx moderno para evitar lios
-        if filepath.lower().endswith('.xls'):
-            output_path = filepath + "x" 
-            
-        df.to_excel(output_path, index=False)
-        
-        if output_path != filepath:
-            try:
-                os.remove(filepath)
-            except:
-                pass # Si no se puede borrar el viejo, no es crítico
-            print(f"Archivo actualizado a formato moderno: {output_path}")
-            return output_path, None
-            
-        print("¡Archivo TIE procesado correctamente!")
-        return output_path, None
+        result = workbook_xm.process_download(filepath, clean_to=_clean_paths(filepath)[1])
+        return _apply_clean(filepath, result)
         
     except Exception as e:
         print(f"Error procesando TIE: {e}")
@@ -274,12 +1746,12 @@ def read_maestro_file(filepath):
         # Leer sin cabecera asumiendo que la data empieza en row 1 (0-indexed) o row 2
         # Frecuentemente tienen encabezados. Intentaremos detectar.
         # Por seguridad leemos header=0.
-        df = pd.read_excel(filepath, header=None)
+        df = read_workbook(filepath, header=None)
         
         # Opcional: Si la primera fila parece texto de encabezado (ej: "CODIGO"), saltarla.
         # Una heurística simple: si la columna 0 de la row 0 es "CODIGO" o "CÓDIGO"
         if isinstance(df.iloc[0,0], str) and "CODIGO" in df.iloc[0,0].upper():
-            df = pd.read_excel(filepath, header=0)
+            df = read_workbook(filepath, header=0)
             # Re-leer con header, ahora las columnas tienen nombres, pero accedemos por iloc para ser agnósticos
         
         agentes = []
@@ -317,23 +1789,18 @@ def get_latest_balance_file(root_dir):
     if not os.path.exists(cuentas_dir):
         return {}, "No existe carpeta 'Cuentas'", None
 
-    files = [os.path.join(cuentas_dir, f) for f in os.listdir(cuentas_dir) 
-             if os.path.isfile(os.path.join(cuentas_dir, f)) and f.lower().endswith(('.xlsx', '.xls'))]
-    
-    if not files:
+    # El más reciente por fecha de modificación, consultado al manifiesto (sin listar la carpeta)
+    latest = _file_index(cuentas_dir).manifest.latest("Cuentas")
+    if latest is None:
         return {}, "No hay archivos en 'Cuentas'", None
-
-    # Ordenar por fecha de modificación (o nombre si tiene fecha)
-    # Asumimos modificación por simplicidad, o nombre si queremos ser estrictos con la fecha en nombre
-    latest_file = max(files, key=os.path.getmtime)
-    file_date = datetime.fromtimestamp(os.path.getmtime(latest_file)).strftime("%Y-%m-%d")
+    latest_file = os.path.join(cuentas_dir, latest["nombre"])
 
     if pd is None: return {}, "Pandas no instalado", latest_file
 
     try:
         # Leer archivo de saldos
         # Se asume estructura: Col B=Cuenta, Col J=Saldo (Index 1 y 9) según script original
-        df = pd.read_excel(latest_file)
+        df = read_workbook(latest_file)
         
         saldos = {}
         # Iterar. Es arriesgado confiar en índices fijos si el formato cambia, pero es lo que tenemos.
@@ -387,31 +1854,14 @@ def calculate_debt_for_agent(root_dir, agent, date_filter=None):
         if not os.path.exists(folder_path):
             continue
             
-        # Listar archivos
-        for fname in os.listdir(folder_path):
-            if not fname.lower().endswith(('.xlsx', '.xls')): continue
-            
-            # Extraer fecha del nombre para filtrar
-            # Reutilizamos lógica simple o regex
-            # Aquí haremos un parsing básico.
+        # Archivos desde date_filter (búsqueda binaria en el catálogo de la carpeta, con
+        # los nombres ya analizados); de BASE fecha y BASE fecha_V2 solo cuenta la última versión
+        for entry in folder_catalog(folder_path, folder_name).since(date_filter):
+            fname = entry.name
             try:
-                # Intento de heurística de fecha. 
-                # Si falla, asumimos que es reciente si la fecha de modificación es reciente?
-                # Mejor usar la fecha del archivo si es posible.
-                file_date = _extract_date_from_name(fname)
-                if not file_date:
-                    # Fallback: file mtime
-                    file_date = datetime.fromtimestamp(os.path.getmtime(os.path.join(folder_path, fname)))
-                
-                # Normalizar a media noche
-                file_date = file_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                if file_date < date_filter:
-                    continue
-
                 # Procesar archivo
                 fpath = os.path.join(folder_path, fname)
-                df = pd.read_excel(fpath) # Header 0 por defecto
+                df = read_workbook(fpath) # Header 0 por defecto
                 
                 # Buscar el Agente (Col 0 por defecto suele ser Código)
                 # TIE tiene estructura diferente (col 0 borrada, ahora col 0 es codigo?)
@@ -457,52 +1907,222 @@ def calculate_debt_for_agent(root_dir, agent, date_filter=None):
                 
     return total_debt, details
 
+# --- NOMBRES DE ARCHIVO ---
+# Un solo parser para todos los nombres del archivo: el formato de fecha del esquema
+# ("formato_fecha" en ESQUEMAS) primero y los demás como respaldo (archivos copiados a mano).
+# Las expresiones se compilan una vez y cada nombre se analiza una sola vez por proceso.
+MONTH_ABBREVIATIONS = {"ENE": 1, "FEB": 2, "MAR": 3, "ABR": 4, "MAY": 5, "JUN": 6,
+                       "JUL": 7, "AGO": 8, "SEP": 9, "OCT": 10, "NOV": 11, "DIC": 12,
+                       "JAN": 1, "APR": 4, "AUG": 8, "DEC": 12}  # Ingles/Español mix
+
+# Sin dígitos ni letras pegados: "MAR" no coincide dentro de "MARGEN" ni "12MARZO"
+_DATE_PATTERNS = {
+    "TEXTO": re.compile(r'(?<![0-9])(\d{1,2})(' + "|".join(MONTH_ABBREVIATIONS) + r')(?![A-Z])[- ]?(\d{4})(?![0-9])',
+                        re.IGNORECASE),  # 23ENE-2026
+    "NUMERICO": re.compile(r'(?<![0-9])(\d{2})-(\d{2})-(\d{4})(?![0-9])'),    # 23-01-2026
+    "ISO": re.compile(r'(?<![0-9])(\d{4})-(\d{2})-(\d{2})(?![0-9])'),         # 2026-01-23
+}
+_VERSION_SUFFIX_RE = re.compile(r'_V(\d+)$', re.IGNORECASE)
+
+# base: archivo base de ESQUEMAS (o None); date: datetime (o None); version: 1 = sin sufijo, 2 = _V2...
+ParsedName = namedtuple("ParsedName", ["base", "date", "version", "extension"])
+
+def _date_from_match(date_format, match):
+    try:
+        if date_format == "TEXTO":
+            return datetime(int(match.group(3)), MONTH_ABBREVIATIONS[match.group(2).upper()], int(match.group(1)))
+        if date_format == "NUMERICO":
+            return datetime(int(match.group(3)), int(match.group(2)), int(match.group(1)))
+        return datetime(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+    except ValueError:
+        return None  # Ej: 31FEB-2026
+
+def _parse_date(filename, date_format=None):
+    """Fecha de filename, probando primero date_format y después los demás formatos."""
+    formats = [date_format] if date_format in _DATE_PATTERNS else []
+    formats += [name for name in ("ISO", "TEXTO", "NUMERICO") if name != date_format]
+    for name in formats:
+        match = _DATE_PATTERNS[name].search(filename)
+        if match:
+            return _date_from_match(name, match)
+    return None
+
+@functools.lru_cache(maxsize=65536)
+def parse_scheme_filename(filename, scheme_name):
+    """ParsedName de filename según la configuración del esquema (resultado en caché)."""
+    stem, ext = os.path.splitext(filename)
+    version = _VERSION_SUFFIX_RE.search(stem)
+    config = ESQUEMAS.get(scheme_name, {})
+    return ParsedName(_match_file_base(filename, scheme_name) if scheme_name in ESQUEMAS else None,
+                      _parse_date(stem, config.get("formato_fecha", "TEXTO")),
+                      int(version.group(1)) if version else 1,
+                      ext.lower())
+
 def _extract_date_from_name(filename):
     """ Intenta extraer fecha de strings como 'GARANTIA 23ENE-2026.xlsx' o '2026-02-06' """
-    # Diccionario meses
-    meses = {"ENE":1, "FEB":2, "MAR":3, "ABR":4, "MAY":5, "JUN":6, 
-             "JUL":7, "AGO":8, "SEP":9, "OCT":10, "NOV":11, "DIC":12,
-             "JAN":1, "APR":4, "AUG":8, "DEC":12} # Ingles/Español mix
-    
-    filename = filename.upper()
-    try:
-        # ISO YYYY-MM-DD
-        import re
-        iso_match = re.search(r'(\d{4})-(\d{2})-(\d{2})', filename)
-        if iso_match:
-            return datetime(int(iso_match.group(1)), int(iso_match.group(2)), int(iso_match.group(3)))
-            
-        # Custom 23ENE-2026 (o similar)
-        # Buscamos combinaciones DDMMM
-        for mes, num in meses.items():
-            if mes in filename:
-                # Buscar dia antes
-                # Regex: (\d{1,2})MES
-                day_match = re.search(r'(\d{1,2})' + mes, filename)
-                year_match = re.search(r'(\d{4})', filename)
-                
-                if day_match and year_match:
-                    return datetime(int(year_match.group(0)), num, int(day_match.group(1)))
-    except:
-        return None
+    return _parse_date(filename)
+
+def _date_from_scheme_filename(filename, scheme_name):
+    """Fecha del nombre de archivo con el formato del esquema (ej: DD-MM-YYYY de TIE)."""
+    return parse_scheme_filename(filename, scheme_name).date
+
+@functools.lru_cache(maxsize=65536)
+def _match_file_base(filename, scheme_name):
+    """Archivo base de ESQUEMAS al que corresponde filename (prefijo más largo), o None."""
+    normalized = " ".join(filename.upper().split())
+    bases = sorted(ESQUEMAS[scheme_name]["archivos"], key=len, reverse=True)
+    for base in bases:
+        if normalized.startswith(base.upper()):
+            return base
     return None
 
-    return None 
+# --- CATÁLOGO POR CARPETA ---
+CatalogEntry = namedtuple("CatalogEntry", ["date", "base", "version", "name"])
 
-def download_scheme_range(start_date, end_date, scheme_name, root_dir, max_workers=20, callback_log=None):
+class FolderCatalog:
     """
-    Descarga archivos para un esquema en un rango de fechas.
-    callback_log: Función opcional para recibir mensajes de log (str).
-    Retorna: (archivos_descargados, total_dias)
+    Archivos de una carpeta de esquema ordenados por fecha, con el nombre ya analizado.
+    Sin fecha en el nombre se usa la de modificación. Las versiones de una misma
+    obligación (BASE fecha, BASE fecha_V2...) se colapsan en la más reciente.
     """
-    if scheme_name not in ESQUEMAS:
-        if callback_log: callback_log(f"[ERROR] Esquema '{scheme_name}' no existe.")
-        return 0, 0
-        
-    config = ESQUEMAS[scheme_name]
-    files_to_try = config["archivos"]
-    
-    # Crear carpeta
+
+    def __init__(self, scheme_name, rows):
+        """rows: [(nombre, mtime)] de la carpeta."""
+        latest = {}
+        for name, mtime in rows:
+            parsed = parse_scheme_filename(name, scheme_name)
+            file_date = parsed.date
+            if file_date is None:
+                if mtime is None:
+                    continue
+                file_date = datetime.fromtimestamp(mtime)
+            file_date = file_date.replace(hour=0, minute=0, second=0, microsecond=0)
+            # Sin archivo base conocido cada nombre es su propia obligación
+            key = (parsed.base or name.casefold(), file_date, parsed.extension != ".xls")
+            entry = CatalogEntry(file_date, parsed.base, parsed.version, name)
+            if key not in latest or entry.version > latest[key].version:
+                latest[key] = entry
+        # Un .xls convertido a .xlsx (TIE) es el mismo archivo: se queda el .xlsx
+        for (base, file_date, is_xlsx), entry in list(latest.items()):
+            if not is_xlsx and (base, file_date, True) in latest:
+                del latest[(base, file_date, is_xlsx)]
+        self.entries = sorted(latest.values(), key=lambda e: (e.date, e.base or "", e.name))
+        self._dates = [entry.date for entry in self.entries]
+
+    def since(self, date):
+        """Entradas con fecha >= date (búsqueda binaria)."""
+        return self.entries[bisect.bisect_left(self._dates, date.replace(hour=0, minute=0, second=0, microsecond=0)):]
+
+    def between(self, start_date, end_date):
+        """Entradas con fecha en [start_date, end_date]."""
+        return self.entries[bisect.bisect_left(self._dates, start_date):bisect.bisect_right(self._dates, end_date)]
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def folder_catalog(folder, scheme_name=None):
+    """
+    Catálogo de folder (esquema = nombre de la carpeta si no se da). Se reconstruye solo
+    si la carpeta cambió (mtime del directorio) desde la última vez.
+    """
+    key = os.path.abspath(folder)
+    scheme_name = scheme_name or os.path.basename(key)
+    try:
+        token = os.path.getmtime(key)
+    except OSError:
+        return FolderCatalog(scheme_name, [])
+    with _catalogs_lock:
+        cached = _catalogs.get(key)
+        if cached is not None and cached[0] == token:
+            return cached[1]
+    index = _file_index(key)
+    index.names(refresh=True)  # Reconcilia el manifiesto con la carpeta
+    catalog = FolderCatalog(scheme_name, [(row["nombre"], row["mtime"]) for row in index.manifest.rows(index.carpeta)])
+    with _catalogs_lock:
+        _catalogs[key] = (token, catalog)
+    return catalog
+
+# --- CALENDARIO DE PUBLICACIÓN APRENDIDO ---
+# La mayoría de fechas de la ventana de run_daily nunca reciben archivo (Semanal sale ciertos
+# días de la semana, Cuentas en días hábiles, TIE con fecha adelantada) y cada fallo cuesta ~6s.
+# El archivo local ya muestra en qué días aparece cada (esquema, archivo base).
+CALENDAR_MIN_SAMPLES = 8      # Con menos archivos observados no se descarta nada
+CALENDAR_SMOOTHING = 0.5      # Suavizado para días de la semana nunca vistos
+CALENDAR_LEAD_MARGIN_DAYS = 3 # Días extra sobre la máxima anticipación observada
+DEFAULT_MIN_SCORE = 0.05      # Claves con puntaje menor se omiten (0 = no omitir nada)
+
+def calendar_may_skip(scheme_name):
+    """
+    True si el calendario puede descartar fechas del esquema (puntaje bajo min_score).
+    En los esquemas "critico" solo ordena: un día de la semana raro (ej: Semanal corrido
+    por un festivo) queda bajo el umbral y, como nunca se sondea, nunca se aprende.
+    """
+    return not ESQUEMAS.get(scheme_name, {}).get("critico")
+
+class PublicationCalendar:
+    """
+    Modelo de publicación aprendido del archivo local (root_dir/<esquema>).
+    Para cada (esquema, archivo base) cuenta en qué días de la semana hay archivos y con
+    cuántos días de anticipación aparecieron (fecha del nombre - fecha de modificación).
+    score() retorna 0..1; 1.0 significa "sin datos suficientes, sondear normalmente".
+    """
+
+    def __init__(self, min_samples=CALENDAR_MIN_SAMPLES, smoothing=CALENDAR_SMOOTHING,
+                 lead_margin_days=CALENDAR_LEAD_MARGIN_DAYS):
+        self.min_samples = min_samples
+        self.smoothing = smoothing
+        self.lead_margin_days = lead_margin_days
+        self._weekdays = {}  # (esquema, base) -> [conteo lunes..domingo]
+        self._leads = {}     # (esquema, base) -> anticipación máxima observada (días)
+        self._samples = {}   # (esquema, base) -> archivos observados
+
+    @classmethod
+    def from_archive(cls, root_dir, scheme_names=None, **kwargs):
+        """Construye el modelo recorriendo root_dir/<esquema> (una vez por ejecución)."""
+        model = cls(**kwargs)
+        for scheme_name in scheme_names or ESQUEMAS.keys():
+            folder = os.path.join(root_dir, scheme_name)
+            if not os.path.isdir(folder):
+                continue
+            # Fecha, archivo base y fecha de modificación ya están en el manifiesto
+            for row in _file_index(folder).manifest.rows(scheme_name):
+                if row["base"] is None or row["fecha"] is None:
+                    continue
+                file_base = row["base"]
+                file_date = datetime.strptime(row["fecha"], "%Y-%m-%d")
+                seen = datetime.fromtimestamp(row["mtime"]) if row["mtime"] is not None else None
+                model.add(scheme_name, file_base, file_date, seen)
+        return model
+
+    def add(self, scheme_name, file_base, file_date, seen_date=None):
+        key = (scheme_name, file_base)
+        self._weekdays.setdefault(key, [0] * 7)[file_date.weekday()] += 1
+        self._samples[key] = self._samples.get(key, 0) + 1
+        if seen_date is not None:
+            lead = (file_date.date() - seen_date.date()).days
+            self._leads[key] = max(self._leads.get(key, lead), lead)
+
+    def samples(self, scheme_name, file_base):
+        return self._samples.get((scheme_name, file_base), 0)
+
+    def score(self, scheme_name, file_base, date_obj, today=None):
+        """Probabilidad relativa (0..1) de que exista archivo para esa fecha."""
+        key = (scheme_name, file_base)
+        if self._samples.get(key, 0) < self.min_samples:
+            return 1.0
+        counts = self._weekdays[key]
+        score = (counts[date_obj.weekday()] + self.smoothing) / (max(counts) + self.smoothing)
+
+        # Fechas más adelantadas que cualquier publicación vista: casi seguro aún no existen
+        today = (today or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+        days_ahead = (date_obj.replace(hour=0, minute=0, second=0, microsecond=0) - today).days
+        max_lead = self._leads.get(key)
+        if days_ahead > 0 and max_lead is not None and days_ahead > max(max_lead, 0) + self.lead_margin_days:
+            score *= 0.1
+        return min(score, 1.0)
+
+def _prepare_scheme_folder(root_dir, scheme_name, callback_log=None):
+    """Crea root_dir/scheme_name si no existe. Retorna la ruta o None si falló."""
     scheme_folder = os.path.join(root_dir, scheme_name)
     if not os.path.exists(scheme_folder):
         try:
@@ -510,92 +2130,969 @@ def download_scheme_range(start_date, end_date, scheme_name, root_dir, max_worke
             if callback_log: callback_log(f"Creada carpeta: {scheme_folder}")
         except OSError as e:
             if callback_log: callback_log(f"[ERROR] No se pudo crear carpeta: {e}")
-            return 0, 0
-            
-    if callback_log: callback_log(f"--- Iniciando Descarga Automática: {scheme_name} ---")
-    if callback_log: callback_log(f"Rango: {start_date.strftime('%Y-%m-%d')} a {end_date.strftime('%Y-%m-%d')}")
-    
-    tasks = []
-    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-
-    # Dos niveles de búsqueda para equilibrar cobertura vs. velocidad:
-    # - Fechas recientes (hasta hoy): todas las variaciones de nombre/extensión/versión,
-    #   porque XM puede publicar con errores de nombrado que ya conocemos.
-    # - Fechas futuras (mañana en adelante): solo nombre canónico + extensiones comunes,
-    #   sin variantes de espacios ni _V2. Ahorra requests vs. búsqueda completa.
-    #   IMPORTANTE: incluir .xls porque archivos TIE son siempre publicados con fecha
-    #   futura (ej: archivo del lunes se publica el jueves anterior) y pueden llegar en
-    #   formato .xls (Excel 97-2003).
-    versions_full     = ["", "_V2"]
-    extensions_full   = [".xlsx", ".XLSX", ".xls", ".XLS"]
-    versions_future   = [""]
-    extensions_future = [".xlsx", ".XLSX", ".xls", ".XLS"]
-
-    current_date = start_date
-    delta = timedelta(days=1)
-    days_count = 0
-
-    while current_date <= end_date:
-        days_count += 1
-        is_future = current_date > today
-
-        if is_future:
-            # Fecha futura: mínimas combinaciones (archivo no publicado aún)
+            return None
+    return scheme_folder
+
+# --- PLAN DE SONDEO ---
+# Representación intermedia compartida por run_daily, la GUI y ambos motores: qué URLs se
+# sondean, en qué orden y cuánto costaría, antes de enviar un solo request.
+ESTIMATED_PROBE_SECONDS = 6.0  # Latencia típica de un 404/500 en el API nuevo
+
+Probe = namedtuple("Probe", ["url", "filename", "scheme_folder", "scheme", "file_date"])
+
+# Prioridad de negocio de cada escalera (menor = antes). Con plazo límite, lo que no se
+# alcanza a ejecutar es siempre lo menos valioso.
+TIER_CRITICAL = 0     # Esquemas "critico" con fecha de hoy o del siguiente día hábil
+TIER_RECENT = 1       # Fechas pasadas o de hoy: publicadas con alta probabilidad
+TIER_NEAR_FUTURE = 2  # Hasta NEAR_FUTURE_DAYS adelante
+TIER_SPECULATIVE = 3  # Futuro lejano: sondeo especulativo
+NEAR_FUTURE_DAYS = 3
+
+def _next_business_day(day):
+    """Siguiente día hábil (lunes a viernes; no conoce festivos)."""
+    day += timedelta(days=1)
+    while day.weekday() >= 5:
+        day += timedelta(days=1)
+    return day
+
+def ladder_tier(probe, today=None):
+    """Nivel de prioridad (TIER_*) de una escalera según su primer Probe."""
+    today = (today or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    file_day = probe.file_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    if ESQUEMAS.get(probe.scheme, {}).get("critico") and file_day in (today, _next_business_day(today)):
+        return TIER_CRITICAL
+    days_ahead = (file_day - today).days
+    if days_ahead <= 0:
+        return TIER_RECENT
+    if days_ahead <= NEAR_FUTURE_DAYS:
+        return TIER_NEAR_FUTURE
+    return TIER_SPECULATIVE
+
+# Reparto del plan en N shards (procesos o máquinas) por (esquema, fecha, archivo base).
+# Se usa crc32 y no hash(): debe dar lo mismo en todas las máquinas y ejecuciones.
+def parse_shard(text):
+    """'i/N' (1 <= i <= N) -> (i, N). Lanza ValueError si el formato no es válido."""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except (AttributeError, ValueError):
+        raise ValueError(f"Shard inválido: {text!r} (se espera i/N, ej: 2/4)")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Shard inválido: {text!r} (i debe estar entre 1 y N)")
+    return index, count
+
+def shard_of(scheme_name, file_date, file_base, count):
+    """Shard (1..count) al que pertenece la clave (esquema, fecha, archivo base)."""
+    key = f"{scheme_name}|{file_date.strftime('%Y-%m-%d')}|{file_base}"
+    return zlib.crc32(key.encode("utf-8")) % count + 1
+
+# Registro de qué patrones de nombre aciertan realmente, por esquema, en
+# <root>/.xm_patrones.json: sirve para ajustar "sondeo" en ESQUEMAS con datos.
+PATTERNS_FILENAME = ".xm_patrones.json"
+
+def probe_pattern(scheme_name, file_base, filename):
+    """Patrón de un nombre publicado, ej: "canonico|_V2|.xlsx"; None si no se reconoce."""
+    stem, ext = os.path.splitext(filename)
+    match = _VERSION_SUFFIX_RE.search(stem)
+    version = match.group(0).upper() if match else ""
+    separator = ESQUEMAS.get(scheme_name, {}).get("separador", " ")
+    for name, transform in NAME_VARIANTS.items():
+        prefix = transform(file_base) + separator
+        # "BASE  fecha" es espacio_final, no canónico seguido de un espacio de más
+        if filename.startswith(prefix) and not filename[len(prefix):len(prefix) + 1].isspace():
+            return f"{name}|{version}|{ext}"
+    return None
+
+class PatternLog:
+    """{esquema: {patrón: {"aciertos": n, "ultimo": "YYYY-MM-DD", "ejemplo": nombre}}}."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.patterns = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.patterns = json.load(f)
+            except (OSError, ValueError):
+                self.patterns = {}
+
+    @classmethod
+    def for_root(cls, root_dir):
+        return cls(os.path.join(root_dir, PATTERNS_FILENAME))
+
+    def record(self, scheme_name, filename):
+        """Anota un acierto. Retorna el patrón si es la primera vez que se ve en el esquema."""
+        file_base = _match_file_base(filename, scheme_name)
+        pattern = probe_pattern(scheme_name, file_base, filename) if file_base else None
+        if pattern is None:
+            return None
+        with self._lock:
+            by_scheme = self.patterns.setdefault(scheme_name, {})
+            is_new = pattern not in by_scheme
+            entry = by_scheme.setdefault(pattern, {"aciertos": 0})
+            entry["aciertos"] += 1
+            entry["ultimo"] = datetime.now().strftime("%Y-%m-%d")
+            entry["ejemplo"] = filename
+        return pattern if is_new else None
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with self._lock:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.patterns, f, indent=1, sort_keys=True, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Advertencia: no se pudo guardar el registro de patrones: {e}")
+
+class ProbePlan:
+    """
+    Plan de sondeo para varios esquemas y un rango de fechas.
+    Genera de forma perezosa escaleras de Probe (una por archivo base, fecha y versión),
+    sin URLs repetidas y con el archivo local ya existente como primer paso.
+    files: {esquema: [archivos base]} para restringir la búsqueda (ej: la GUI); por defecto
+    se usan todos los "archivos" de ESQUEMAS.
+    discovered: {(esquema, archivo base, fecha, versión): (url, nombre)} con los archivos
+    encontrados en las páginas de XM (ver extract_xm_links.discover). Esas claves sondean
+    primero la URL exacta y, si falla (enlace viejo o archivo renombrado), siguen con la
+    escalera normal de variantes.
+    shard: (i, N) de parse_shard; solo se generan las claves de ese shard (ver shard_of).
+    windows: {esquema: (inicio, fin)} que reemplaza start_date/end_date para ese esquema
+    (ej: probe_window en run_daily). Las variantes de nombre, versiones, extensiones y si
+    se admiten fechas futuras salen siempre de probe_policy.
+    """
+
+    def __init__(self, start_date, end_date, scheme_names, root_dir, files=None,
+                 miss_cache=None, calendar=None, min_score=0.0, discovered=None, shard=None,
+                 windows=None):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.windows = windows or {}
+        self.scheme_names = [name for name in scheme_names if name in ESQUEMAS]
+        self.unknown_schemes = [name for name in scheme_names if name not in ESQUEMAS]
+        self.root_dir = root_dir
+        self.files = files or {}
+        self.miss_cache = miss_cache
+        self.calendar = calendar
+        self.min_score = min_score
+        self.discovered = discovered or {}
+        self.shard = shard
+        # (esquema, base, fecha) -> versiones descubiertas (ej: un _V2 con fecha futura)
+        self._discovered_versions = {}
+        for scheme_name, file_base, file_date, ver in self.discovered:
+            self._discovered_versions.setdefault((scheme_name, file_base, file_date), []).append(ver)
+        self.stats = {}
+        self._local_names = {}
+        self._policies = {name: probe_policy(name) for name in self.scheme_names}
+
+    def scheme_folder(self, scheme_name):
+        return os.path.join(self.root_dir, scheme_name)
+
+    def scheme_range(self, scheme_name):
+        """(inicio, fin) de fechas a sondear para el esquema."""
+        return self.windows.get(scheme_name, (self.start_date, self.end_date))
+
+    def days_count(self, scheme_name=None):
+        start_date, end_date = self.scheme_range(scheme_name) if scheme_name else (self.start_date, self.end_date)
+        return max((end_date - start_date).days + 1, 0)
+
+    def _local_index(self, scheme_name):
+        """{nombre.casefold(): nombre real} de la carpeta del esquema (según el manifiesto)."""
+        if scheme_name not in self._local_names:
+            folder = self.scheme_folder(scheme_name)
+            # En Windows ".xlsx" y ".XLSX" son el mismo archivo: comparar sin mayúsculas.
+            # refresh: otro proceso pudo descargar desde el último plan (ej: ciclos de vigilancia)
+            self._local_names[scheme_name] = _file_index(folder).names(refresh=True) if os.path.isdir(folder) else {}
+        return self._local_names[scheme_name]
+
+    def _variant_space(self, scheme_name, file_base, is_future):
+        """
+        (versiones, versiones ampliadas, combinaciones canónicas, combinaciones ampliadas).
+        Las combinaciones son (patrón, variante del nombre, extensión), sin repetidos.
+        """
+        tier = self._policies[scheme_name]["futuro" if is_future else "pasado"]
+        expanded = tier.get("ampliado") or {}
+        names = tier["nombres"]
+        extensions = tier["extensiones"]
+        all_names = names + [n for n in expanded.get("nombres", []) if n not in names]
+        all_extensions = extensions + [e for e in expanded.get("extensiones", []) if e not in extensions]
+
+        canonical, extra, seen = [], [], set()
+        for name in all_names:
+            variant = NAME_VARIANTS[name](file_base)
+            for ext in all_extensions:
+                if (variant, ext) in seen:
+                    continue
+                seen.add((variant, ext))
+                target = canonical if name in names and ext in extensions else extra
+                target.append((f"{name}{ext}", variant, ext))
+        extra_versions = [v for v in expanded.get("versiones", []) if v not in tier["versiones"]]
+        return tier["versiones"], extra_versions, canonical, extra
+
+    def _new_stats(self, scheme_name=None):
+        return {"dias": self.days_count(scheme_name), "claves": 0, "politica": 0, "escaleras": 0, "sondeos": 0,
+                "locales": 0, "cache": 0, "calendario": 0, "duplicados": 0, "descubiertos": 0,
+                "otro_shard": 0, "ampliados": 0}
+
+    def iter_scheme_ladders(self, scheme_name, ordered=True):
+        """
+        Escaleras de un esquema. ordered=True las entrega de más a menos probable según el
+        calendario (materializa el esquema); ordered=False las genera fecha por fecha.
+        """
+        stats = self.stats[scheme_name] = self._new_stats(scheme_name)
+        generator = self._generate(scheme_name, stats)
+        if not ordered:
+            for _, ladder in generator:
+                yield ladder
+            return
+        # Primero por prioridad de negocio, luego por puntaje del calendario.
+        # Orden estable: a igual nivel y puntaje se mantiene el orden por fecha
+        today = datetime.now()
+        for _, ladder in sorted(generator, key=lambda item: (ladder_tier(item[1][0], today), -item[0])):
+            yield ladder
+
+    def day_ladders(self, scheme_name, day):
+        """Escaleras de un esquema para un solo día (para recorrer rangos largos de a poco)."""
+        stats = self.stats.setdefault(scheme_name, self._new_stats(scheme_name))
+        return [ladder for _, ladder in self._generate(scheme_name, stats, day, day)]
+
+    def _generate(self, scheme_name, stats, start_date=None, end_date=None):
+        files_to_try = self.files.get(scheme_name) or ESQUEMAS[scheme_name]["archivos"]
+        scheme_folder = self.scheme_folder(scheme_name)
+        local = self._local_index(scheme_name)
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        allow_future = self._policies[scheme_name]["fechas_futuras"]
+        scheme_start, scheme_end = self.scheme_range(scheme_name)
+
+        current_date = max(start_date or scheme_start, scheme_start)
+        while current_date <= min(end_date or scheme_end, scheme_end):
+            # Comparar solo la fecha: "hoy" con hora (ej: datetime.now()) no es futuro
+            is_future = current_date.replace(hour=0, minute=0, second=0, microsecond=0) > today
+            if is_future and not allow_future:
+                stats["politica"] += len(files_to_try)
+                current_date += timedelta(days=1)
+                continue
             for file_base in files_to_try:
-                for ver in versions_future:
-                    for ext in extensions_future:
-                        url, filename = get_xm_url(file_base, current_date, esquema_nombre=scheme_name, version_suffix=ver, extension=ext)
-                        tasks.append((url, filename, scheme_folder, scheme_name))
+                if self.shard and shard_of(scheme_name, current_date, file_base, self.shard[1]) != self.shard[0]:
+                    stats["otro_shard"] += 1
+                    continue
+                stats["claves"] += 1
+                found_versions = self._discovered_versions.get((scheme_name, file_base, current_date.date()), [])
+                score = self.calendar.score(scheme_name, file_base, current_date, today) if self.calendar else 1.0
+                if score < self.min_score and not found_versions and calendar_may_skip(scheme_name):
+                    stats["calendario"] += 1
+                    continue
+
+                versions, extra_versions, canonical, extra = self._variant_space(scheme_name, file_base, is_future)
+                # Clave que debería existir: si lo canónico falla, vale la pena lo ampliado
+                expected = not is_future and score >= EXPANDED_MIN_SCORE
+                if expected:
+                    versions = versions + extra_versions
+                # Una escalera por versión: "_V2" sigue buscando aunque el archivo base ya exista
+                for ver in versions + [v for v in found_versions if v not in versions]:
+                    ladder, seen_urls, local_probe, key_score = [], set(), None, score
+                    found = self.discovered.get((scheme_name, file_base, current_date.date(), ver))
+                    if found is not None:
+                        # Publicado según la página de XM: nombre exacto, sin caché de fallos
+                        url, filename = found
+                        local_name = local.get(filename.casefold())
+                        stats["descubiertos"] += 1
+                        if local_name is not None:
+                            stats["locales"] += 1
+                            stats["escaleras"] += 1
+                            yield 1.0, [Probe(url, local_name, scheme_folder, scheme_name, current_date)]
+                            continue
+                        # Primer paso; si el enlace ya no responde, sigue la escalera normal
+                        ladder.append(Probe(url, filename, scheme_folder, scheme_name, current_date))
+                        seen_urls.add(url)
+                        key_score = 1.0
+                    # Las versiones ampliadas (ej: _V3) solo prueban las combinaciones canónicas
+                    combos = canonical if ver in extra_versions else canonical + extra
+                    for index, (_, variant, ext) in enumerate(combos):
+                        url, filename = get_xm_url(variant, current_date, esquema_nombre=scheme_name, version_suffix=ver, extension=ext)
+                        if url in seen_urls:
+                            stats["duplicados"] += 1
+                            continue
+                        seen_urls.add(url)
+                        local_name = local.get(filename.casefold())
+                        if local_name is not None and local_probe is None:
+                            # Ya descargado (quizá con otra capitalización): resuelve sin red
+                            local_probe = Probe(url, local_name, scheme_folder, scheme_name, current_date)
+                            continue
+                        if index >= len(canonical) and not expected:
+                            continue  # Nivel ampliado: solo para claves que deberían existir
+                        if self.miss_cache is not None and self.miss_cache.is_miss(url):
+                            stats["cache"] += 1
+                            continue
+                        if index >= len(canonical):
+                            stats["ampliados"] += 1
+                        ladder.append(Probe(url, filename, scheme_folder, scheme_name, current_date))
+                    if local_probe is not None:
+                        stats["locales"] += 1
+                        ladder.insert(0, local_probe)
+                    if ladder:
+                        stats["escaleras"] += 1
+                        stats["sondeos"] += len(ladder) if local_probe is None else 0
+                        yield key_score, ladder
+            current_date += timedelta(days=1)
+
+    def watch_ladder(self, scheme_name, file_base, day):
+        """
+        Escalera mínima para el modo vigilancia (watch_xm.py): versión base y solo las
+        combinaciones canónicas, sin caché de fallos. None si el archivo ya está en disco.
+        """
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        is_future = day.replace(hour=0, minute=0, second=0, microsecond=0) > today
+        _, _, canonical, extra = self._variant_space(scheme_name, file_base, is_future)
+        local = self._local_index(scheme_name)
+        ladder = []
+        for index, (_, variant, ext) in enumerate(canonical + extra):
+            url, filename = get_xm_url(variant, day, esquema_nombre=scheme_name, extension=ext)
+            if filename.casefold() in local:
+                return None
+            if index < len(canonical):
+                ladder.append(Probe(url, filename, self.scheme_folder(scheme_name), scheme_name, day))
+        return ladder
+
+    def iter_ladders(self, ordered=True):
+        """Escaleras de todos los esquemas, esquema por esquema."""
+        for scheme_name in self.scheme_names:
+            yield from self.iter_scheme_ladders(scheme_name, ordered)
+
+    def estimate(self, concurrency, probe_seconds=ESTIMATED_PROBE_SECONDS, ladders=None):
+        """
+        Recorre el plan sin tocar la red. Retorna líneas de texto con, por esquema, los
+        requests mínimos (un acierto al primer intento por escalera) y máximos (todo falla),
+        y el tiempo estimado con la concurrencia dada.
+        ladders: {esquema: escaleras ya generadas con iter_scheme_ladders} para estimar sin
+        volver a generar el plan (ni sumar dos veces las omisiones de stats y la caché).
+        """
+        lines = []
+        total_min = total_max = 0
+        for scheme_name in self.scheme_names:
+            if ladders is not None and scheme_name in ladders:
+                scheme_ladders = ladders[scheme_name]
+            else:
+                scheme_ladders = list(self.iter_scheme_ladders(scheme_name, ordered=False))
+            stats = self.stats[scheme_name]
+            network = [ladder for ladder in scheme_ladders if ladder[0].filename.casefold() not in self._local_index(scheme_name)]
+            req_min, req_max = len(network), stats["sondeos"]
+            total_min += req_min
+            total_max += req_max
+            lines.append(
+                f"{scheme_name}: {stats['dias']} días, {stats['claves']} claves, {stats['escaleras']} escaleras "
+                f"({stats['locales']} ya en disco, {stats['descubiertos']} descubiertas), requests {req_min}-{req_max} "
+                f"({stats['ampliados']} de variantes ampliadas) "
+                f"[omitidos: caché {stats['cache']}, calendario {stats['calendario']}, política {stats['politica']}, "
+                f"duplicados {stats['duplicados']}"
+                + (f", otros shards {stats['otro_shard']}" if self.shard else "") + "]")
+        seconds_min = total_min * probe_seconds / max(concurrency, 1)
+        seconds_max = total_max * probe_seconds / max(concurrency, 1)
+        lines.append(f"TOTAL: requests {total_min}-{total_max}; tiempo estimado "
+                     f"{seconds_min / 60:.1f}-{seconds_max / 60:.1f} min con {concurrency} sondeos simultáneos "
+                     f"(~{probe_seconds:.0f}s por request)")
+        return lines
+
+def download_scheme_range(start_date, end_date, scheme_name, root_dir, max_workers=20, callback_log=None, miss_cache=None, controller=None, calendar=None, min_score=DEFAULT_MIN_SCORE, discovered=None, revalidate_days=DEFAULT_REVALIDATE_DAYS, breaker=None, deadline=None):
+    """
+    Descarga archivos para un esquema en un rango de fechas.
+    callback_log: Función opcional para recibir mensajes de log (str).
+    miss_cache: MissCache opcional. Si es None se usa la caché persistente de root_dir.
+    controller: AdaptiveConcurrency opcional. Si se da, fija los sondeos en vuelo
+                (max_workers se ignora) y se ajusta según las respuestas del servidor.
+    calendar: PublicationCalendar opcional. Si es None se aprende del archivo de root_dir.
+    min_score: umbral del calendario; fechas con menor puntaje no se sondean (0 = todas).
+               No aplica a los esquemas "critico" (ver calendar_may_skip).
+    discovered: archivos encontrados en las páginas de XM (ver ProbePlan).
+    revalidate_days: archivos ya descargados con fecha desde hoy - N días se revalidan con
+                     un request condicional (ETag / Last-Modified); 0 = no revalidar.
+    breaker: CircuitBreaker opcional, compartido entre llamadas; si es None se crea uno
+             para esta llamada.
+    deadline: hora límite (time.time()) de la ejecución; lo pendiente al llegar se descarta
+              y se informa. El orden de la cola (ladder_tier) asegura que lo descartado sea
+              lo menos valioso.
+    Retorna: (archivos_descargados, total_dias)
+    """
+    results = download_schemes_range(start_date, end_date, [scheme_name], root_dir, max_workers=max_workers,
+                                     callback_log=callback_log, miss_cache=miss_cache, controller=controller,
+                                     calendar=calendar, min_score=min_score, discovered=discovered,
+                                     revalidate_days=revalidate_days, breaker=breaker, deadline=deadline)
+    return results.get(scheme_name, (0, 0))
+
+def download_schemes_range(start_date, end_date, scheme_names, root_dir, max_workers=20, callback_log=None, miss_cache=None, controller=None, weights=None, calendar=None, min_score=DEFAULT_MIN_SCORE, discovered=None, revalidate_days=DEFAULT_REVALIDATE_DAYS, breaker=None, deadline=None, shard=None, on_file=None, windows=None, coordinator=None):
+    """
+    Descarga varios esquemas con una sola cola de trabajo compartida: los sondeos de todos
+    los esquemas comparten el mismo pool, así la cola lenta de uno se solapa con el resto.
+    weights: {esquema: peso} para el reparto de workers; por defecto "prioridad" de ESQUEMAS.
+    calendar / min_score / discovered / revalidate_days / breaker / deadline: ver download_scheme_range.
+    shard: (i, N) de parse_shard; solo se sondean las claves de ese shard.
+    on_file: función opcional on_file(task, msg) por cada archivo obtenido (nuevo o ya en disco).
+    windows: {esquema: (inicio, fin)} por esquema (ver probe_window); reemplaza el rango dado.
+    coordinator: RunCoordinator ya adquirido; si es None se toma un arriendo sobre root_dir
+                 durante la llamada (otras ejecuciones en la misma raíz no repiten sondeos).
+    Retorna: {esquema: (archivos_descargados, total_dias)}
+    """
+    if coordinator is None:
+        with RunCoordinator(root_dir, callback_log, defer=True) as coordinator:
+            return download_schemes_range(start_date, end_date, scheme_names, root_dir, max_workers=max_workers,
+                                          callback_log=callback_log, miss_cache=miss_cache, controller=controller,
+                                          weights=weights, calendar=calendar, min_score=min_score,
+                                          discovered=discovered, revalidate_days=revalidate_days, breaker=breaker,
+                                          deadline=deadline, shard=shard, on_file=on_file, windows=windows,
+                                          coordinator=coordinator)
+
+    owns_cache = miss_cache is None
+    if owns_cache:
+        miss_cache = MissCache.for_root(root_dir)
+    if calendar is None:
+        calendar = PublicationCalendar.from_archive(root_dir, scheme_names)
+    if breaker is None:
+        breaker = CircuitBreaker(callback_log=callback_log)
+
+    plan = ProbePlan(start_date, end_date, scheme_names, root_dir, miss_cache=miss_cache,
+                     calendar=calendar, min_score=min_score, discovered=discovered, shard=shard,
+                     windows=windows)
+    patterns = PatternLog.for_root(root_dir)
+    run = _MultiSchemeRun(callback_log, on_file=on_file, patterns=patterns)
+    ladders = run.plan(plan)
+
+    # Etapa de CPU (limpieza TIE) en procesos propios: los hilos de descarga no la esperan
+    with PostProcessQueue(callback_log) as post_processor:
+        for scheme_name in plan.scheme_names:
+            post_processor.resume(plan.scheme_folder(scheme_name), scheme_name)
+        worker = lambda *task: _download_worker_wrapper(*task, miss_cache=miss_cache, controller=controller,
+                                                        revalidate_days=revalidate_days, breaker=breaker,
+                                                        coordinator=coordinator, post_processor=post_processor)
+        _run_probe_ladders(ladders, worker, max_workers, run.on_result, controller=controller,
+                           weights=weights, on_ladder_done=run.on_ladder_done, breaker=breaker,
+                           deadline=deadline, on_dropped=run.on_dropped)
+    run.report_dropped()
+    patterns.save()
+
+    if owns_cache:
+        miss_cache.save()
+    return run.results()
+
+def _scheme_weights(weights=None):
+    """Pesos de reparto por esquema: los dados o la "prioridad" declarada en ESQUEMAS."""
+    merged = {name: config.get("prioridad", 1) for name, config in ESQUEMAS.items()}
+    merged.update(weights or {})
+    return merged
+
+class _MultiSchemeRun:
+    """
+    Planificación, contadores y mensajes de log por esquema de una ejecución.
+    Compartido por el motor de hilos y el de asyncio para que ambos reporten igual.
+    """
+
+    def __init__(self, callback_log=None, on_file=None, patterns=None):
+        self.callback_log = callback_log
+        self.on_file = on_file
+        self.patterns = patterns
+        self.found = {}
+        self.days = {}
+        self.open_ladders = {}
+        self.dropped = []  # Primer paso de cada escalera descartada por el plazo límite
+
+    def log(self, msg):
+        if self.callback_log: self.callback_log(msg)
+
+    def plan(self, plan):
+        """Crea las carpetas y genera las escaleras de todos los esquemas de plan (ProbePlan)."""
+        for scheme_name in plan.unknown_schemes:
+            self.log(f"[ERROR] Esquema '{scheme_name}' no existe.")
+
+        all_ladders = []
+        for scheme_name in plan.scheme_names:
+            if _prepare_scheme_folder(plan.root_dir, scheme_name, self.callback_log) is None:
+                continue
+
+            self.log(f"--- Iniciando Descarga Automática: {scheme_name} ---")
+            scheme_start, scheme_end = plan.scheme_range(scheme_name)
+            self.log(f"Rango: {scheme_start.strftime('%Y-%m-%d')} a {scheme_end.strftime('%Y-%m-%d')}")
+
+            ladders = list(plan.iter_scheme_ladders(scheme_name))
+            stats = plan.stats[scheme_name]
+            if stats["cache"]:
+                self.log(f"Omitidas {stats['cache']} combinaciones por caché de fallos (404/500 recientes).")
+            if stats["calendario"]:
+                self.log(f"Omitidas {stats['calendario']} fechas sin publicación histórica (umbral {plan.min_score}).")
+            if stats["politica"]:
+                self.log(f"Omitidas {stats['politica']} claves con fecha futura (el esquema no publica por adelantado).")
+            if stats["descubiertos"]:
+                self.log(f"{stats['descubiertos']} archivos con nombre exacto desde las páginas de XM (se sondean primero).")
+            if plan.shard:
+                self.log(f"Shard {plan.shard[0]}/{plan.shard[1]}: {stats['claves']} claves propias, "
+                         f"{stats['otro_shard']} de otros shards.")
+
+            self.found[scheme_name] = 0
+            self.days[scheme_name] = stats["dias"]
+            self.open_ladders[scheme_name] = len(ladders)
+            if not ladders:
+                self._finish(scheme_name)
+            all_ladders.extend(ladders)
+        return all_ladders
+
+    def on_result(self, task, success, msg):
+        if success:
+            self.found[task[3]] += 1
+            if msg: self.log(msg)
+            if self.patterns is not None and not (msg and "Ya en disco" in msg):
+                new_pattern = self.patterns.record(task[3], task[1])
+                if new_pattern:
+                    self.log(f"[PATRÓN] {task[3]}: primer acierto con {new_pattern} ({task[1]})")
+            if self.on_file: self.on_file(task, msg)
+        elif msg and ("[ERROR]" in msg or "[EXCEPTION]" in msg):
+            self.log(msg)
+
+    def on_ladder_done(self, task):
+        scheme_name = task[3]
+        self.open_ladders[scheme_name] -= 1
+        if self.open_ladders[scheme_name] == 0:
+            self._finish(scheme_name)
+
+    def on_dropped(self, ladder):
+        """Escalera que no alcanzó a ejecutarse antes del plazo límite."""
+        self.dropped.append(ladder[0])
+        self.on_ladder_done(ladder[0])
+
+    def report_dropped(self):
+        """Informa (una vez, al final) lo que quedó sin ejecutar por el plazo límite."""
+        if not self.dropped:
+            return
+        today = datetime.now()
+        by_scheme = {}
+        for probe in self.dropped:
+            by_scheme.setdefault(probe[3], []).append(probe)
+        detail = ", ".join(f"{name}: {len(probes)}" for name, probes in sorted(by_scheme.items()))
+        self.log(f"[PLAZO] Tiempo agotado: {len(self.dropped)} archivos sin sondear ({detail}).")
+        for probe in self.dropped:
+            if ladder_tier(probe, today) == TIER_CRITICAL:
+                self.log(f"[PLAZO] Sin sondear (crítico): {probe[3]} {probe[1]}")
+
+    def _finish(self, scheme_name):
+        self.log(f"Finalizado {scheme_name}: {self.found[scheme_name]} archivos.")
+
+    def results(self):
+        return {name: (self.found[name], self.days[name]) for name in self.found}
+
+def _is_local(probe):
+    """True si el archivo del paso ya está en disco (el acierto no cuesta requests)."""
+    return os.path.exists(os.path.join(probe[2], probe[1]))
+
+class _FairLadderQueue:
+    """
+    Escaleras pendientes agrupadas por esquema (task[3]). pop() entrega primero las del
+    mejor nivel de prioridad (ladder_tier) disponible y, dentro de ese nivel, del esquema
+    con menor proporción en_vuelo/peso: todos los esquemas avanzan a la vez y los de mayor
+    peso reciben más workers.
+    """
+
+    def __init__(self, ladders, weights=None, lookahead=None):
+        """
+        lookahead: si se da, ladders puede ser un generador: solo se extraen escaleras
+                   hasta tener lookahead pendientes (memoria constante en rangos largos).
+        """
+        self._weights = _scheme_weights(weights)
+        self._today = datetime.now()
+        self._queues = {}     # esquema -> deque de escaleras (deque de tareas)
+        self._in_flight = {}  # esquema -> escaleras con una tarea en vuelo
+        self._size = 0
+        self._lookahead = lookahead
+        self._source = None
+        if lookahead:
+            self._source = iter(ladders)
+            self._refill()
+            return
+        # Escaleras con un archivo ya descargado primero (ProbePlan lo pone como primer paso):
+        # se resuelven sin red y liberan workers
+        for ladder in sorted((l for l in ladders if l), key=lambda l: not _is_local(l[0])):
+            self.push(deque(ladder))
+
+    def _refill(self):
+        while self._source is not None and self._size < self._lookahead:
+            ladder = next(self._source, None)
+            if ladder is None:
+                self._source = None
+            elif ladder:
+                self.push(deque(ladder))
+
+    def __bool__(self):
+        self._refill()
+        return self._size > 0
+
+    def push(self, ladder, front=False):
+        scheme = ladder[0][3]
+        queue = self._queues.setdefault(scheme, deque())
+        self._in_flight.setdefault(scheme, 0)
+        self._size += 1
+        if front:
+            queue.appendleft(ladder)
         else:
-            # Fecha reciente/hoy: todas las variaciones (XM comete errores de nombrado)
-            for file_base in files_to_try:
-                variations = [file_base, file_base + " ", file_base.replace(" ", "  ")]
-                variations = list(set(variations))
-                for variant in variations:
-                    for ver in versions_full:
-                        for ext in extensions_full:
-                            url, filename = get_xm_url(variant, current_date, esquema_nombre=scheme_name, version_suffix=ver, extension=ext)
-                            tasks.append((url, filename, scheme_folder, scheme_name))
-        current_date += delta
-        
-    found_count = 0
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_task = {executor.submit(_download_worker_wrapper, *task): task for task in tasks}
-        
-        for future in concurrent.futures.as_completed(future_to_task):
+            queue.append(ladder)
+
+    def pop(self):
+        self._refill()
+        self._size -= 1
+        tiers = {name: ladder_tier(queue[0][0], self._today) for name, queue in self._queues.items() if queue}
+        best = min(tiers.values())
+        scheme = min((name for name, tier in tiers.items() if tier == best),
+                     key=lambda name: (self._in_flight[name] + 1) / max(self._weights.get(name, 1), 0.001))
+        self._in_flight[scheme] += 1
+        return self._queues[scheme].popleft()
+
+    def release(self, scheme):
+        self._in_flight[scheme] -= 1
+
+    def drain(self):
+        """
+        Retira y retorna todas las escaleras pendientes (ej: al vencer el plazo).
+        Con lookahead, lo que el generador aún no produjo simplemente no se genera.
+        """
+        dropped = []
+        for queue in self._queues.values():
+            dropped.extend(queue)
+            queue.clear()
+        self._size = 0
+        self._source = None
+        return dropped
+
+def _run_probe_ladders(ladders, worker, max_workers, on_result, controller=None, weights=None, on_ladder_done=None, breaker=None, deadline=None, on_dropped=None, lookahead=None):
+    """
+    Ejecuta escaleras de sondeo. Cada escalera es una lista ordenada de tareas alternativas
+    para el mismo archivo (la más probable primero). Cada escalera tiene como máximo una
+    tarea en vuelo; al primer acierto sus pasos restantes nunca se envían.
+    worker(*task) -> (success, msg); on_result(task, success, msg) se llama por cada tarea.
+    controller: AdaptiveConcurrency opcional; su límite actual reemplaza a max_workers.
+    weights: pesos por esquema para repartir workers (ver _FairLadderQueue).
+    on_ladder_done(tarea): se llama con la última tarea de cada escalera que termina
+                           (acierto o agotada).
+    breaker: CircuitBreaker opcional; mientras espera una prueba, las escaleras pendientes
+             se retienen (una sola tarea en vuelo) en vez de gastarse fallando.
+    deadline: hora límite (time.time()); al llegar no se envía nada más, se esperan las
+              tareas en vuelo y cada escalera pendiente se entrega a on_dropped(escalera).
+    lookahead: escaleras pendientes máximas; permite pasar un generador (ver _FairLadderQueue).
+    Una tarea cuyo worker lanza ClaimPending vuelve al final de la cola (no cuenta como ejecutada).
+    Retorna el número de tareas ejecutadas.
+    """
+    pending = _FairLadderQueue(ladders, weights, lookahead)
+    executed = 0
+    pool_size = controller.maximum if controller else max_workers
+    current_limit = (lambda: controller.limit) if controller else (lambda: max_workers)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=pool_size) as executor:
+        in_flight = {}  # future -> (tarea, pasos restantes de la escalera)
+
+        def submit_next(ladder):
+            task = ladder.popleft()
+            in_flight[executor.submit(worker, *task)] = (task, ladder)
+
+        def can_submit():
+            if breaker is not None and breaker.waiting:
+                return not in_flight and breaker.retry_in() == 0  # Solo el request de prueba
+            return len(in_flight) < current_limit()
+
+        while True:
+            if deadline is not None and pending and time.time() >= deadline:
+                for ladder in pending.drain():
+                    if on_dropped: on_dropped(ladder)
+            while pending and can_submit():
+                submit_next(pending.pop())
+            if controller is not None:
+                controller.observe(len(in_flight))
+            if not in_flight:
+                if pending and breaker is not None and breaker.waiting:
+                    wait = breaker.retry_in()
+                    if deadline is not None:
+                        wait = min(wait, max(deadline - time.time(), 0))
+                    time.sleep(max(wait, 0.05))
+                    continue
+                break
+            timeout = max(deadline - time.time(), 0.05) if deadline is not None and pending else None
+            done, _ = concurrent.futures.wait(in_flight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task, ladder = in_flight.pop(future)
+                pending.release(task[3])
+                try:
+                    success, msg = future.result()
+                except ClaimPending:
+                    # Otra ejecución la sondea: la escalera se retoma después de las demás
+                    ladder.appendleft(task)
+                    pending.push(ladder)
+                    continue
+                except Exception as e:
+                    success, msg = False, f"[EXCEPTION] {e}"
+                executed += 1
+                on_result(task, success, msg)
+
+                # Acierto: la escalera termina. Fallo: sigue con la siguiente variante.
+                if not success and ladder:
+                    if deadline is not None and time.time() >= deadline:
+                        if on_dropped: on_dropped(ladder)
+                    else:
+                        pending.push(ladder, front=True)
+                elif on_ladder_done:
+                    on_ladder_done(task)
+
+    return executed
+
+def _download_message(filename, status):
+    return {STATUS_UPDATED: f"[OK] Actualizado: {filename}",
+            STATUS_LINKED: f"[OK] Enlazado del almacén: {filename}"}.get(status, f"[OK] Descargado: {filename}")
+
+def _needs_post_process(scheme):
+    return scheme == "TIE"
+
+def _clean_suffix(filename, new_path, error_msg):
+    if not new_path:
+        return f" -> [WARN] Error Limpiando TIE: {error_msg}"
+    new_filename = os.path.basename(new_path)
+    return f" -> Limpiado: {new_filename}" if new_filename != filename else " -> Limpiado."
+
+def _clean_downloaded(filename, scheme_folder):
+    """Limpieza TIE de un archivo recién descargado. Retorna el sufijo para el mensaje de log."""
+    return _clean_suffix(filename, *clean_tie_file(os.path.join(scheme_folder, filename)))
+
+def _post_process_download(filename, scheme_folder, scheme, status=STATUS_DOWNLOADED):
+    """Post-procesamiento de un archivo recién descargado. Retorna el mensaje de log."""
+    msg = _download_message(filename, status)
+    if _needs_post_process(scheme):
+        msg += _clean_downloaded(filename, scheme_folder)
+    return msg
+
+# --- PIPELINE: ETAPA DE E/S (SONDEOS) Y ETAPA DE CPU (POST-PROCESAMIENTO) ---
+# Los sondeos y descargas (etapa de E/S) corren en los hilos de _run_probe_ladders o en
+# las corrutinas de download_xm_async y casi solo esperan a la red. La limpieza TIE (leer
+# el libro, quitar la columna A, escribir) ocupa CPU: en esos mismos hilos compite por el
+# GIL con los sondeos. La etapa de CPU corre workbook_xm.process_download en un pool de
+# procesos, uno por núcleo, solo para los esquemas que se post-procesan
+# (_needs_post_process); los demás libros no pasan por ella (su formato ya se verificó
+# con los primeros bytes al descargarlos). El proceso principal solo deja el resultado en
+# su lugar (os.replace) y anota el manifiesto, que es SQLite y no se comparte entre procesos.
+# Si el pool no se puede usar (no arranca o un proceso muere), la etapa sigue en hilos.
+# Entre ambas etapas la cola es acotada (POST_PROCESS_BACKLOG archivos por proceso): si la
+# CPU no da abasto, submit() frena al hilo de descarga en vez de acumular archivos.
+# Cada archivo enviado queda marcado como pendiente en el manifiesto hasta terminar: la
+# limpieza no es idempotente y un archivo ya en disco no se vuelve a procesar, así que
+# una ejecución interrumpida lo retoma desde la marca (resume).
+POST_PROCESS_WORKERS = os.cpu_count() or 1
+POST_PROCESS_BACKLOG = 2   # Archivos en espera o en proceso por cada proceso de la etapa
+PENDING_TIE_CLEAN = "limpieza_tie"
+
+def _process_pool_context():
+    """forkserver donde existe (fork de un proceso con hilos no es seguro); si no, spawn."""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+class PostProcessQueue:
+    """
+    Etapa de CPU del pipeline de descarga (limpieza TIE). submit() solo bloquea con la cola
+    llena; drain() espera lo enviado (también al salir del bloque with). Los resultados se
+    informan por callback_log.
+    workers: procesos de la etapa (por defecto uno por núcleo), creados con el primer envío.
+    backlog: archivos en cola por proceso antes de frenar a la etapa de E/S.
+    processes=False: la etapa usa hilos (ej: sistemas sin soporte de multiprocessing).
+    """
+
+    def __init__(self, callback_log=None, workers=None, backlog=POST_PROCESS_BACKLOG, processes=True):
+        self.callback_log = callback_log
+        self.workers = max(1, workers or POST_PROCESS_WORKERS)
+        self.processes = processes
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(self.workers * max(1, backlog))
+        self._lock = threading.Condition()
+        self._in_flight = 0
+        self._messages = []
+        self._queued = set()  # (carpeta, nombre) enviados y sin terminar
+        self.done = 0
+        self.failed = 0
+
+    def log(self, msg):
+        if self.callback_log: self.callback_log(msg)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.drain()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None and self.processes:
+                try:
+                    self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                                        mp_context=_process_pool_context())
+                except (OSError, ImportError, NotImplementedError) as e:
+                    self.log(f"[WARN] Post-procesamiento en hilos (sin procesos): {e}")
+                    self.processes = False
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                   thread_name_prefix="xm-post")
+            return self._pool
+
+    def _use_threads(self, error):
+        """El pool de procesos quedó inservible (BrokenProcessPool): lo que sigue va en hilos."""
+        with self._lock:
+            if not self.processes:
+                return
+            self.processes = False
+            broken, self._pool = self._pool, None
+        self.log(f"[WARN] Post-procesamiento en hilos (el pool de procesos falló): {error}")
+        if broken is not None:
+            broken.shutdown(wait=False)
+
+    def _dispatch(self, path):
+        try:
+            return self._executor().submit(workbook_xm.process_download, path, _clean_paths(path)[1])
+        except concurrent.futures.BrokenExecutor as e:
+            self._use_threads(e)
+            return self._executor().submit(workbook_xm.process_download, path, _clean_paths(path)[1])
+
+    def submit(self, filename, scheme_folder, scheme):
+        """
+        Envía filename a la etapa de CPU si su esquema se post-procesa. Retorna el future,
+        o None si no hay nada que hacer. Un fallo de la etapa no se propaga: el archivo se
+        procesa en este hilo, así la descarga sigue contando como hecha.
+        """
+        if not _needs_post_process(scheme):
+            return None
+        key = (os.path.abspath(scheme_folder), filename)
+        with self._lock:
+            if key in self._queued:
+                return None
+            self._queued.add(key)
+        path = os.path.join(scheme_folder, filename)
+        try:
+            # La marca va antes de esperar lugar: un corte durante la espera también se retoma
+            _file_index(scheme_folder).update(filename, pendiente=PENDING_TIE_CLEAN)
+        except Exception:
+            with self._lock:
+                self._queued.discard(key)
+            raise
+        self._slots.acquire()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._dispatch(path)
+        except Exception as e:
+            self.log(f"[WARN] Post-procesamiento de {filename} en el hilo de descarga: {e}")
+            future = concurrent.futures.Future()
             try:
-                success, msg = future.result()
-                if success:
-                    found_count += 1
-                    if callback_log and msg: callback_log(msg)
-                elif msg and "[ERROR]" in msg and callback_log:
-                     callback_log(msg)
+                future.set_result(workbook_xm.process_download(path, _clean_paths(path)[1]))
+            except Exception as error:
+                future.set_exception(error)
+        future.add_done_callback(lambda f: self._finish(f, filename, scheme_folder, scheme))
+        return future
+
+    def _release(self, key, msg=None):
+        with self._lock:
+            self._queued.discard(key)
+            self._in_flight -= 1
+            if msg:
+                self._messages.append(msg)
+            self._lock.notify_all()
+        self._slots.release()
+
+    def _finish(self, future, filename, scheme_folder, scheme):
+        """Vuelta de la etapa de CPU, en el proceso principal: resultado en su lugar y manifiesto."""
+        path = os.path.join(scheme_folder, filename)
+        error = future.exception()
+        if isinstance(error, concurrent.futures.BrokenExecutor) and self.processes:
+            # Un proceso murió (ej: sin memoria) y el pool entero quedó inservible: se repite en hilos
+            self._use_threads(error)
+            try:
+                retry = self._dispatch(path)
+            except Exception:
+                pass
+            else:
+                retry.add_done_callback(lambda f: self._finish(f, filename, scheme_folder, scheme))
+                return
+        msg = None
+        try:
+            try:
+                msg = self._apply(future.result(), filename, scheme_folder, scheme)
             except Exception as e:
-                if callback_log: callback_log(f"[EXCEPTION] {e}")
-                
-    if callback_log: callback_log(f"Finalizado {scheme_name}: {found_count} archivos.")
-    return found_count, days_count
+                # Archivo inaccesible o etapa caída: queda pendiente para la próxima ejecución
+                _discard_partial(_clean_paths(path)[1])
+                msg = f"[{scheme}] {filename} -> [WARN] Post-procesamiento interrumpido: {e}"
+                with self._lock:
+                    self.failed += 1
+            if msg:
+                self.log(msg)
+        finally:
+            self._release((os.path.abspath(scheme_folder), filename), msg)
+
+    def _apply(self, result, filename, scheme_folder, scheme):
+        path = os.path.join(scheme_folder, filename)
+        index = _file_index(scheme_folder)
+        row = index.manifest.get(index.carpeta, filename)
+        if row is None or row["pendiente"] is None:
+            _discard_partial(_clean_paths(path)[1])
+            return None  # Ya lo procesó otra ejecución que retomó el mismo pendiente
+        if result["invalido"]:
+            _discard_invalid(path)
+            suffix = f" -> [WARN] Libro ilegible ({result['error']}): se descartó y se descargará de nuevo."
+        else:
+            suffix = _clean_suffix(filename, *_apply_clean(path, result))
+        failed = "[WARN]" in suffix
+        # Un libro que no se puede procesar no se reintenta en cada ejecución
+        if failed and index.get(filename) is not None:
+            index.update(filename, pendiente=None)
+        with self._lock:
+            self.done += 1
+            self.failed += failed
+        return f"[{scheme}] {filename}{suffix}"
 
-def _download_worker_wrapper(url, filename, scheme_folder, scheme):
-    """Helper interno para procesar descarga y limpieza (logic from GUI)"""
+    def resume(self, scheme_folder, scheme):
+        """Vuelve a enviar los archivos de scheme_folder que quedaron pendientes. Retorna cuántos."""
+        if not os.path.isdir(scheme_folder):
+            return 0
+        index = _file_index(scheme_folder)
+        if not _needs_post_process(scheme):
+            # Marcas de validación de versiones anteriores: esos libros ya no pasan por la etapa
+            for filename in index.manifest.pending(index.carpeta):
+                index.update(filename, pendiente=None)
+            return 0
+        resumed = sum(self.submit(filename, scheme_folder, scheme) is not None
+                      for filename in index.manifest.pending(index.carpeta))
+        if resumed:
+            self.log(f"[{scheme}] Retomando post-procesamiento de {resumed} archivos interrumpidos.")
+        return resumed
+
+    def drain(self):
+        """Espera todo lo enviado hasta ahora. Retorna los mensajes, en orden de llegada."""
+        with self._lock:
+            self._lock.wait_for(lambda: self._in_flight == 0)
+            messages, self._messages = self._messages, []
+        return messages
+
+def _download_worker_wrapper(url, filename, scheme_folder, scheme, file_date=None, miss_cache=None, controller=None, revalidate_days=DEFAULT_REVALIDATE_DAYS, breaker=None, coordinator=None, post_processor=None):
+    """
+    Helper interno para procesar descarga y limpieza (logic from GUI)
+    post_processor: PostProcessQueue opcional (etapa de CPU); la limpieza TIE se envía ahí
+    en vez de hacerse en este hilo.
+    """
     try:
-        success = download_file(url, filename, scheme_folder)
-        if success:
-            msg = f"[OK] Descargado: {filename}"
-            if scheme == "TIE":
-                full_path = os.path.join(scheme_folder, filename)
-                new_path, error_msg = clean_tie_file(full_path)
-                if new_path:
-                    new_filename = os.path.basename(new_path)
-                    if new_filename != filename:
-                         msg += f" -> Limpiado: {new_filename}"
-                    else:
-                         msg += " -> Limpiado."
-                else:
-                    msg += f" -> [WARN] Error Limpiando TIE: {error_msg}"
-            return True, msg
-        return False, None
+        status = _probe_status(url, filename, scheme_folder, miss_cache=miss_cache, file_date=file_date,
+                               controller=controller, revalidate=_should_revalidate(file_date, revalidate_days),
+                               breaker=breaker, coordinator=coordinator)
+        if status == _MISSED:
+            return False, None
+        if status is None:
+            return False, f"{PROBE_UNANSWERED} {filename}"
+        # Un archivo ya en disco no se vuelve a procesar (la limpieza TIE no es idempotente)
+        if status == STATUS_CACHED:
+            return True, f"[OK] Ya en disco: {filename}"
+        if post_processor is not None and _needs_post_process(scheme):
+            post_processor.submit(filename, scheme_folder, scheme)
+            return True, _download_message(filename, status) + " -> limpieza en cola"
+        return True, _post_process_download(filename, scheme_folder, scheme, status)
+    except ClaimPending:
+        raise  # _run_probe_ladders la devuelve a la cola
     except Exception as e:
         return False, f"[ERROR] {filename}: {str(e)}"
 
@@ -2,10 +2,10 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from datetime import datetime, timedelta
 import threading
+import multiprocessing
 import sys
 import os
 import queue
-import concurrent.futures
 
 # Importar lógica del script existente
 # Asegúrate de que download_xm_file.py esté en la misma carpeta
@@ -281,15 +281,23 @@ class XMDownloaderApp(tk.Tk):
                          args=(start_date, end_date, scheme, selected_file, root_dir), 
                          daemon=True).start()
 
-    def download_worker(self, url, filename, scheme_folder, scheme):
+    def download_worker(self, url, filename, scheme_folder, scheme, file_date=None, miss_cache=None, controller=None, coordinator=None, post_processor=None):
         """Helper function to run in a thread worker."""
         try:
-            success = download_xm_file.download_file(url, filename, scheme_folder)
+            # Un archivo ya en disco (o que otra ejecución acaba de bajar) no se vuelve a limpiar:
+            # cada limpieza quita una columna
+            status = download_xm_file._download_status(url, filename, scheme_folder, miss_cache=miss_cache,
+                                                       file_date=file_date, controller=controller,
+                                                       coordinator=coordinator)
+            cached = status == download_xm_file.STATUS_CACHED
             
-            if success:
-                msg = f"[OK] Descargado: {filename}"
-                # Post-procesamiento para TIE
-                if scheme == "TIE":
+            if status is not None:
+                msg = f"[OK] Descargado: {filename}" if not cached else f"[OK] Ya en disco: {filename}"
+                # Limpieza TIE en la etapa de CPU: el hilo sigue con otro sondeo
+                if scheme == "TIE" and not cached and post_processor is not None:
+                    post_processor.submit(filename, scheme_folder, scheme)
+                    msg += "\n[INFO] Limpieza TIE en cola."
+                elif scheme == "TIE" and not cached:
                     full_path = os.path.join(scheme_folder, filename)
                     # Llamar a la función de limpieza
                     new_path, error_msg = download_xm_file.clean_tie_file(full_path)
@@ -304,15 +312,14 @@ class XMDownloaderApp(tk.Tk):
                         msg += f"\n[WARN] No se pudo limpiar TIE: {error_msg}"
                 return True, msg
             return False, None
+        except download_xm_file.ClaimPending:
+            raise  # La cola de escaleras la retoma más tarde
         except Exception as e:
             return False, f"[ERROR] {filename}: {str(e)}"
 
     def run_download_process(self, start_date, end_date, scheme, selected_file, root_dir):
         try:
-            current_date = start_date
-            delta = timedelta(days=1)
             found_count = 0
-            days_count = 0
 
             # Crear subcarpeta del esquema
             scheme_folder = os.path.join(root_dir, scheme)
@@ -336,55 +343,54 @@ class XMDownloaderApp(tk.Tk):
 
             self.log(f"Guardando en: {scheme_folder}")
 
-            # Generar todas las tareas
-            tasks = []
-            versions = ["", "_V2"]
-            extensions = [".xlsx", ".XLSX", ".xls", ".XLS"]
-
-            # Loop dates
-            temp_date = start_date
-            while temp_date <= end_date:
-                days_count += 1
-                
-                for file_base in files_to_try:
-                    variations = [
-                        file_base,                     
-                        file_base + " ",               
-                        file_base.replace(" ", "  ")   
-                    ]
-                    variations = list(set(variations))
-                    
-                    for variant in variations:
-                        for ver in versions:
-                            for ext in extensions:
-                                url, filename = download_xm_file.get_xm_url(variant, temp_date, esquema_nombre=scheme, version_suffix=ver, extension=ext)
-                                tasks.append((url, filename, scheme_folder, scheme))
-                
-                temp_date += delta
-
-            self.log(f"Generadas {len(tasks)} combinaciones posibles. Iniciando descarga concurrente...")
+            # Caché de fallos compartida con run_daily (misma raíz → mismos 404 ya confirmados)
+            miss_cache = download_xm_file.MissCache.for_root(root_dir)
+
+            # Plan de sondeo compartido con run_daily (mismas variantes, sin URLs repetidas).
+            # El usuario eligió el rango explícitamente: el calendario solo ordena, no omite fechas.
+            plan = download_xm_file.ProbePlan(
+                start_date, end_date, [scheme], root_dir, files={scheme: files_to_try},
+                miss_cache=miss_cache,
+                calendar=download_xm_file.PublicationCalendar.from_archive(root_dir, [scheme]),
+                min_score=0.0)
+            # Se genera una sola vez: la estimación reutiliza las mismas escaleras
+            ladders = list(plan.iter_scheme_ladders(scheme))
+            for line in plan.estimate(20, ladders={scheme: ladders}):
+                self.log(f"[PLAN] {line}")
+
+            stats = plan.stats[scheme]
+            days_count = stats["dias"]
+            if stats["cache"]:
+                self.log(f"Omitidas {stats['cache']} combinaciones por caché de fallos (404/500 recientes).")
+            self.log(f"Generadas {stats['sondeos']} combinaciones posibles. Iniciando descarga concurrente...")
             
-            # Ejecutar con ThreadPoolExecutor
-            # Limitamos workers para no saturar
-            with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-                # Map futures to tasks
-                future_to_task = {executor.submit(self.download_worker, *task): task for task in tasks}
-                
-                for future in concurrent.futures.as_completed(future_to_task):
-                    try:
-                        success, message = future.result()
-                        if success:
-                            found_count += 1
-                            if message:
-                                self.log(message)
-                        elif message and "[ERROR]" in message:
-                             self.log(message)
-                    except Exception as exc:
-                        self.log(f"[EXCEPTION] Worker generó excepción: {exc}")
+            # Concurrencia adaptativa: parte de 20 (antes fijo) y se ajusta según responda XM
+            controller = download_xm_file.AdaptiveConcurrency(initial=20, maximum=60, callback_log=self.log)
+
+            def on_result(task, success, message):
+                nonlocal found_count
+                if success:
+                    found_count += 1
+                    if message:
+                        self.log(message)
+                elif message and ("[ERROR]" in message or "[EXCEPTION]" in message):
+                     self.log(message)
+
+            # Arriendo sobre la raíz: si run_daily corre a la vez, no se repiten sondeos
+            with download_xm_file.RunCoordinator(root_dir, self.log, defer=True) as coordinator, \
+                    download_xm_file.PostProcessQueue(self.log) as post_processor:
+                post_processor.resume(scheme_folder, scheme)
+                worker = lambda *task: self.download_worker(*task, miss_cache=miss_cache, controller=controller,
+                                                            coordinator=coordinator, post_processor=post_processor)
+                download_xm_file._run_probe_ladders(ladders, worker, controller.limit,
+                                                    on_result, controller=controller)
+
+            miss_cache.save()
 
             self.log(f"\n--- Finalizado ---")
             self.log(f"Días escaneados: {days_count}")
             self.log(f"Archivos descargados: {found_count}")
+            self.log(controller.summary())
             
             self.msg_queue.put(("ENABLE_BTN", None))
             self.msg_queue.put(("MSGBOX", ("Proceso Terminado", f"Se descargaron {found_count} archivos en '{scheme}'.")))
@@ -395,5 +401,8 @@ class XMDownloaderApp(tk.Tk):
             self.msg_queue.put(("ERRORBOX", ("Error Crítico", str(e))))
 
 if __name__ == "__main__":
+    # La etapa de CPU usa procesos: en un ejecutable empaquetado (PyInstaller) cada hijo
+    # vuelve a arrancar este script y freeze_support lo desvía antes de abrir otra ventana
+    multiprocessing.freeze_support()
     app = XMDownloaderApp()
     app.mainloop()
@@ -1,39 +1,308 @@
-import requests
-from bs4 import BeautifulSoup
-import urllib.parse
-
-def find_xm_file_paths():
-    url = "https://www.xm.com.co/administraci%C3%B3n-financiera/garant%C3%ADas-financieras/c%C3%A1lculos-garant%C3%ADas-financieras-mensuales-esquema"
-    
-    # Use a standard browser User-Agent to avoid 403 Forbidden
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-    
-    try:
-        print(f"Intentando acceder a: {url}")
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        print("\n--- Enlaces encontrados (XLSX, XLS, PDF) ---")
-        found = False
-        for link in soup.find_all('a', href=True):
-            href = link['href']
-            # Check for common file extensions
-            if href.lower().endswith(('.xlsx', '.xls', '.pdf')):
-                full_url = urllib.parse.urljoin(url, href)
-                print(f"Archivo: {link.get_text(strip=True)}")
-                print(f"Ruta: {full_url}")
-                print("-" * 30)
-                found = True
-                
-        if not found:
-            print("No se encontraron archivos con extensiones .xlsx, .xls o .pdf directamente en los enlaces.")
-            
-    except requests.exceptions.RequestException as e:
-        print(f"Error al acceder a la página: {e}")
+"""
+Descubrimiento de archivos publicados en las páginas de XM.
+
+Las páginas de garantías de xm.com.co enlazan los archivos reales (.xlsx/.xls). Leerlas
+da el nombre exacto del blob, así el descargador no tiene que adivinar variantes de
+nombre: las claves que resuelve se sondean primero en la URL exacta, y las variantes
+quedan solo como respaldo si ese enlace ya no responde.
+
+- crawl_pages: descarga las páginas en paralelo con caché ETag/Last-Modified en disco.
+- parse_links / blob_path_from_url: extraen enlaces y rutas de blob del HTML (sin red).
+- discover: todo lo anterior -> {(esquema, archivo base, fecha, versión): (url, nombre)}
+  listo para ProbePlan(discovered=...).
+
+Para probar sin red, fetch puede reemplazarse por fixture_fetch({url: archivo.html}), o:
+    python extract_xm_links.py --html pagina_guardada.html
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import time
+from html.parser import HTMLParser
+from urllib.parse import parse_qs, unquote, urljoin, urlsplit
+
+import download_xm_file
+from download_xm_file import ESQUEMAS
+
+PAGE_CACHE_DIRNAME = ".xm_paginas"  # Oculta: upload_drive no sube archivos que empiezan por '.'
+PAGE_TIMEOUT = 30
+WORKBOOK_EXTENSIONS = ('.xlsx', '.xls')
+BLOB_CONTAINER = "storageportalxm"
+
+_VERSION_RE = re.compile(r'(_V\d+)\s*$', re.IGNORECASE)
+
+
+class _LinkParser(HTMLParser):
+    """Junta (href, texto) de todas las etiquetas <a href=...>."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+        self._current = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            href = dict(attrs).get("href")
+            if href:
+                self._current = [href, []]
+
+    def handle_data(self, data):
+        if self._current is not None:
+            self._current[1].append(data)
+
+    def handle_endtag(self, tag):
+        if tag == "a" and self._current is not None:
+            href, text = self._current
+            self.links.append((href, " ".join("".join(text).split())))
+            self._current = None
+
+
+def blob_path_from_url(url):
+    """
+    Ruta del blob dentro de storageportalxm para un enlace de XM, o None.
+    Entiende el API de descarga (?ruta=...), el portal antiguo y enlaces directos al blob.
+    """
+    parts = urlsplit(url)
+    ruta = parse_qs(parts.query).get("ruta")
+    if ruta:
+        return ruta[0].lstrip("/")
+    path = unquote(parts.path)
+    marker = f"/{BLOB_CONTAINER}/"
+    if parts.hostname and parts.hostname.startswith(BLOB_CONTAINER) and marker in path:
+        return path.split(marker, 1)[1]
+    return None
+
+
+def parse_links(html, base_url, extensions=WORKBOOK_EXTENSIONS):
+    """
+    Enlaces a archivos en el HTML de una página de XM.
+    Retorna: lista de (texto, url_absoluta, ruta_blob o None), sin repetidos.
+    """
+    parser = _LinkParser()
+    parser.feed(html)
+    results, seen = [], set()
+    for href, text in parser.links:
+        full_url = urljoin(base_url, href.strip())
+        blob_path = blob_path_from_url(full_url)
+        # Los enlaces del API terminan en "&nombreBlobContainer=...": mirar la ruta del blob
+        target = (blob_path or urlsplit(full_url).path).lower()
+        if not target.endswith(extensions) or full_url in seen:
+            continue
+        seen.add(full_url)
+        results.append((text, full_url, blob_path))
+    return results
+
+
+def resolve_blob_path(blob_path, scheme_names=None):
+    """
+    Clave del planificador para una ruta de blob.
+    Retorna: ((esquema, archivo base, fecha, versión), nombre) o None si no se reconoce.
+    """
+    filename = blob_path.rsplit("/", 1)[-1]
+    stem, ext = os.path.splitext(filename)
+    if ext.lower() not in WORKBOOK_EXTENSIONS:
+        return None
+    for scheme_name in scheme_names or ESQUEMAS.keys():
+        if not blob_path.startswith(ESQUEMAS[scheme_name]["carpeta_url"] + "/"):
+            continue
+        file_base = download_xm_file._match_file_base(filename, scheme_name)
+        file_date = download_xm_file._date_from_scheme_filename(filename, scheme_name)
+        if file_base is None or file_date is None:
+            continue
+        match = _VERSION_RE.search(stem)
+        version = match.group(1).upper() if match else ""
+        return (scheme_name, file_base, file_date.date(), version), filename
+    return None
+
+
+class PageCache:
+    """
+    Caché en disco de páginas HTML con sus validadores (ETag / Last-Modified).
+    Cada página se guarda como <sha1>.html + <sha1>.json en cache_dir.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @classmethod
+    def for_root(cls, root_dir):
+        return cls(os.path.join(root_dir, PAGE_CACHE_DIRNAME))
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".html"), os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, url):
+        """Retorna (meta, html) guardados o (None, None)."""
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(body_path, "r", encoding="utf-8") as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def conditional_headers(self, url):
+        meta, _ = self.get(url)
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def store(self, url, headers, html):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        body_path, meta_path = self._paths(url)
+        meta = {"url": url, "etag": headers.get("etag"),
+                "last_modified": headers.get("last-modified"), "fetched": time.time()}
+        for path, content in ((body_path, html), (meta_path, json.dumps(meta, indent=1))):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+
+def fetch_page(url, headers):
+    """GET de una página de XM. Retorna (status, headers en minúsculas, html)."""
+    request_headers = {"User-Agent": download_xm_file.XM_USER_AGENT}
+    request_headers.update(headers)
+    response = download_xm_file._https_pool.request("GET", url, headers=request_headers, timeout=PAGE_TIMEOUT)
+    response_headers = {name.lower(): value for name, value in response.headers.items()}
+    return response.status, response_headers, response.data.decode("utf-8", errors="replace")
+
+
+def fixture_fetch(fixtures):
+    """fetch sin red para pruebas: {url: ruta a un .html guardado}. Otras URLs dan 404."""
+    def fetch(url, headers):
+        path = fixtures.get(url)
+        if path is None:
+            return 404, {}, ""
+        with open(path, "r", encoding="utf-8") as f:
+            return 200, {}, f.read()
+    return fetch
+
+
+def crawl_pages(urls, cache, fetch=fetch_page, max_workers=4, callback_log=None):
+    """
+    Descarga las páginas en paralelo con peticiones condicionales.
+    Si XM responde 304 o falla, se usa la copia de la caché (si existe).
+    Retorna: {url: html}; las páginas sin contenido disponible no aparecen.
+    """
+    def log(msg):
+        if callback_log: callback_log(msg)
+
+    def crawl_one(url):
+        try:
+            status, headers, html = fetch(url, cache.conditional_headers(url))
+        except Exception as e:
+            status, headers, html = None, {}, f"{e!r}"
+        if status == 200:
+            cache.store(url, headers, html)
+            return url, html, "nueva"
+        _, cached = cache.get(url)
+        if status == 304:
+            return url, cached, "sin cambios"
+        log(f"[DESCUBRIMIENTO] {url}: {status or html}; se usa la caché" if cached is not None
+            else f"[DESCUBRIMIENTO] {url}: {status or html}; sin copia en caché")
+        return url, cached, "caché"
+
+    pages = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(urls) or 1))) as executor:
+        for url, html, state in executor.map(crawl_one, urls):
+            if html is not None:
+                pages[url] = html
+                log(f"[DESCUBRIMIENTO] Página {state}: {url}")
+    return pages
+
+
+def scheme_pages(scheme_names=None):
+    """URLs de "paginas_xm" declaradas en ESQUEMAS para los esquemas dados."""
+    urls = []
+    for scheme_name in scheme_names or ESQUEMAS.keys():
+        for url in ESQUEMAS.get(scheme_name, {}).get("paginas_xm", []):
+            if url not in urls:
+                urls.append(url)
+    return urls
+
+
+def discover(scheme_names, root_dir, fetch=fetch_page, callback_log=None, max_workers=4):
+    """
+    Recorre las páginas de XM de los esquemas y resuelve los archivos enlazados.
+    Retorna: {(esquema, archivo base, fecha, versión): (url, nombre)} para ProbePlan.
+    """
+    urls = scheme_pages(scheme_names)
+    if not urls:
+        return {}
+    pages = crawl_pages(urls, PageCache.for_root(root_dir), fetch=fetch,
+                        max_workers=max_workers, callback_log=callback_log)
+    return discover_from_html(pages.items(), scheme_names, callback_log=callback_log)
+
+
+def discover_from_html(pages, scheme_names=None, callback_log=None):
+    """Como discover, a partir de pares (url de la página, html) ya descargados o guardados."""
+    discovered = {}
+    unresolved = 0
+    for base_url, html in pages:
+        for _, _, blob_path in parse_links(html, base_url):
+            resolved = resolve_blob_path(blob_path, scheme_names) if blob_path else None
+            if resolved is None:
+                unresolved += 1
+                continue
+            key, filename = resolved
+            discovered[key] = (download_xm_file.xm_url_from_blob_path(blob_path), filename)
+    if callback_log:
+        callback_log(f"[DESCUBRIMIENTO] {len(discovered)} archivos resueltos, {unresolved} enlaces no reconocidos.")
+    return discovered
+
+
+def find_xm_file_paths(html_files=None, base_url=None):
+    """
+    Imprime los archivos enlazados en las páginas de XM, o en .html guardados
+    (base_url resuelve sus enlaces relativos; por defecto la primera página de ESQUEMAS).
+    """
+    pages = []
+    if html_files:
+        base_url = base_url or scheme_pages()[0]
+        for path in html_files:
+            with open(path, "r", encoding="utf-8") as f:
+                pages.append((base_url, f.read()))
+    else:
+        for url in scheme_pages():
+            print(f"Intentando acceder a: {url}")
+            try:
+                status, _, html = fetch_page(url, {})
+            except Exception as e:
+                print(f"Error al acceder a la página: {e}")
+                continue
+            if status != 200:
+                print(f"Error al acceder a la página: HTTP {status}")
+                continue
+            pages.append((url, html))
+
+    print("\n--- Enlaces encontrados (XLSX, XLS) ---")
+    found = False
+    for page_url, html in pages:
+        for text, full_url, blob_path in parse_links(html, page_url):
+            resolved = resolve_blob_path(blob_path) if blob_path else None
+            print(f"Archivo: {text}")
+            print(f"Ruta: {full_url}")
+            print(f"Clave: {resolved[0] if resolved else 'no reconocida'}")
+            print("-" * 30)
+            found = True
+
+    if not found:
+        print("No se encontraron archivos con extensiones .xlsx o .xls directamente en los enlaces.")
+
 
 if __name__ == "__main__":
-    find_xm_file_paths()
+    parser = argparse.ArgumentParser(description="Lista los archivos enlazados en las páginas de garantías de XM.")
+    parser.add_argument("--html", nargs="*", help="Leer páginas guardadas en vez de descargarlas.")
+    parser.add_argument("--base-url", help="URL de origen de las páginas guardadas (enlaces relativos).")
+    args = parser.parse_args()
+    find_xm_file_paths(args.html, args.base_url)
@@ -0,0 +1,285 @@
+"""
+Manifiesto de una raíz de descargas: el estado del archivo en SQLite
+(<root>/.xm_manifiesto.sqlite), en vez de consultarlo al disco en cada llamada.
+
+Una fila por archivo completo de <root>/<carpeta>: tamaño, sha256, formato real, URL y ruta
+de blob, validadores HTTP (ETag / Last-Modified), fecha del nombre, esquema, archivo base,
+versión, fecha de modificación, estado de subida a Drive, post-procesamiento pendiente
+(limpieza TIE) y, si el archivo ya se compactó (archive_xm), el archivo mensual que lo
+contiene. Las consultas van por índice
+(carpeta + nombre, carpeta + fecha, carpeta + mtime), así no se encarecen a medida que el
+archivo crece.
+
+El disco se lee (sync) solo si la carpeta cambió desde la última sincronización: archivos copiados a mano se agregan, los borrados se quitan.
+Varios procesos pueden compartir el manifiesto (SQLite en modo WAL) si la raíz está en un
+disco local. WAL necesita memoria compartida entre procesos, que las unidades virtuales de
+sincronización (Google Drive para escritorio, "G:\\Mi unidad\\...") no ofrecen: ahí el
+manifiesto usa journal_mode=DELETE, que es seguro pero serializa las escrituras. Se puede
+forzar el modo con la variable de entorno XM_MANIFEST_JOURNAL (WAL / DELETE).
+"""
+import os
+import sqlite3
+import threading
+
+MANIFEST_FILENAME = ".xm_manifiesto.sqlite"  # Oculto: upload_drive no lo sube
+WORKBOOK_EXTENSIONS = ('.xlsx', '.xls')
+JOURNAL_MODE_ENV = "XM_MANIFEST_JOURNAL"
+# Componentes de ruta de carpetas sincronizadas por Google Drive para escritorio
+SYNCED_FOLDER_MARKERS = ("mi unidad", "my drive", "unidades compartidas", "shared drives",
+                         "google drive", "googledrive")
+
+# Campos de un archivo descargado que expone la vista por carpeta (_FileIndex)
+ENTRY_FIELDS = ("bytes", "formato", "url", "etag", "last_modified", "sha256")
+COLUMNS = ENTRY_FIELDS + ("ruta_blob", "esquema", "fecha", "base", "version", "mtime", "subido", "archivo",
+                          "pendiente")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archivos (
+    carpeta TEXT NOT NULL,
+    nombre TEXT NOT NULL COLLATE NOCASE,
+    bytes INTEGER, formato TEXT, url TEXT, etag TEXT, last_modified TEXT, sha256 TEXT,
+    ruta_blob TEXT, esquema TEXT, fecha TEXT, base TEXT, version TEXT, mtime REAL, subido TEXT,
+    archivo TEXT, pendiente TEXT,
+    PRIMARY KEY (carpeta, nombre)
+);
+CREATE INDEX IF NOT EXISTS archivos_fecha ON archivos (carpeta, fecha);
+CREATE INDEX IF NOT EXISTS archivos_mtime ON archivos (carpeta, mtime);
+CREATE TABLE IF NOT EXISTS carpetas (
+    carpeta TEXT PRIMARY KEY,
+    mtime REAL
+);
+"""
+
+
+def journal_mode(root_dir):
+    """Modo de journal de SQLite para el manifiesto de root_dir: WAL salvo en unidades sincronizadas."""
+    forced = os.environ.get(JOURNAL_MODE_ENV, "").strip().upper()
+    if forced in ("WAL", "DELETE"):
+        return forced
+    parts = os.path.abspath(root_dir).replace("\\", "/").casefold().split("/")
+    return "DELETE" if any(part in SYNCED_FOLDER_MARKERS for part in parts) else "WAL"
+
+
+def is_workbook_name(name):
+    return not name.startswith('.') and name.lower().endswith(WORKBOOK_EXTENSIONS)
+
+
+class DownloadManifest:
+    """
+    Manifiesto SQLite de root_dir. Es seguro compartirlo entre hilos.
+    describe: función opcional describe(carpeta, nombre) -> {esquema, fecha, base, version}
+              para completar las filas nuevas (la da download_xm_file).
+    """
+
+    def __init__(self, root_dir, describe=None):
+        self.root_dir = root_dir
+        self.path = os.path.join(root_dir, MANIFEST_FILENAME)
+        self.describe = describe
+        self._lock = threading.Lock()
+        os.makedirs(root_dir, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self.journal_mode = journal_mode(root_dir)
+            if self.journal_mode == "WAL":
+                # El sistema de archivos puede rechazar WAL: SQLite responde con el modo que quedó
+                mode = self._conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+                if str(mode).upper() != "WAL":
+                    self.journal_mode = "DELETE"
+            if self.journal_mode == "DELETE":
+                self._conn.execute("PRAGMA journal_mode=DELETE")
+                self._conn.execute("PRAGMA synchronous=FULL")
+            else:
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            # Manifiestos de versiones anteriores: columnas agregadas después
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(archivos)")}
+            for column in ("archivo", "pendiente"):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE archivos ADD COLUMN {column} TEXT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _row(self, row):
+        return {key: row[key] for key in row.keys()} if row is not None else None
+
+    def _described(self, carpeta, nombre, fields):
+        if self.describe is not None and "fecha" not in fields:
+            try:
+                extra = self.describe(carpeta, nombre) or {}
+            except Exception:
+                extra = {}
+            fields = dict(extra, **fields)
+        return fields
+
+    # --- Lectura ---
+
+    def get(self, carpeta, nombre):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM archivos WHERE carpeta = ? AND nombre = ?",
+                                     (carpeta, nombre)).fetchone()
+        return self._row(row)
+
+    def names(self, carpeta):
+        """Nombres de los archivos de la carpeta (sueltos y compactados)."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT nombre FROM archivos WHERE carpeta = ?", (carpeta,))]
+
+    def rows(self, carpeta, since=None):
+        """Filas de la carpeta ordenadas por fecha; since: "YYYY-MM-DD" (incluida). Sin fecha van al final."""
+        query = "SELECT * FROM archivos WHERE carpeta = ?"
+        params = [carpeta]
+        if since is not None:
+            query += " AND (fecha >= ? OR fecha IS NULL)"
+            params.append(since)
+        query += " ORDER BY fecha IS NULL, fecha, nombre"
+        with self._lock:
+            return [self._row(row) for row in self._conn.execute(query, params)]
+
+    def latest(self, carpeta):
+        """Fila con la fecha de modificación más reciente de la carpeta, o None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM archivos WHERE carpeta = ? ORDER BY mtime DESC LIMIT 1",
+                                     (carpeta,)).fetchone()
+        return self._row(row)
+
+    def latest_with_url(self, carpetas):
+        """Fila más reciente (mtime) con URL entre las carpetas dadas, o None."""
+        carpetas = list(carpetas)
+        if not carpetas:
+            return None
+        marks = ", ".join("?" for _ in carpetas)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT * FROM archivos WHERE carpeta IN ({marks}) AND url IS NOT NULL ORDER BY mtime DESC LIMIT 1",
+                carpetas).fetchone()
+        return self._row(row)
+
+    def pending(self, carpeta):
+        """Nombres de la carpeta con post-procesamiento pendiente (ej: limpieza TIE interrumpida)."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT nombre FROM archivos WHERE carpeta = ? AND pendiente IS NOT NULL", (carpeta,))]
+
+    def all_rows(self):
+        with self._lock:
+            return [self._row(row) for row in self._conn.execute("SELECT * FROM archivos ORDER BY carpeta, nombre")]
+
+    # --- Escritura ---
+
+    def update(self, carpeta, nombre, **fields):
+        """Actualiza (o crea) la fila; los campos None quedan en NULL."""
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Campos desconocidos en el manifiesto: {', '.join(sorted(unknown))}")
+        with self._lock:
+            exists = self._conn.execute("SELECT 1 FROM archivos WHERE carpeta = ? AND nombre = ?",
+                                        (carpeta, nombre)).fetchone()
+        if not exists:
+            fields = self._described(carpeta, nombre, fields)
+            columns = ["carpeta", "nombre"] + list(fields)
+            with self._lock:
+                self._conn.execute(
+                    f"INSERT OR IGNORE INTO archivos ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                    [carpeta, nombre] + list(fields.values()))
+            if not fields:
+                return
+        if fields:
+            assignments = ", ".join(f"{key} = ?" for key in fields)
+            with self._lock:
+                self._conn.execute(f"UPDATE archivos SET {assignments} WHERE carpeta = ? AND nombre = ?",
+                                   list(fields.values()) + [carpeta, nombre])
+
+    def discard(self, carpeta, nombre):
+        with self._lock:
+            self._conn.execute("DELETE FROM archivos WHERE carpeta = ? AND nombre = ?", (carpeta, nombre))
+
+    def mark_archived(self, carpeta, nombres, archivo):
+        """Anota que nombres ya están en archivo (ruta relativa a la raíz) y no sueltos en la carpeta."""
+        with self._lock:
+            self._conn.executemany("UPDATE archivos SET archivo = ? WHERE carpeta = ? AND nombre = ?",
+                                   [(archivo, carpeta, nombre) for nombre in nombres])
+
+    def mark_uploaded(self, carpeta, nombre, marker):
+        with self._lock:
+            self._conn.execute("UPDATE archivos SET subido = ? WHERE carpeta = ? AND nombre = ?",
+                               (marker, carpeta, nombre))
+
+    # --- Sincronización con el disco ---
+
+    def sync(self, carpeta, force=False):
+        """
+        Reconcilia el manifiesto con <root>/<carpeta>. Cuesta un stat del directorio si la
+        carpeta no cambió (mtime) desde la última sincronización; si cambió, un scandir.
+        """
+        folder = os.path.join(self.root_dir, carpeta)
+        try:
+            folder_mtime = os.path.getmtime(folder)
+        except OSError:
+            with self._lock:
+                self._conn.execute("DELETE FROM archivos WHERE carpeta = ?", (carpeta,))
+                self._conn.execute("DELETE FROM carpetas WHERE carpeta = ?", (carpeta,))
+            return
+        with self._lock:
+            row = self._conn.execute("SELECT mtime FROM carpetas WHERE carpeta = ?", (carpeta,)).fetchone()
+        if row is not None and row[0] == folder_mtime and not force:
+            return
+
+        on_disk = {}
+        for entry in os.scandir(folder):
+            if is_workbook_name(entry.name) and entry.is_file():
+                stat = entry.stat()
+                on_disk[entry.name.casefold()] = (entry.name, stat.st_size, stat.st_mtime)
+        with self._lock:
+            known = {name.casefold(): (name, mtime, archivo) for name, mtime, archivo in self._conn.execute(
+                "SELECT nombre, mtime, archivo FROM archivos WHERE carpeta = ?", (carpeta,))}
+        # Los compactados no están en la carpeta, pero siguen en el archivo mensual
+        gone = [(carpeta, name) for key, (name, _, archivo) in known.items() if key not in on_disk and not archivo]
+        # Un compactado que vuelve a aparecer suelto (restaurado o descargado de nuevo) deja de estar archivado
+        touched = [(mtime, carpeta, known[key][0]) for key, (_, _, mtime) in on_disk.items()
+                   if key in known and (known[key][1] != mtime or known[key][2])]
+        # Archivos que no pasaron por el descargador (copiados a mano, versiones anteriores):
+        # se anotan con su tamaño actual; el formato se verifica al usarlos
+        new = [self._described(carpeta, name, {"bytes": size, "mtime": mtime})
+               for key, (name, size, mtime) in on_disk.items() if key not in known]
+        new_names = [name for key, (name, _, _) in on_disk.items() if key not in known]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("DELETE FROM archivos WHERE carpeta = ? AND nombre = ?", gone)
+                self._conn.executemany("UPDATE archivos SET mtime = ?, archivo = NULL WHERE carpeta = ? AND nombre = ?",
+                                       touched)
+                for name, fields in zip(new_names, new):
+                    columns = ["carpeta", "nombre"] + list(fields)
+                    self._conn.execute(
+                        f"INSERT OR IGNORE INTO archivos ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                        [carpeta, name] + list(fields.values()))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO carpetas (carpeta, mtime) VALUES (?, ?)",
+                               (carpeta, folder_mtime))
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def for_root(root_dir, describe=None):
+    """Manifiesto de root_dir, uno por proceso (las conexiones se reutilizan)."""
+    key = os.path.abspath(root_dir)
+    with _manifests_lock:
+        manifest = _manifests.get(key)
+        if manifest is None:
+            manifest = _manifests[key] = DownloadManifest(key, describe)
+        elif describe is not None and manifest.describe is None:
+            manifest.describe = describe
+        return manifest
+
+
+def exists(root_dir):
+    return os.path.exists(os.path.join(root_dir, MANIFEST_FILENAME))
@@ -1,7 +1,8 @@
 
 import os
 import sys
-from datetime import datetime, timedelta
+import argparse
+from datetime import datetime
 import time
 
 # Ensure we can import the module even if run from a different CWD
@@ -14,50 +15,170 @@ except ImportError:
     print("Error: No se encontro download_xm_file.py")
     sys.exit(1)
 
-def main():
-    # Configuración de fechas
-    # Se incluye un buffer de 2 días hacia atrás para asegurar descargas de días previos
-    # (ej: Cuentas/Saldos de días anteriores o fines de semana)
-    start_date = datetime.now() - timedelta(days=2)
-    end_date = datetime.now() + timedelta(days=15)
+# Concurrencia por motor: los hilos son caros (uno bloqueado por cada 404 de ~6s),
+# las corrutinas no, así que asyncio puede mantener muchos más sondeos en vuelo.
+# (inicial, máximo): el controlador AIMD parte del inicial y sube mientras XM lo tolere.
+ENGINE_WORKERS = {
+    "threads": (40, 120),   # El nuevo API es lento (~6s/404); más workers compensan
+    "asyncio": (200, 600),
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Descarga diaria de garantías XM.")
+    parser.add_argument("--engine", choices=sorted(ENGINE_WORKERS),
+                        default=os.environ.get("XM_ENGINE", "threads"),
+                        help="Motor de descarga (default: $XM_ENGINE o 'threads').")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Sondeos simultáneos iniciales (default según el motor).")
+    parser.add_argument("--no-adaptive", action="store_true",
+                        help="Concurrencia fija en --workers, sin control AIMD.")
+    parser.add_argument("--plan", action="store_true",
+                        help="Solo mostrar el plan (requests por esquema y tiempo estimado), sin descargar.")
+    parser.add_argument("--min-score", type=float,
+                        default=float(os.environ.get("XM_MIN_SCORE", download_xm_file.DEFAULT_MIN_SCORE)),
+                        help="Umbral del calendario de publicación aprendido; 0 sondea todas las fechas.")
+    parser.add_argument("--discover", action="store_true",
+                        default=os.environ.get("XM_DISCOVER", "").lower() in ("1", "true", "si", "sí"),
+                        help="Leer antes las páginas de XM para obtener los nombres exactos publicados.")
+    parser.add_argument("--revalidate-days", type=int,
+                        default=int(os.environ.get("XM_REVALIDATE_DAYS", download_xm_file.DEFAULT_REVALIDATE_DAYS)),
+                        help="Revalidar (ETag/Last-Modified) archivos ya descargados con fecha desde hoy - N días; 0 = no.")
+    parser.add_argument("--deadline", type=float,
+                        default=float(os.environ["XM_DEADLINE_MINUTES"]) if os.environ.get("XM_DEADLINE_MINUTES") else None,
+                        help="Minutos máximos de sondeo; lo pendiente (lo menos prioritario) se descarta y se informa.")
+    parser.add_argument("--skip-preflight", action="store_true",
+                        help="No comprobar que el portal XM responde antes de descargar.")
+    parser.add_argument("--shard", type=download_xm_file.parse_shard, default=os.environ.get("XM_SHARD") or None,
+                        help="i/N: sondear solo la parte i de N del plan (ver shards_xm.py merge).")
+    return parser.parse_args(argv)
+
+def get_engine(name):
+    """Retorna el módulo cuyo download_scheme_range se usará."""
+    if name == "asyncio":
+        import download_xm_async
+        return download_xm_async
+    return download_xm_file
+
+def main(argv=None):
+    args = parse_args(argv)
+    script_start = time.time()
+    engine = get_engine(args.engine)
+    initial_workers, max_workers_cap = ENGINE_WORKERS[args.engine]
+    max_workers = args.workers or initial_workers
+
+    # Usamos una lambda para imprimir logs con timestamp simple
+    log_func = lambda msg: print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
+
+    # Un solo controlador para todos los esquemas: lo aprendido sobre el servidor se conserva
+    controller = None
+    if not args.no_adaptive:
+        controller = download_xm_file.AdaptiveConcurrency(
+            initial=max_workers, maximum=max(max_workers_cap, max_workers), callback_log=log_func)
+
+    # Configuración de fechas: cada esquema declara su ventana en ESQUEMAS ("sondeo").
+    # Por defecto 2 días hacia atrás (Cuentas/Saldos de días previos o fines de semana)
+    # y 15 hacia adelante (TIE y Semanal se publican con fecha adelantada).
+    schemes = list(download_xm_file.ESQUEMAS.keys())
+    windows = {scheme: download_xm_file.probe_window(scheme) for scheme in schemes}
+    start_date = min(start for start, _ in windows.values())
+    end_date = max(end for _, end in windows.values())
     
     # Carpeta raíz (relativa al script o absoluta)
     root_dir = os.path.join(current_dir, "Garantías")
     
     print(f"=== INICIANDO EJECUCIÓN AUTOMÁTICA: {datetime.now()} ===")
-    print(f"Rango: {start_date.strftime('%Y-%m-%d')} - {end_date.strftime('%Y-%m-%d')}")
+    print("Rango: " + ", ".join(f"{scheme} {start.strftime('%Y-%m-%d')} - {end.strftime('%Y-%m-%d')}"
+                                for scheme, (start, end) in windows.items()))
     print(f"Carpeta: {root_dir}")
-    
-    start_time = time.time()
-    
-    # Iterar todos los esquemas
-    total_files = 0
-    
-    for scheme in download_xm_file.ESQUEMAS.keys():
-        print(f"\n>> Procesando Esquema: {scheme}...")
+    print(f"Motor: {args.engine} ({max_workers} sondeos simultáneos{', adaptativo' if controller else ''})")
+    if args.deadline:
+        print(f"Plazo: {args.deadline:g} minutos")
+    if args.shard:
+        print(f"Shard: {args.shard[0]}/{args.shard[1]}")
+
+    # Verificación previa: si el portal no es alcanzable (red), unos segundos en vez de miles
+    # de timeouts. Cualquier respuesta HTTP, aunque sea un error, deja seguir la descarga
+    if not args.plan and not args.skip_preflight:
+        ok, detail = download_xm_file.preflight_check(root_dir, schemes)
+        if not ok:
+            print(f"[ERROR CRÍTICO] El portal XM no es alcanzable ({detail}). Se omite la descarga.")
+            return 1
+        print(f"Portal XM: responde, {detail}")
+
+    # Descubrimiento: nombres exactos desde las páginas de XM; el resto va a fuerza bruta
+    discovered = None
+    if args.discover:
         try:
-            # Usamos una lambda para imprimir logs con timestamp simple
-            log_func = lambda msg: print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
-            
-            count, days = download_xm_file.download_scheme_range(
-                start_date,
-                end_date,
-                scheme,
-                root_dir,
-                max_workers=40,  # El nuevo API es lento (~6s/404); más workers compensan
-                callback_log=log_func
-            )
-            total_files += count
+            import extract_xm_links
+            discovered = extract_xm_links.discover(schemes, root_dir, callback_log=log_func)
         except Exception as e:
-            print(f"[ERROR CRÍTICO] Falló esquema {scheme}: {e}")
+            print(f"[ERROR] Falló el descubrimiento en las páginas de XM (se sigue con fuerza bruta): {e}")
+
+    if args.plan:
+        plan = download_xm_file.ProbePlan(
+            start_date, end_date, schemes, root_dir,
+            miss_cache=download_xm_file.MissCache.for_root(root_dir),
+            calendar=download_xm_file.PublicationCalendar.from_archive(root_dir),
+            min_score=args.min_score, discovered=discovered, shard=args.shard, windows=windows)
+        print("\n=== PLAN (sin descargar) ===")
+        for line in plan.estimate(max_workers):
+            print(line)
+        return
+
+    start_time = time.time()
+    breaker = download_xm_file.CircuitBreaker(callback_log=log_func)
+    # El plazo cuenta desde el inicio del script (incluye verificación previa y descubrimiento)
+    deadline = script_start + args.deadline * 60 if args.deadline else None
+    manifest = None
+    if args.shard:
+        import shards_xm
+        manifest = shards_xm.ShardManifest(root_dir, args.shard, start_date, end_date)
+    
+    # Todos los esquemas en una sola cola compartida (reparto según "prioridad" de ESQUEMAS):
+    # la cola lenta de un esquema se solapa con el resto en vez de esperarse en serie.
+    print(f"\n>> Procesando Esquemas: {', '.join(schemes)}...")
+    results = {}
+    try:
+        results = engine.download_schemes_range(
+            start_date,
+            end_date,
+            schemes,
+            root_dir,
+            max_workers=max_workers,
+            callback_log=log_func,
+            controller=controller,
+            min_score=args.min_score,
+            discovered=discovered,
+            revalidate_days=args.revalidate_days,
+            breaker=breaker,
+            deadline=deadline,
+            shard=args.shard,
+            on_file=manifest.add if manifest else None,
+            windows=windows
+        )
+    except Exception as e:
+        print(f"[ERROR CRÍTICO] Falló la descarga de esquemas: {e}")
+    if manifest:
+        manifest.save()
+        print(f"Manifiesto del shard: {manifest.path} ({len(manifest.entries)} archivos)")
+
+    total_files = sum(count for count, _ in results.values())
+    for scheme, (count, days) in results.items():
+        print(f"  {scheme}: {count} archivos ({days} días)")
 
     elapsed = time.time() - start_time
     print(f"\n=== PROCESO TERMINADO ===")
     print(f"Total archivos descargados: {total_files}")
     print(f"Tiempo total: {elapsed:.2f} segundos")
+    print(breaker.summary())
+    if controller:
+        print(controller.summary())
+        for line in controller.history_lines():
+            print(f"  {line}")
+    return 0
     
     # Opcional: Pausa breve si se ejecuta por consola para ver resultado
     # time.sleep(5)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""
+Ejecución repartida en shards: el plan de sondeo se divide en N partes disjuntas por
+(esquema, fecha, archivo base) (ver download_xm_file.shard_of), cada una la corre un
+proceso o una máquina distinta, y al final se fusionan los resultados.
+
+- ShardManifest: lo que obtuvo un shard (nombre, tamaño, sha256, URL), guardado en
+  <root>/.xm_shards/shard-<i>-de-<N>.json.
+- merge_shards: copia a la carpeta destino los archivos de cada shard, junta sus cachés
+  de fallos y deja un manifiesto consolidado. Es idempotente (lo ya copiado se compara
+  por sha256 y se salta) y detecta conflictos: el mismo archivo con contenido distinto.
+
+Uso:
+    python run_daily.py --shard 2/4                  # en cada runner o proceso
+    python shards_xm.py merge Garantías runner1/Garantías runner2/Garantías ...
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+from datetime import datetime
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+import download_xm_file
+from download_xm_file import MissCache
+
+SHARDS_DIRNAME = ".xm_shards"  # Oculta: upload_drive no la sube
+MERGED_MANIFEST_FILENAME = "fusion.json"
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1, sort_keys=True, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _final_path(task):
+    """Archivo en disco de un sondeo exitoso (un .xls de TIE queda convertido a .xlsx)."""
+    path = os.path.join(task[2], task[1])
+    if not os.path.exists(path) and task[3] == "TIE":
+        converted = os.path.splitext(path)[0] + ".xlsx"
+        if os.path.exists(converted):
+            return converted
+    return path
+
+
+class ShardManifest:
+    """
+    Archivos obtenidos por un shard: {"esquema/nombre": {esquema, nombre, bytes, sha256, url,
+    fecha, estado}}. Relanzar el mismo shard sobre la misma raíz amplía el manifiesto.
+    """
+
+    def __init__(self, root_dir, shard, start_date=None, end_date=None):
+        self.root_dir = root_dir
+        self.shard = shard
+        self.path = os.path.join(root_dir, SHARDS_DIRNAME, f"shard-{shard[0]}-de-{shard[1]}.json")
+        self.start_date = start_date
+        self.end_date = end_date
+        self.entries = {}
+        self._added = []  # (sondeo, estado) aún sin anotar
+        if os.path.exists(self.path):
+            try:
+                self.entries = load_manifest(self.path).get("archivos", {})
+            except (OSError, ValueError) as e:
+                print(f"Advertencia: manifiesto de shard ilegible ({e}). Se crea de nuevo.")
+
+    def add(self, task, msg=None):
+        """
+        Hook on_file de download_schemes_range. Tamaño y sha256 se toman al guardar: la
+        limpieza TIE termina en su propia cola después de este aviso.
+        """
+        self._added.append((task, "cache" if msg and "Ya en disco" in msg else "nuevo"))
+
+    def _resolve(self):
+        added, self._added = self._added, []
+        for task, status in added:
+            path = _final_path(task)
+            if not os.path.exists(path):
+                continue
+            name = os.path.basename(path)
+            self.entries[f"{task[3]}/{name}"] = {
+                "esquema": task[3], "nombre": name, "bytes": os.path.getsize(path), "sha256": _sha256(path),
+                "url": task[0], "fecha": task[4].strftime("%Y-%m-%d") if task[4] else None, "estado": status}
+
+    def save(self):
+        self._resolve()
+        data = {"shard": f"{self.shard[0]}/{self.shard[1]}", "actualizado": datetime.now().isoformat(timespec="seconds"),
+                "archivos": self.entries}
+        if self.start_date and self.end_date:
+            data["rango"] = [self.start_date.strftime("%Y-%m-%d"), self.end_date.strftime("%Y-%m-%d")]
+        try:
+            _write_json(self.path, data)
+        except OSError as e:
+            print(f"Advertencia: no se pudo guardar el manifiesto del shard: {e}")
+
+
+def load_manifest(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def find_manifests(source):
+    """Manifiestos de shard en una raíz (o el .json dado)."""
+    if os.path.isfile(source):
+        return [source]
+    folder = os.path.join(source, SHARDS_DIRNAME)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.startswith("shard-") and name.endswith(".json"))
+
+
+def _same_file(a, b):
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+
+def _copy_into(src, dest):
+    """Copia atómica: nunca deja un archivo a medias con el nombre final."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_path = dest + download_xm_file.PARTIAL_SUFFIX
+    shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dest)
+    # El índice de tamaños y validadores (ETag) viaja con el archivo
+    src_folder, name = os.path.split(src)
+    entry = download_xm_file._file_index(src_folder).get(name) or {}
+    entry["bytes"] = os.path.getsize(dest)
+    download_xm_file._file_index(os.path.dirname(dest)).update(name, **entry)
+
+
+def merge_shards(dest_root, sources, callback_log=None):
+    """
+    Fusiona en dest_root los resultados de los shards de sources (raíces o manifiestos).
+    Retorna: {"copiados", "iguales", "faltantes": [...], "conflictos": [...], "shards": [...]}
+    """
+    def log(msg):
+        if callback_log: callback_log(msg)
+
+    merged_path = os.path.join(dest_root, SHARDS_DIRNAME, MERGED_MANIFEST_FILENAME)
+    merged = load_manifest(merged_path) if os.path.exists(merged_path) else {}
+    files = merged.get("archivos", {})
+    conflicts = []
+    summary = {"copiados": 0, "iguales": 0, "faltantes": [], "conflictos": conflicts, "shards": []}
+    dest_cache = MissCache.for_root(dest_root)
+    seen_counts = {}
+
+    for source in sources:
+        manifests = find_manifests(source)
+        if not manifests:
+            log(f"[FUSIÓN] {source}: sin manifiestos de shard.")
+        for manifest_path in manifests:
+            manifest = load_manifest(manifest_path)
+            source_root = os.path.dirname(os.path.dirname(os.path.abspath(manifest_path)))
+            shard = download_xm_file.parse_shard(manifest["shard"])
+            seen_counts.setdefault(shard[1], set()).add(shard[0])
+            summary["shards"].append(manifest["shard"])
+
+            for key, entry in sorted(manifest.get("archivos", {}).items()):
+                src = os.path.join(source_root, entry["esquema"], entry["nombre"])
+                dest = os.path.join(dest_root, entry["esquema"], entry["nombre"])
+                if not os.path.exists(src) or os.path.getsize(src) != entry["bytes"]:
+                    summary["faltantes"].append(key)
+                    log(f"[FUSIÓN] {key}: no está (o cambió) en {source_root}; se omite.")
+                    continue
+
+                known = files.get(key)
+                if known is not None and known["sha256"] != entry["sha256"]:
+                    conflicts.append({"archivo": key, "sha256": [known["sha256"], entry["sha256"]],
+                                      "shards": [known.get("shard"), manifest["shard"]]})
+                    log(f"[CONFLICTO] {key}: shards {known.get('shard')} y {manifest['shard']} descargaron contenidos distintos.")
+                    continue
+
+                if _same_file(src, dest):
+                    summary["iguales"] += 1
+                elif os.path.exists(dest):
+                    if _sha256(dest) == entry["sha256"]:
+                        summary["iguales"] += 1
+                    else:
+                        # Se conserva el destino: decidir a mano cuál es el correcto
+                        conflicts.append({"archivo": key, "sha256": [_sha256(dest), entry["sha256"]],
+                                          "shards": ["destino", manifest["shard"]]})
+                        log(f"[CONFLICTO] {key}: el destino ya tiene otro contenido que el shard {manifest['shard']}.")
+                        continue
+                else:
+                    _copy_into(src, dest)
+                    summary["copiados"] += 1
+                files[key] = dict(entry, shard=manifest["shard"])
+
+            if not _same_file(source_root, dest_root):
+                dest_cache.merge(MissCache.for_root(source_root))
+
+    for count, indices in sorted(seen_counts.items()):
+        missing = sorted(set(range(1, count + 1)) - indices)
+        if missing:
+            log(f"[FUSIÓN] Faltan shards de {count}: {', '.join(str(i) for i in missing)}.")
+    if len(seen_counts) > 1:
+        log(f"[FUSIÓN] Hay shards de repartos distintos (N = {', '.join(str(n) for n in sorted(seen_counts))}).")
+
+    dest_cache.save()
+    merged.update({"actualizado": datetime.now().isoformat(timespec="seconds"), "archivos": files,
+                   "shards": sorted(set(merged.get("shards", [])) | set(summary["shards"])),
+                   "conflictos": conflicts})
+    _write_json(merged_path, merged)
+    log(f"[FUSIÓN] {summary['copiados']} copiados, {summary['iguales']} ya presentes, "
+        f"{len(summary['faltantes'])} faltantes, {len(conflicts)} conflictos.")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fusiona los resultados de ejecuciones repartidas en shards.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    merge = sub.add_parser("merge", help="Copia a DESTINO los archivos de cada shard y consolida los manifiestos.")
+    merge.add_argument("dest", help="Carpeta raíz destino (ej: Garantías)")
+    merge.add_argument("sources", nargs="+", help="Raíces de los shards o sus manifiestos .json")
+    args = parser.parse_args(argv)
+
+    log_func = lambda msg: print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
+    summary = merge_shards(args.dest, args.sources, callback_log=log_func)
+    # Código 2 si hay conflictos: en CI el paso falla y se revisa a mano
+    return 2 if summary["conflictos"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Descubrimiento de archivos de XM contra una página guardada (sin red).
+
+Ejecutar desde la raíz del repositorio:
+    python -m unittest discover tests
+"""
+import datetime
+import os
+import tempfile
+import unittest
+
+import extract_xm_links
+from extract_xm_links import PageCache, discover, fixture_fetch, parse_links, resolve_blob_path
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "xm_garantias_mensuales.html")
+PAGE_URL = extract_xm_links.scheme_pages(["Mensual"])[0]
+CARPETA = "Energia y Mercado/Garantias Mensuales"
+API_URL = ("https://api-portalxm.xm.com.co/administracion-archivos/ficheros/descarga-archivo"
+           "?ruta=Energia%20y%20Mercado/Garantias%20Mensuales/2026/04.%20Abril/"
+           "GARANTIA%20MENSUAL%2001ABR-2026.xlsx&nombreBlobContainer=storageportalxm")
+
+EXPECTED = {
+    ("Mensual", "GARANTIA MENSUAL", datetime.date(2026, 4, 1), ""): "GARANTIA MENSUAL 01ABR-2026.xlsx",
+    ("Mensual", "GARANTIA MENSUAL", datetime.date(2026, 4, 1), "_V2"): "GARANTIA MENSUAL 01ABR-2026_V2.xlsx",
+    ("Mensual", "GARANTIA TXR", datetime.date(2026, 3, 2), ""): "GARANTIA TXR 02MAR-2026.xlsx",
+}
+
+
+def read_fixture():
+    with open(FIXTURE, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+class ParseLinksTest(unittest.TestCase):
+
+    def test_blob_paths(self):
+        links = parse_links(read_fixture(), PAGE_URL)
+        self.assertEqual([blob_path for _, _, blob_path in links], [
+            f"{CARPETA}/2026/04. Abril/GARANTIA MENSUAL 01ABR-2026.xlsx",
+            f"{CARPETA}/2026/04. Abril/GARANTIA MENSUAL 01ABR-2026_V2.xlsx",
+            f"{CARPETA}/2026/03. Marzo/GARANTIA TXR 02MAR-2026.xlsx",
+            "Agentes/Otros/INSTRUCTIVO 01ABR-2026.xlsx",
+            None,  # Enlace relativo del sitio, sin blob
+        ])
+
+    def test_link_text_and_urls(self):
+        text, full_url, _ = parse_links(read_fixture(), PAGE_URL)[0]
+        self.assertEqual(text, "Garantía mensual abril 2026")
+        self.assertEqual(full_url, API_URL)  # &amp; ya decodificado
+        relative = parse_links(read_fixture(), PAGE_URL)[-1][1]
+        self.assertEqual(relative, "https://www.xm.com.co/documentos/plantilla_garantias.xls")
+
+    def test_resolve_dates_and_versions(self):
+        resolved = [resolve_blob_path(blob_path, ["Mensual"])
+                    for _, _, blob_path in parse_links(read_fixture(), PAGE_URL) if blob_path]
+        self.assertEqual(dict(r for r in resolved if r), EXPECTED)
+        self.assertIsNone(resolved[-1])  # Carpeta de otro esquema
+
+
+class DiscoverTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_discover_from_fixture(self):
+        discovered = discover(["Mensual"], self.root, fetch=fixture_fetch({PAGE_URL: FIXTURE}))
+        self.assertEqual({key: filename for key, (_, filename) in discovered.items()}, EXPECTED)
+        url, _ = discovered[("Mensual", "GARANTIA MENSUAL", datetime.date(2026, 4, 1), "")]
+        self.assertEqual(url, API_URL)
+
+    def test_revalidation_uses_cached_page(self):
+        html = read_fixture()
+        requests = []
+
+        def fetch(url, headers):
+            requests.append(dict(headers))
+            if headers.get("If-None-Match") == '"v1"':
+                return 304, {}, ""
+            return 200, {"etag": '"v1"', "last-modified": "Fri, 17 Apr 2026 12:00:00 GMT"}, html
+
+        first = discover(["Mensual"], self.root, fetch=fetch)
+        second = discover(["Mensual"], self.root, fetch=fetch)
+
+        self.assertEqual(requests[0], {})
+        self.assertEqual(requests[1], {"If-None-Match": '"v1"',
+                                       "If-Modified-Since": "Fri, 17 Apr 2026 12:00:00 GMT"})
+        self.assertEqual(second, first)
+        self.assertEqual(len(second), len(EXPECTED))
+
+    def test_failed_fetch_falls_back_to_cache(self):
+        discover(["Mensual"], self.root, fetch=fixture_fetch({PAGE_URL: FIXTURE}))
+
+        def failing_fetch(url, headers):
+            raise ConnectionError("sin red")
+
+        log = []
+        discovered = discover(["Mensual"], self.root, fetch=failing_fetch, callback_log=log.append)
+        self.assertEqual(len(discovered), len(EXPECTED))
+        self.assertTrue(any("se usa la caché" in line for line in log))
+
+    def test_page_cache_validators(self):
+        cache = PageCache.for_root(self.root)
+        self.assertEqual(cache.conditional_headers(PAGE_URL), {})
+        cache.store(PAGE_URL, {"etag": '"v2"'}, "<html></html>")
+        meta, html = cache.get(PAGE_URL)
+        self.assertEqual((meta["etag"], html), ('"v2"', "<html></html>"))
+        self.assertEqual(cache.conditional_headers(PAGE_URL), {"If-None-Match": '"v2"'})
+
+
+if __name__ == "__main__":
+    unittest.main()
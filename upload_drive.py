@@ -4,6 +4,7 @@ import logging
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
+import manifest_xm
 # Configuración de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 # Scopes necesarios
@@ -42,8 +43,16 @@ def get_or_create_folder(service, parent_id, folder_name):
         folder = service.files().create(body=file_metadata, fields='id').execute()
         logging.info(f"Carpeta creada: {folder_name} (ID: {folder.get('id')})")
         return folder.get('id')
-def upload_files_recursive(base_folder_id, local_root):
-    """Sube archivos recursivamente manteniendo la estructura de carpetas."""
+def _upload_marker(path):
+    """Identifica el contenido subido: tamaño y fecha de modificación (ns)."""
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+def upload_files_recursive(base_folder_id, local_root, force=False):
+    """
+    Sube archivos recursivamente manteniendo la estructura de carpetas.
+    Si la raíz tiene manifiesto de descargas (manifest_xm), los libros que no cambiaron
+    desde la última subida se saltan sin consultar a Drive. force: subir todo igual.
+    """
     try:
         creds = authenticate_with_token_json()
         service = build('drive', 'v3', credentials=creds)
@@ -56,12 +65,36 @@ def upload_files_recursive(base_folder_id, local_root):
     # Diccionario para cachear los IDs de las carpetas creadas/encontradas
     # Clave: ruta relativa (ej: "Semanal"), Valor: drive_folder_id
     folder_cache = {}
+    manifest = manifest_xm.for_root(local_root) if manifest_xm.exists(local_root) else None
+    skipped = 0
     for root, dirs, files in os.walk(local_root):
+        # Carpetas ocultas (ej: .xm_coordinacion, .xm_shards) también son estado interno
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
         # Calcular ruta relativa desde la carpeta raíz local
         if root == local_root:
             rel_path = "."
         else:
             rel_path = os.path.relpath(root, local_root)
+        # Carpetas de primer nivel (esquemas): el manifiesto lleva el estado de subida
+        carpeta = rel_path if manifest and rel_path != "." and os.sep not in rel_path else None
+        # Archivos ocultos (ej: .xm_miss_cache.json) son estado interno del descargador
+        pending = []  # (nombre, marca de subida o None)
+        if carpeta:
+            manifest.sync(carpeta)  # Agrega los archivos copiados a mano desde la última descarga
+        for file_name in files:
+            if file_name.startswith('.'):
+                continue
+            marker = None
+            if carpeta:
+                row = manifest.get(carpeta, file_name)
+                if row is not None:
+                    marker = _upload_marker(os.path.join(root, file_name))
+                    if row["subido"] == marker and not force:
+                        skipped += 1
+                        continue
+            pending.append((file_name, marker))
+        if carpeta and not pending:
+            continue  # Nada nuevo: ni siquiera se consulta la carpeta en Drive
         
         # Determinar el ID de la carpeta padre en Drive para este nivel
         if rel_path == '.':
@@ -89,7 +122,7 @@ def upload_files_recursive(base_folder_id, local_root):
             
             current_drive_folder_id = parent_id
         # Subir archivos en la carpeta actual
-        for file_name in files:
+        for file_name, marker in pending:
             local_file_path = os.path.join(root, file_name)
             display_path = os.path.join(rel_path, file_name) if rel_path != "." else file_name
             logging.info(f"Procesando archivo: {display_path}")
@@ -108,9 +141,13 @@ def upload_files_recursive(base_folder_id, local_root):
                     file_id = items[0]['id']
                     file = service.files().update(fileId=file_id, media_body=media, fields='id').execute()
                     logging.info(f"Actualizado: {file_name}")
+                if marker:
+                    manifest.mark_uploaded(carpeta, file_name, marker)
             
             except Exception as e:
                 logging.error(f"Error al subir/actualizar {file_name}: {e}")
+    if skipped:
+        logging.info(f"Sin cambios desde la última subida (omitidos): {skipped} archivos")
 if __name__ == '__main__':
     # ID de la carpeta raíz de destino en Google Drive
     FOLDER_ID = os.environ.get('GDRIVE_FOLDER_ID')
@@ -121,4 +158,5 @@ if __name__ == '__main__':
         logging.error("La variable de entorno 'GDRIVE_FOLDER_ID' no está definida.")
     else:
         FOLDER_ID = FOLDER_ID.strip()
-        upload_files_recursive(FOLDER_ID, LOCAL_PATH)
+        # UPLOAD_FORCE=1: volver a subir todo (ej: si se borraron archivos en Drive)
+        upload_files_recursive(FOLDER_ID, LOCAL_PATH, force=os.environ.get('UPLOAD_FORCE') == '1')
@@ -0,0 +1,214 @@
+"""
+Modo vigilancia: proceso de larga duración que detecta publicaciones nuevas de XM a los
+pocos minutos, en vez de esperar a la ejecución diaria de run_daily.
+
+Cada esquema declara en ESQUEMAS ("sondeo" -> "vigilancia") cada cuántos minutos se
+revisa y qué días respecto a hoy. En cada ciclo solo se sondean las claves de esos días
+que aún faltan en disco, con la versión base y las variantes canónicas: unos pocos
+requests por ciclo. El pool de conexiones, el calendario de publicación y las claves ya
+encontradas se conservan en memoria entre ciclos.
+
+Cada archivo nuevo genera un evento: se informa en el log, se pasa a on_new_file y,
+con --events, se agrega como una línea JSON a un archivo.
+
+Uso:
+    python watch_xm.py
+    python watch_xm.py --schemes TIE Semanal --events eventos.jsonl
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+import download_xm_file
+from download_xm_file import (CircuitBreaker, PatternLog, ProbePlan, PublicationCalendar, RunCoordinator,
+                              PostProcessQueue)
+
+WATCH_WORKERS = 8          # Sondeos simultáneos: cada ciclo es pequeño
+WATCH_MIN_SLEEP = 5.0      # Segundos mínimos entre revisiones de qué esquema toca
+
+
+class Watcher:
+    """
+    Vigila los esquemas dados. cycle() ejecuta una revisión de los esquemas a los que les
+    toca; run() repite hasta que stop_event se active (o Ctrl+C).
+    on_new_file: función opcional on_new_file(evento) con evento =
+                 {"esquema", "archivo", "ruta", "fecha", "detectado"}.
+    """
+
+    def __init__(self, root_dir, scheme_names, max_workers=WATCH_WORKERS, callback_log=None,
+                 on_new_file=None, min_score=download_xm_file.DEFAULT_MIN_SCORE):
+        self.root_dir = root_dir
+        self.scheme_names = [name for name in scheme_names
+                             if download_xm_file._prepare_scheme_folder(root_dir, name, callback_log)]
+        self.max_workers = max_workers
+        self.callback_log = callback_log
+        self.on_new_file = on_new_file
+        self.min_score = min_score
+        self.calendar = PublicationCalendar.from_archive(root_dir, self.scheme_names)
+        self.patterns = PatternLog.for_root(root_dir)
+        self.policies = {name: download_xm_file.probe_policy(name)["vigilancia"] for name in self.scheme_names}
+        self.next_due = {name: 0.0 for name in self.scheme_names}
+        self.found = set()   # (esquema, archivo base, "YYYY-MM-DD") ya en disco
+        self.cycles = 0
+        self.requests = 0
+        self.events = 0
+
+    def log(self, msg):
+        if self.callback_log: self.callback_log(msg)
+
+    def _watch_days(self, scheme_name, today):
+        first, last = self.policies[scheme_name]["dias"]
+        if not download_xm_file.probe_policy(scheme_name)["fechas_futuras"]:
+            last = min(last, 0)
+        return [today + timedelta(days=offset) for offset in range(first, last + 1)]
+
+    def _ladders(self, scheme_names, now):
+        """Escaleras de las claves faltantes; las ya en disco pasan a self.found."""
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        # ProbePlan nuevo en cada ciclo: relee la carpeta (otros procesos pueden haber descargado)
+        plan = ProbePlan(today, today, scheme_names, self.root_dir)
+        ladders = []
+        for scheme_name in scheme_names:
+            for day in self._watch_days(scheme_name, today):
+                for file_base in download_xm_file.ESQUEMAS[scheme_name]["archivos"]:
+                    key = (scheme_name, file_base, day.strftime("%Y-%m-%d"))
+                    if key in self.found:
+                        continue
+                    if (download_xm_file.calendar_may_skip(scheme_name)
+                            and self.calendar.score(scheme_name, file_base, day, today) < self.min_score):
+                        continue
+                    ladder = plan.watch_ladder(scheme_name, file_base, day)
+                    if ladder is None:
+                        self.found.add(key)
+                    elif ladder:
+                        ladders.append(ladder)
+        # Las fechas que salieron de la ventana ya no hacen falta en memoria
+        oldest = min((self._watch_days(name, today)[0] for name in scheme_names), default=today)
+        self.found = {key for key in self.found if key[2] >= oldest.strftime("%Y-%m-%d")}
+        return ladders
+
+    def _emit(self, task, msg, path):
+        """path: ruta final del archivo (ej: el .xlsx en que la limpieza TIE convirtió un .xls)."""
+        scheme_name, file_date = task[3], task[4]
+        file_base = download_xm_file._match_file_base(task[1], scheme_name)
+        if file_base:
+            self.found.add((scheme_name, file_base, file_date.strftime("%Y-%m-%d")))
+            self.calendar.add(scheme_name, file_base, file_date)
+        if msg and "Ya en disco" in msg:
+            return  # Lo descargó otro proceso entre el listado y el sondeo
+        self.patterns.record(scheme_name, task[1])  # El nombre publicado, no el convertido
+        filename = os.path.basename(path)
+        event = {"esquema": scheme_name, "archivo": filename, "ruta": path,
+                 "fecha": file_date.strftime("%Y-%m-%d"), "detectado": datetime.now().isoformat(timespec="seconds")}
+        self.events += 1
+        self.log(f"[NUEVO] {scheme_name}: {filename} ({msg})")
+        if self.on_new_file:
+            try:
+                self.on_new_file(event)
+            except Exception as e:
+                self.log(f"[ERROR] Hook de archivo nuevo: {e}")
+
+    def cycle(self, now=None):
+        """Revisa los esquemas a los que les toca. Retorna los segundos hasta el próximo."""
+        now = now or datetime.now()
+        due = [name for name in self.scheme_names if self.next_due[name] <= time.time()]
+        if due:
+            self.cycles += 1
+            ladders = self._ladders(due, now)
+            # Un cortacircuitos por ciclo: un corte largo no detiene la vigilancia para siempre
+            breaker = CircuitBreaker(callback_log=self.callback_log)
+
+            found = []
+
+            def on_result(task, success, msg):
+                if success:
+                    found.append((task, msg))
+                elif msg and ("[ERROR]" in msg or "[EXCEPTION]" in msg):
+                    self.log(msg)
+
+            executed = 0
+            if ladders:
+                # Arriendo solo durante el ciclo: entre ciclos no hay sondeos que compartir
+                with RunCoordinator(self.root_dir, self.callback_log, defer=True) as coordinator, \
+                        PostProcessQueue(self.callback_log) as post_processor:
+                    for name in due:
+                        post_processor.resume(os.path.join(self.root_dir, name), name)
+                    worker = lambda *task: download_xm_file._download_worker_wrapper(
+                        *task, breaker=breaker, coordinator=coordinator, post_processor=post_processor)
+                    executed = download_xm_file._run_probe_ladders(ladders, worker, self.max_workers, on_result,
+                                                                   breaker=breaker)
+            # Los eventos salen con la limpieza TIE ya terminada: el archivo está en su forma final
+            for task, msg in found:
+                path = os.path.join(task[2], task[1])
+                # Un TIE .xls queda convertido a .xlsx (y el .xls borrado): el evento apunta al final
+                final_path = next((p for p in (download_xm_file._clean_paths(path)[0], path) if os.path.exists(p)), None)
+                if final_path is None:
+                    continue  # Libro ilegible, descartado al limpiarlo: se vuelve a buscar en el próximo ciclo
+                self._emit(task, msg, final_path)
+            self.requests += executed
+            self.patterns.save()
+            for name in due:
+                self.next_due[name] = time.time() + self.policies[name]["intervalo"] * 60
+            self.log(f"[VIGILANCIA] Ciclo {self.cycles} ({', '.join(due)}): {len(ladders)} claves faltantes, "
+                     f"{executed} sondeos.")
+        return max(min(self.next_due.values()) - time.time(), WATCH_MIN_SLEEP) if self.next_due else None
+
+    def run(self, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            wait = self.cycle()
+            if wait is None:
+                return
+            stop_event.wait(wait)
+
+    def summary(self):
+        return (f"Vigilancia: {self.cycles} ciclos, {self.requests} sondeos, "
+                f"{self.events} archivos nuevos.")
+
+
+def jsonl_hook(path):
+    """on_new_file que agrega cada evento como una línea JSON en path."""
+    lock = threading.Lock()
+
+    def hook(event):
+        with lock, open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+    return hook
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Vigila la publicación de archivos nuevos de XM.")
+    parser.add_argument("--schemes", nargs="+", default=list(download_xm_file.ESQUEMAS.keys()),
+                        choices=list(download_xm_file.ESQUEMAS.keys()))
+    parser.add_argument("--root", default=os.path.join(current_dir, "Garantías"))
+    parser.add_argument("--workers", type=int, default=WATCH_WORKERS, help="Sondeos simultáneos por ciclo.")
+    parser.add_argument("--events", default=None, help="Archivo .jsonl donde agregar un evento por archivo nuevo.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    log_func = lambda msg: print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
+    watcher = Watcher(args.root, args.schemes, max_workers=args.workers, callback_log=log_func,
+                      on_new_file=jsonl_hook(args.events) if args.events else None)
+    print(f"=== VIGILANCIA XM: {', '.join(watcher.scheme_names)} ===")
+    for name in watcher.scheme_names:
+        policy = watcher.policies[name]
+        print(f"  {name}: cada {policy['intervalo']} min, días {policy['dias'][0]:+d} a {policy['dias'][1]:+d}")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print("\nVigilancia detenida.")
+    print(watcher.summary())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
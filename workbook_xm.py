@@ -0,0 +1,142 @@
+"""
+Lectura y transformación de libros de Excel de XM, sin pandas ni estado.
+
+Las funciones de este módulo solo reciben bytes o rutas y no tocan el manifiesto, el
+almacén compartido ni la red: así pueden correr en los procesos de la etapa de CPU del
+pipeline de descarga (ver PostProcessQueue en download_xm_file), que solo necesitan
+este módulo.
+"""
+import io
+import os
+import zipfile
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None  # download_xm_file ya advierte al importarse
+
+try:
+    import xlrd
+except ImportError:
+    xlrd = None  # Solo hace falta para TIE publicados en formato Excel 97-2003 (.xls)
+
+# Firma de los primeros bytes: un 200 del API puede traer una página HTML o un JSON de
+# error; se detecta antes de escribir el cuerpo y nunca queda guardado como .xlsx/.xls.
+ZIP_MAGIC = b"PK\x03\x04"                            # .xlsx (Office Open XML)
+OLE2_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"   # .xls (Excel 97-2003)
+SNIFF_BYTES = len(OLE2_MAGIC)
+EXCEL_ENGINES = {"xlsx": "openpyxl", "xls": "xlrd"}
+
+class NotAWorkbookError(ValueError):
+    """El contenido descargado (o en disco) no es un libro de Excel."""
+
+def sniff_format(head):
+    """Formato real según los primeros bytes: "xlsx", "xls" o None si no es un libro."""
+    if head.startswith(ZIP_MAGIC):
+        return "xlsx"
+    if head.startswith(OLE2_MAGIC):
+        return "xls"
+    return None
+
+def describe_content(head):
+    text = head.lstrip().lower()
+    if not text:
+        return "vacío"
+    if text.startswith(b"<"):
+        return "HTML"
+    if text[:1] in (b"{", b"["):
+        return "JSON"
+    return f"desconocido ({head[:SNIFF_BYTES]!r})"
+
+def engine_available(file_format):
+    return {"xlsx": openpyxl, "xls": xlrd}.get(file_format) is not None
+
+def xls_value(cell, datemode):
+    """Valor de una celda de xlrd como lo entrega openpyxl (fechas, enteros, vacías como None)."""
+    if cell.ctype == xlrd.XL_CELL_DATE:
+        try:
+            return xlrd.xldate.xldate_as_datetime(cell.value, datemode)
+        except (ValueError, OverflowError):
+            return cell.value
+    if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+        return None
+    if cell.ctype == xlrd.XL_CELL_BOOLEAN:
+        return bool(cell.value)
+    if cell.ctype == xlrd.XL_CELL_NUMBER and float(cell.value).is_integer():
+        return int(cell.value)
+    return cell.value
+
+def sheet_rows(data, file_format):
+    """Valores de la primera hoja, fila por fila, leídos desde memoria."""
+    if file_format == "xlsx":
+        book = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            sheet = book.worksheets[0]
+            sheet.reset_dimensions()  # Algunos libros declaran mal su tamaño (ej: "A1")
+            for row in sheet.iter_rows(values_only=True):
+                yield row
+        finally:
+            book.close()
+    else:
+        book = xlrd.open_workbook(file_contents=data, on_demand=True)
+        try:
+            sheet = book.sheet_by_index(0)
+            for index in range(sheet.nrows):
+                yield [xls_value(cell, book.datemode) for cell in sheet.row(index)]
+        finally:
+            book.release_resources()
+
+def check_archive(data, file_format):
+    """Un .xlsx con algún miembro dañado (CRC) se lee a medias sin error: se revisa el zip entero."""
+    if file_format != "xlsx":
+        return
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        broken = archive.testzip()
+    if broken is not None:
+        raise zipfile.BadZipFile(f"{broken} dañado")
+
+def strip_first_column(data, file_format, dest):
+    """
+    Escribe en dest (.xlsx) la primera hoja sin la columna A, fila por fila en un libro de
+    escritura en streaming. Retorna la cantidad de filas.
+    """
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet("Sheet1")  # Mismo nombre de hoja que escribía pandas
+    rows = 0
+    for row in sheet_rows(data, file_format):
+        sheet.append(list(row[1:]))
+        rows += 1
+    book.save(dest)
+    return rows
+
+def process_download(path, clean_to=None):
+    """
+    Trabajo de CPU sobre un libro recién descargado: lo valida leyéndolo completo y, con
+    clean_to, escribe ahí la versión sin la columna A (limpieza TIE). path no se modifica.
+    Retorna {"formato", "filas", "error", "invalido"}; invalido: el archivo no se puede
+    leer como libro (dañado o de otro tipo), a diferencia de un motor no instalado.
+    """
+    result = {"formato": None, "filas": None, "error": None, "invalido": False}
+    with open(path, 'rb') as f:
+        data = f.read()
+    file_format = result["formato"] = sniff_format(data[:SNIFF_BYTES])
+    if file_format is None:
+        result.update(error=f"contenido {describe_content(data[:SNIFF_BYTES])}, no es un libro de Excel",
+                      invalido=True)
+        return result
+    for engine_format in {file_format, "xlsx" if clean_to else file_format}:
+        if not engine_available(engine_format):
+            result["error"] = f"Librería {EXCEL_ENGINES[engine_format]} no instalada."
+            return result
+    try:
+        check_archive(data, file_format)
+        if clean_to:
+            result["filas"] = strip_first_column(data, file_format, clean_to)
+        else:
+            result["filas"] = sum(1 for _ in sheet_rows(data, file_format))
+    except Exception as e:
+        if clean_to and os.path.exists(clean_to):
+            os.remove(clean_to)
+        # Un fallo al escribir (ej: disco lleno) no dice nada del libro descargado
+        result.update(error=str(e) or type(e).__name__, invalido=not isinstance(e, OSError))
+    return result